@@ -34,4 +34,5 @@ LOGFILES=$(echo /var/log/{nginx/error,nginx/http.error,nginx/http.access,supervi
 # Launch
 export OVERC_CONFIG=/etc/overc/server.ini
 export OVERC_DATABASE=mysql://$OVERC_DB_USER:$OVERC_DB_PASS@$OVERC_DB_HOST:$OVERC_DB_PORT/$OVERC_DB_NAME
+overc db upgrade
 exec /usr/bin/supervisord -n >/dev/null 2>&1 # it's logging to a file anyway
@@ -0,0 +1,74 @@
+import os
+import logging
+import argparse
+
+from overc import __version__, OvercApplication
+from overc.src.init import init_db_engine
+from overc.lib.db import schema
+from overc.lib import retention
+
+logger = logging.getLogger(__name__)
+
+
+def cmd_db_upgrade(args, app_config):
+    """ Create or upgrade the database schema """
+    db_engine = init_db_engine(app_config['DATABASE'], app_config)
+    version, new_version = schema.upgrade(db_engine)
+
+    if version is None:
+        print 'Database schema created: v{}'.format(new_version)
+    elif version == new_version:
+        print 'Database schema is up to date: v{}'.format(version)
+    else:
+        print 'Database schema upgraded: v{} -> v{}'.format(version, new_version)
+
+
+def cmd_prune(args, app_config):
+    """ Delete old rows according to the retention policies """
+    application = OvercApplication(__name__, app_config['INSTANCE_PATH'], app_config)
+    if not application.app.config['RETENTION']:
+        print 'No retention policies configured: see [retention] in the config file'
+        return
+
+    ssn = application.db()
+    try:
+        removed = retention.prune(application, ssn)
+    finally:
+        application.db.remove()
+
+    for name, n in removed.items():
+        print '{}: {} {} removed'.format(name, n, 'segments' if name == 'history' else 'rows')
+
+
+def main():
+    # Arguments
+    parser = argparse.ArgumentParser(
+        prog='overc',
+        description='OverC server management',
+        epilog='v{}'.format(__version__)
+    )
+    parser.add_argument('--verbose', '-v', action='count', default=0, help='Be more verbose. -vv includes debug output')
+    parser.add_argument('-c', '--config', dest='config', default=os.environ.get('OVERC_CONFIG', 'server.ini'), help='Server config file. Default: $OVERC_CONFIG, or "server.ini"')
+
+    # Subcommands
+    sub = parser.add_subparsers(dest='command_name', title='Command')
+
+    cmd = sub.add_parser('db', help='Database management')
+    db_sub = cmd.add_subparsers(dest='db_command_name', title='Command')
+    cmd = db_sub.add_parser('upgrade', help=cmd_db_upgrade.__doc__)
+    cmd.set_defaults(func=cmd_db_upgrade)
+
+    cmd = sub.add_parser('prune', help=cmd_prune.__doc__)
+    cmd.set_defaults(func=cmd_prune)
+
+    # Parse
+    args = parser.parse_args()
+
+    # Configure logging
+    logging.basicConfig(level=[logging.WARN, logging.INFO, logging.DEBUG, logging.NOTSET][args.verbose])
+
+    # Config
+    app_config = OvercApplication.loadConfigFile(args.config)
+
+    # Command
+    args.func(args, app_config)
@@ -0,0 +1,71 @@
+import threading
+from time import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """ Bounded in-process cache with time-based eviction
+
+    When full, the least recently used item is evicted.
+    Thread-safe.
+    """
+
+    def __init__(self, maxsize, ttl):
+        """ Init the cache
+        :param maxsize: Maximum number of items to keep
+        :type maxsize: int
+        :param ttl: Time to live, seconds
+        :type ttl: float
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Get an item
+        :param key: Item key
+        :param default: The value to return when missing or expired
+        :return: The value
+        """
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return default
+
+            # Expired?
+            if expires < time():
+                return default
+
+            # Move to the end: most recently used
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        """ Put an item
+        :param key: Item key
+        :param value: Item value
+        """
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time() + self.ttl, value)
+
+            # Evict the least recently used
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        """ Remove an item, if exists
+        :param key: Item key
+        """
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        """ Remove all items """
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,90 @@
+from time import time
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import select, func, and_
+
+
+def insert_ignore(ssn, table, rows):
+    """ Bulk insert rows, silently skipping the ones that violate unique constraints
+
+    Used to create rows that might have just been created by a concurrent transaction.
+
+    * MySQL: `INSERT IGNORE`
+    * SQLite: `INSERT OR IGNORE`
+    * Others: a savepoint, falling back to row-by-row inserts on conflict
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param table: The table to insert into
+    :type table: sqlalchemy.sql.schema.Table
+    :param rows: Rows to insert
+    :type rows: list[dict]
+    """
+    if not rows:
+        return
+
+    dialect = ssn.get_bind().dialect.name
+    if dialect == 'mysql':
+        ssn.execute(table.insert().prefix_with('IGNORE'), rows)
+    elif dialect == 'sqlite':
+        ssn.execute(table.insert().prefix_with('OR IGNORE'), rows)
+    else:
+        try:
+            with ssn.begin_nested():
+                ssn.execute(table.insert(), rows)
+        except IntegrityError:
+            for row in rows:
+                try:
+                    with ssn.begin_nested():
+                        ssn.execute(table.insert(), row)
+                except IntegrityError:
+                    pass
+
+
+def delete_id_ranges(ssn, table, whereclause, until_id, batch_size, deadline=None, before_delete=None):
+    """ Delete rows in small primary key ranges, committing after each one
+
+    Every batch is a short transaction over a primary key range of `batch_size` ids,
+    so big deletions neither take long locks nor bloat the transaction log.
+    Every range starts at the first matching row, so the gaps left by previous runs are skipped with a single index seek.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param table: The table to delete from. Must have a single-column integer primary key.
+    :type table: sqlalchemy.sql.schema.Table
+    :param whereclause: The condition for the rows to delete
+    :type whereclause: sqlalchemy.sql.expression.ClauseElement
+    :param until_id: The last primary key to consider, inclusive
+    :type until_id: int
+    :param batch_size: The size of every primary key range
+    :type batch_size: int
+    :param deadline: Stop at this time (see `time.time()`): the rest is left for the next run. At least one range is deleted.
+    :type deadline: float|None
+    :param before_delete: Called with the condition of every batch, in its transaction, before the rows are deleted
+    :type before_delete: callable|None
+    :returns: The number of rows deleted
+    :rtype: int
+    """
+    pk = table.primary_key.columns.values()[0]
+
+    def next_start(start):
+        """ The first row to delete at `start` or after it """
+        q = select([func.min(pk)]).where(and_(pk <= until_id, whereclause))
+        if start is not None:
+            q = q.where(pk >= start)
+        return ssn.execute(q).scalar()
+
+    total = 0
+    start = next_start(None)
+    while start is not None:
+        end = min(start + batch_size, until_id + 1)
+        batch = and_(pk >= start, pk < end, whereclause)
+        if before_delete is not None:
+            before_delete(batch)
+        res = ssn.execute(table.delete().where(batch))
+        ssn.commit()
+        total += res.rowcount
+        if deadline is not None and time() >= deadline:
+            break
+        start = next_start(end) if end <= until_id else None
+    return total
@@ -1,20 +1,79 @@
+import hashlib
 from datetime import datetime, timedelta
 
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm.session import object_session
 from sqlalchemy.sql.schema import Column, ColumnDefault
-from sqlalchemy.sql.schema import ForeignKey, UniqueConstraint, Index
+from sqlalchemy.sql.schema import ForeignKey, UniqueConstraint, PrimaryKeyConstraint, Index
 from sqlalchemy.sql.sqltypes import Boolean, SmallInteger, Integer, BigInteger, Float, String, Text, Unicode, UnicodeText, Binary, DateTime, Enum
 from sqlalchemy.orm import relationship, backref, remote, foreign
+from sqlalchemy.types import TypeDecorator
 
 from sqlalchemy.sql.expression import select, and_, func
 
 Base = declarative_base()
 
+#: Big integer primary key. SQLite only auto-increments INTEGER primary keys, which are 64-bit anyway
+BigIntegerPK = BigInteger().with_variant(Integer, 'sqlite')
+
 # TODO: server grouping
 # TODO: service grouping
 
 
+class state_t(int):
+    """ Comparable enum for state """
+    states = ('OK', 'WARN', 'FAIL',   'UNK')
+
+    OK = 0
+    WARN = 1
+    FAIL = 2
+    UNK = 3
+
+    def __new__(cls, state):
+        """ Make a state
+        :param state: State label, or its number
+        :type state: str|int
+        :exception ValueError: Invalid state
+        """
+        if isinstance(state, (int, long)):
+            intval = state
+            if not 0 <= intval < len(cls.states):
+                raise ValueError('Invalid state: {}'.format(state))
+        else:
+            intval = cls.states.index(state)
+        return super(state_t, cls).__new__(cls, intval)
+
+    @property
+    def name(self):
+        """ State label
+        :rtype: str
+        """
+        return self.states[self]
+
+    @classmethod
+    def is_valid(cls, state):
+        """ Test whether the state value is valid """
+        try:
+            cls.states.index(state)
+            return True
+        except ValueError:
+            return False
+
+
+class StateType(TypeDecorator):
+    """ State, stored as a small integer
+
+    Accepts both `state_t` numbers and labels; loads `state_t`.
+    """
+    impl = SmallInteger
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else int(state_t(value))
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else state_t(value)
+
+
 class Server(Base):
     """ A server being monitored """
     __tablename__ = 'servers'
@@ -48,10 +107,16 @@ class Service(Base):
     name = Column(String(32), nullable=False, doc="Service machine name (as reported from the remote)")
     title = Column(Unicode(64), nullable=False, default=u'', doc="Service title")
 
+    # Current state, denormalized: updated on ingest
+    current_state_id = Column(BigInteger, ForeignKey('service_states.id', use_alter=True, name='fk_services_current_state', ondelete='SET NULL'), nullable=True, doc="Current state id")
+    current_state = Column(StateType, nullable=True, doc="Current state")
+    current_rtime = Column(DateTime, nullable=True, doc="Current state received time")
+
     server = relationship(Server, foreign_keys=server_id, backref=backref('services', passive_deletes=True))
 
     __table_args__ = (
         UniqueConstraint(server_id, name),
+        Index('idx_current_state_id', current_state_id),
     )
 
     def update_timed_out(self):
@@ -61,7 +126,7 @@ class Service(Base):
         """
         if not self.state:
             return timedelta(seconds=0)
-        dt = datetime.utcnow() - self.state.rtime
+        dt = datetime.utcnow() - self.state.seen
         self.timed_out = dt > timedelta(seconds=self.period)
         return dt
 
@@ -72,85 +137,116 @@ class Service(Base):
         return self.title or self.name
 
 
-class state_t(int):
-    """ Comparable enum for state """
-    states = ('OK', 'WARN', 'FAIL',   'UNK')
-
-    OK = 0
-    WARN = 1
-    FAIL = 2
-    UNK = 3
+class ServiceStateInfo(Base):
+    """ Service info text, stored once: states with the same text share it """
+    __tablename__ = 'service_state_infos'
 
-    def __new__(cls, state):
-        intval = cls.states.index(state)
-        return super(state_t, cls).__new__(cls, intval)
+    id = Column(BigIntegerPK, primary_key=True, nullable=False)
+    hash = Column(String(40), nullable=False, doc="SHA1 of the text")
+    text = Column(UnicodeText, nullable=False, doc="Service info")
 
-    @classmethod
-    def is_valid(cls, state):
-        """ Test whether the state value is valid """
-        try:
-            cls.states.index(state)
-            return True
-        except ValueError:
-            return False
+    __table_args__ = (
+        UniqueConstraint(hash),
+    )
 
+    @staticmethod
+    def hash_text(text):
+        """ Get the hash of an info text
+        :type text: unicode
+        :rtype: str
+        """
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
 
 
 class ServiceState(Base):
     """ Service state """
     __tablename__ = 'service_states'
 
-    id = Column(BigInteger, primary_key=True, nullable=False)
+    id = Column(BigIntegerPK, primary_key=True, nullable=False)
     service_id = Column(Integer, ForeignKey(Service.id, ondelete='CASCADE'), nullable=False, doc="Service id")
 
     checked = Column(Boolean, nullable=False, default=False, doc="State checked (alerts created)?")
     rtime = Column(DateTime, default=datetime.utcnow, doc="Received time")
+    last_seen = Column(DateTime, nullable=True, doc="Last time the state was reported (repeated reports are merged in change-only storage mode)")
+    repeat_count = Column(Integer, nullable=False, default=0, doc="The number of repeated reports merged into this state")
 
-    state = Column(Enum(*state_t.states, name='service_state'), default='UNK', nullable=False, doc='Service status')
-    info = Column(UnicodeText, nullable=False, doc='Service info')
+    state = Column(StateType, default=state_t.UNK, nullable=False, doc='Service status')
+    info_id = Column(BigInteger, ForeignKey(ServiceStateInfo.id), nullable=False, doc='Service info id')
+
+    # Previous state, recorded on insert. Not a foreign key: old states can be deleted
+    prev_id = Column(BigInteger, nullable=True, doc="Previous state id, if any")
+    prev_state = Column(StateType, nullable=True, doc="Previous state, if any")
 
     service = relationship(Service, foreign_keys=service_id, backref=backref('states', passive_deletes=True))
+    info_blob = relationship(ServiceStateInfo, foreign_keys=info_id, lazy='joined', innerjoin=True, doc="Service info")
+    prev = relationship('ServiceState', viewonly=True, uselist=False,
+                        primaryjoin=remote(id) == foreign(prev_id),
+                        doc="Previous state, if any")
 
     __table_args__ = (
         Index('idx_serviceid_rtime_id', service_id, rtime, id),
-        Index('idx_checked', checked)
+        Index('idx_rtime', rtime),
+        Index('idx_checked', checked),
+        Index('idx_info_id', info_id),
     )
 
     @property
-    def prev(self):
-        # FIXME: learn how to apply .limit() to the relationship() query and uncomment the definition below
-        return object_session(self)\
-            .query(ServiceState)\
-            .filter(
-                ServiceState.id < self.id,
-                ServiceState.service_id == self.service_id
-            )\
-            .order_by(ServiceState.id.desc())\
-            .first()
-
-    # prev = relationship("ServiceState", viewonly=True, uselist=False,
-    #                                  primaryjoin=and_(
-    #                                      remote(id) < foreign(id),
-    #                                      remote(service_id) == foreign(service_id)
-    #                                  ), order_by=id.desc(), doc="Previous state, if any")
-
-
-latest_state = select([func.max(ServiceState.id)]). \
-    where(Service.id == ServiceState.service_id). \
-    correlate(Service). \
-    as_scalar()
+    def info(self):
+        """ Service info text
+        :rtype: unicode
+        """
+        return self.info_blob.text
+
+    @property
+    def seen(self):
+        """ Last time the state was reported
+        :rtype: datetime
+        """
+        return self.last_seen or self.rtime
+
+
 Service.state = relationship(ServiceState, viewonly=True, uselist=False,
-                             primaryjoin=and_(
-                                 ServiceState.id == latest_state,
-                                 ServiceState.service_id == Service.id
-                             ), doc="Current service state")
+                             foreign_keys=Service.current_state_id,
+                             doc="Current service state")
+
+
+#: Alert severity by channel & event: { 'channel/event': state_t }. Defaults to FAIL
+ALERT_SEVERITY = {
+    'plugin/online': state_t.OK,
+    'plugin/offline': state_t.FAIL,
+
+    'service:state/OK': state_t.OK,
+    'service:state/WARN': state_t.WARN,
+    'service:state/FAIL': state_t.FAIL,
+    'service:state/UNK': state_t.UNK,
+
+    'api/alert': state_t.FAIL
+}
+
+
+def alert_severity(channel, event):
+    """ Get alert severity by channel & event
+    :param channel: Alert channel
+    :type channel: str
+    :param event: Alert event
+    :type event: str
+    :return: Number: {0..3}
+    :rtype: int
+    """
+    return ALERT_SEVERITY.get('{}/{}'.format(channel, event), state_t.FAIL)
+
+
+def _default_alert_severity(context):
+    """ Column default: severity by the inserted channel & event """
+    params = context.current_parameters
+    return alert_severity(params['channel'], params['event'])
 
 
 class Alert(Base):
     """ Reported alerts """
     __tablename__ = 'alerts'
 
-    id = Column(BigInteger, primary_key=True, nullable=False)
+    id = Column(BigIntegerPK, primary_key=True, nullable=False)
     server_id = Column(Integer, ForeignKey(Server.id, ondelete='CASCADE'), nullable=True, doc="Server id")
     service_id = Column(Integer, ForeignKey(Service.id, ondelete='CASCADE'), nullable=True, doc="Service id")
     service_state_id = Column(BigInteger, ForeignKey(ServiceState.id, ondelete='SET NULL'), nullable=True, doc="Service state id (if any)")
@@ -161,6 +257,7 @@ class Alert(Base):
     channel = Column(String(32), nullable=False, doc="Alert channel")
     event = Column(String(32), nullable=False, doc="Alert event")
     message = Column(UnicodeText, nullable=False, doc="Alert details")
+    severity = Column(SmallInteger, nullable=False, default=_default_alert_severity, doc="Alert severity: {0..3}, see state_t")
 
     server = relationship(Server, foreign_keys=server_id, backref=backref('alerts', passive_deletes=True, order_by=id.desc()))
     service = relationship(Service, foreign_keys=service_id, backref=backref('alerts', passive_deletes=True, order_by=id.desc()))
@@ -168,6 +265,9 @@ class Alert(Base):
 
     __table_args__ = (
         Index('idx_reported', reported),
+        Index('idx_ctime_server_service', ctime, server_id, service_id),  # covers the alert counts
+        Index('idx_server_ctime', server_id, ctime, service_id),  # covers the alert counts of a server
+        Index('idx_service_ctime', service_id, ctime, server_id),  # covers the alert counts of a service
     )
 
     def __unicode__(self):
@@ -184,23 +284,76 @@ class Alert(Base):
             self.message
         ])
 
+
+#region Rollups
+
+class StateRollupMixin(object):
+    """ Service state aggregates for a period: hour, day """
+
+    @declared_attr
+    def service_id(cls):
+        return Column(Integer, ForeignKey(Service.id, ondelete='CASCADE'), nullable=False, doc="Service id")
+
+    period = Column(DateTime, nullable=False, doc="Period start")
+
+    n_ok = Column(Integer, nullable=False, default=0, doc="The number of OK reports")
+    n_warn = Column(Integer, nullable=False, default=0, doc="The number of WARN reports")
+    n_fail = Column(Integer, nullable=False, default=0, doc="The number of FAIL reports")
+    n_unk = Column(Integer, nullable=False, default=0, doc="The number of UNK reports")
+    n_states = Column(Integer, nullable=False, default=0, doc="The number of stored states (repeated reports merged)")
+    transitions = Column(Integer, nullable=False, default=0, doc="The number of state changes")
+
+    first_rtime = Column(DateTime, nullable=False, doc="The first state received time")
+    last_seen = Column(DateTime, nullable=False, doc="The last time a state was reported")
+
+    @declared_attr
+    def __table_args__(cls):
+        return (
+            PrimaryKeyConstraint('service_id', 'period'),
+        )
+
     @property
-    def severity(self):
-        """ Alert severity as a number
-        :return: Number: {0..3}
-        :rtype: int
+    def counts(self):
+        """ The number of reports per state
+        :rtype: dict[str, int]
         """
-        return {
-            'plugin/online': state_t.OK,
-            'plugin/offline': state_t.FAIL,
-
-            'service:state/OK': state_t.OK,
-            'service:state/WARN': state_t.WARN,
-            'service:state/FAIL': state_t.FAIL,
-            'service:state/UNK': state_t.UNK,
-
-            'api/alert': state_t.FAIL
-        }.get(
-            '{}/{}'.format(self.channel, self.event),
-            state_t.FAIL
-        )
+        return {'OK': self.n_ok, 'WARN': self.n_warn, 'FAIL': self.n_fail, 'UNK': self.n_unk}
+
+
+class ServiceStateHourly(StateRollupMixin, Base):
+    """ Service state aggregates, per hour
+
+    The latest state of the hour might be repeated after the hour is rolled up:
+    `last_repeat_count` is the number of its repeats counted so far.
+    """
+    __tablename__ = 'service_states_hourly'
+
+    last_state_id = Column(BigInteger, nullable=True, doc="The latest state of the hour")
+    last_repeat_count = Column(Integer, nullable=False, default=0, doc="The number of repeats of the latest state counted")
+
+    __table_args__ = (
+        PrimaryKeyConstraint('service_id', 'period'),
+        Index('idx_last_state_id', 'last_state_id'),
+    )
+
+
+class ServiceStateDaily(StateRollupMixin, Base):
+    """ Service state aggregates, per day """
+    __tablename__ = 'service_states_daily'
+
+
+class RollupWatermark(Base):
+    """ Rollup progress: everything before `until` is rolled up """
+    __tablename__ = 'rollup_watermarks'
+
+    name = Column(String(32), primary_key=True, nullable=False, doc="Rollup name")
+    until = Column(DateTime, nullable=False, doc="Rolled up until, exclusive")
+
+#endregion
+
+
+class SchemaVersion(Base):
+    """ Database schema version: a single row. See `overc.lib.db.schema` """
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True, nullable=False, doc="Schema version")
@@ -0,0 +1,93 @@
+import threading
+from time import time
+
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats(object):
+    """ Connection pool usage statistics: checkouts, wait time, hold time
+
+    Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0  # The number of checkouts
+        self.checked_out = 0  # Connections currently checked out
+        self.peak = 0  # The maximum number of connections checked out at once
+        self.wait_total = 0.0  # Time spent waiting for a connection, seconds
+        self.wait_max = 0.0
+        self.hold_total = 0.0  # Time connections were checked out for, seconds
+        self.hold_max = 0.0
+
+    def waited(self, seconds):
+        """ Record a checkout: the time spent waiting for the connection """
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak = max(self.peak, self.checked_out)
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def held(self, seconds):
+        """ Record a checkin: the time the connection was checked out for """
+        with self._lock:
+            self.checked_out -= 1
+            self.hold_total += seconds
+            self.hold_max = max(self.hold_max, seconds)
+
+    def as_dict(self):
+        """ Get the statistics. Times are in milliseconds.
+        :rtype: dict
+        """
+        with self._lock:
+            n = self.checkouts or 1
+            return {
+                'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'peak': self.peak,
+                'wait_avg': self.wait_total / n * 1000,
+                'wait_max': self.wait_max * 1000,
+                'hold_avg': self.hold_total / n * 1000,
+                'hold_max': self.hold_max * 1000,
+            }
+
+    def __str__(self):
+        return ('{checkouts} checkouts, {checked_out} checked out (peak: {peak}), '
+                'wait: {wait_avg:.1f}ms avg, {wait_max:.1f}ms max, '
+                'hold: {hold_avg:.1f}ms avg, {hold_max:.1f}ms max').format(**self.as_dict())
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that collects usage statistics: `pool.stats` """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.stats = PoolStats()
+        self._timing = threading.local()
+
+    def recreate(self):
+        pool = super(TimedQueuePool, self).recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        # QueuePool._do_get() may call itself: only time the outermost call
+        if getattr(self._timing, 'active', False):
+            return super(TimedQueuePool, self)._do_get()
+
+        self._timing.active = True
+        start = time()
+        try:
+            conn = super(TimedQueuePool, self)._do_get()
+        finally:
+            self._timing.active = False
+        self.stats.waited(time() - start)
+        conn.info['checkout_time'] = time()
+        return conn
+
+    def _do_return_conn(self, conn):
+        checkout_time = conn.info.pop('checkout_time', None)
+        if checkout_time is not None:
+            self.stats.held(time() - checkout_time)
+        super(TimedQueuePool, self)._do_return_conn(conn)
@@ -0,0 +1,538 @@
+""" Database schema versioning
+
+The schema version is stored in the `schema_version` table, as a single row.
+Processes only check it on start-up: tables are created and upgraded with `overc db upgrade`.
+
+Version 1 is the baseline: the schema OverC created before it was versioned.
+To change the schema, bump `SCHEMA_VERSION`, and register the steps of its migration with `@migration()`.
+
+Migrations are resumable: every step records its progress in the `schema_migrations` table as it commits,
+and data is backfilled with set-based statements, in id ranges, a transaction each.
+"""
+
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import Table, Column, MetaData, AddConstraint, ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy.sql.expression import select, case, and_, func, text, literal_column
+from sqlalchemy.sql.sqltypes import Integer, BigInteger, UnicodeText
+
+from overc.lib.db import models
+
+logger = logging.getLogger(__name__)
+
+#: The schema version the models describe
+SCHEMA_VERSION = 4
+
+#: Migrations: { version: [ (step, batch table, batch size), ... ] }. Each one upgrades the schema from `version - 1` to `version`.
+#: See `migration()`
+MIGRATIONS = OrderedDict()
+
+#: Migration progress: a row per migration in progress, so a migration that failed resumes where it stopped
+PROGRESS = Table('schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True, autoincrement=False, nullable=False),  # the version being migrated to
+    Column('step', Integer, nullable=False),  # the number of steps done
+    Column('last_id', BigInteger, nullable=True),  # batched step: the last id done
+)
+
+#: The baseline schema, v1: { table name: column names }
+BASELINE_TABLES = {
+    'servers': {'id', 'title', 'name', 'key', 'ip'},
+    'services': {'id', 'server_id', 'period', 'timed_out', 'name', 'title'},
+    'service_states': {'id', 'service_id', 'checked', 'rtime', 'state', 'info'},
+    'alerts': {'id', 'server_id', 'service_id', 'service_state_id', 'reported', 'ctime', 'channel', 'event', 'message'},
+}
+
+
+class SchemaVersionError(RuntimeError):
+    """ The database schema is missing or out of date """
+
+
+def get_version(engine):
+    """ Get the schema version of the database
+    :param engine: Engine
+    :type engine: sqlalchemy.engine.Engine
+    :return: Schema version, or None when the database is not versioned
+    :rtype: int|None
+    """
+    try:
+        return engine.execute(models.SchemaVersion.__table__.select()).scalar()
+    except SQLAlchemyError:
+        return None
+
+
+def check(engine):
+    """ Check that the database schema is up to date: a single query
+    :param engine: Engine
+    :type engine: sqlalchemy.engine.Engine
+    :exception SchemaVersionError: The schema is missing or out of date
+    """
+    version = get_version(engine)
+    if version != SCHEMA_VERSION:
+        raise SchemaVersionError('Database schema version is {}, expected {}: run `overc db upgrade`'.format(
+            'missing' if version is None else version, SCHEMA_VERSION))
+
+
+def _is_baseline(engine):
+    """ Does an unversioned database have the baseline schema?
+    :rtype: bool
+    """
+    insp = inspect(engine)
+    tables = set(insp.get_table_names()) & set(models.Base.metadata.tables)
+    return tables == set(BASELINE_TABLES) and all(
+        set(c['name'] for c in insp.get_columns(name)) == columns
+        for name, columns in BASELINE_TABLES.items()
+    )
+
+
+def upgrade(engine):
+    """ Create or upgrade the database schema
+
+    * An empty database gets all the tables;
+    * An unversioned database with the baseline tables is v1, and is upgraded.
+      Any other unversioned database is refused: its schema is unknown;
+    * A versioned one gets the migrations applied, one at a time, step by step: see `migration()`.
+      A migration that failed, or was interrupted, resumes at the step it stopped at.
+
+    MySQL commits schema changes implicitly: when a step that changes the schema fails there, the database needs fixing by hand.
+
+    :param engine: Engine
+    :type engine: sqlalchemy.engine.Engine
+    :return: (the version before, the version after)
+    :rtype: (int|None, int)
+    :exception SchemaVersionError: The database is not versioned, and its schema is unknown
+    """
+    table = models.SchemaVersion.__table__
+    version = get_version(engine)
+
+    # Unversioned
+    if version is None:
+        if not set(inspect(engine).get_table_names()) & set(models.Base.metadata.tables):
+            with engine.begin() as conn:
+                models.Base.metadata.create_all(bind=conn)
+                conn.execute(table.delete())
+                conn.execute(table.insert(), {'version': SCHEMA_VERSION})
+            logger.info('Created database schema v{}'.format(SCHEMA_VERSION))
+            return version, SCHEMA_VERSION
+
+        if not _is_baseline(engine):
+            raise SchemaVersionError('Database is not versioned, and its tables are not the baseline ones: refusing to upgrade')
+        with engine.begin() as conn:
+            table.create(bind=conn)
+            conn.execute(table.insert(), {'version': 1})
+        version = 1
+        logger.info('Found the baseline database schema: v1')
+
+    # Migrate
+    assert version <= SCHEMA_VERSION, 'Database schema v{} is newer than v{}: upgrade OverC'.format(version, SCHEMA_VERSION)
+    for v in range(version + 1, SCHEMA_VERSION + 1):
+        _migrate(engine, v)
+        logger.info('Upgraded database schema to v{}'.format(v))
+    return version, SCHEMA_VERSION
+
+
+def _id_ranges(conn, table, start, batch_size):
+    """ Split the ids of a table into ranges of `batch_size` rows, skipping the gaps
+    :param start: The first id, or None to start from the lowest one
+    :return: Iterator of (start, end), for the ids `start <= id < end`
+    :rtype: collections.Iterator[(int, int)]
+    """
+    until_id = conn.execute(select([func.max(table.c.id)])).scalar()
+    if start is None:
+        start = conn.execute(select([func.min(table.c.id)])).scalar()
+    while start is not None and start <= until_id:
+        end = conn.execute(select([table.c.id]).where(table.c.id >= start).order_by(table.c.id).offset(batch_size).limit(1)).scalar()
+        yield start, end if end is not None else until_id + 1
+        start = end
+
+
+def _migrate(engine, version):
+    """ Apply a migration, and stamp the version
+
+    The steps done already, according to the progress, are skipped.
+    SQLite table rebuilds need foreign keys off: they're checked after the migration instead.
+    """
+    P = PROGRESS
+    conn = engine.connect()
+    try:
+        sqlite = conn.dialect.name == 'sqlite'
+        if sqlite:
+            foreign_keys = conn.execute('PRAGMA foreign_keys').scalar()
+            conn.execute('PRAGMA foreign_keys=OFF')
+        try:
+            # Progress
+            P.create(bind=conn, checkfirst=True)
+            progress = conn.execute(select([P.c.step, P.c.last_id]).where(P.c.version == version)).first()
+            if progress is None:
+                conn.execute(P.insert(), {'version': version, 'step': 0, 'last_id': None})
+                progress = (0, None)
+            elif progress != (0, None):
+                logger.info('Resuming the migration to v{}: step {}, id {}'.format(version, *progress))
+            set_progress = lambda **values: conn.execute(P.update().where(P.c.version == version).values(**values))
+
+            # Steps
+            for n, (step, table, batch_size) in enumerate(MIGRATIONS[version]):
+                if n < progress[0]:
+                    continue
+                if table is None:
+                    with conn.begin():
+                        step(conn)
+                        set_progress(step=n + 1)
+                    continue
+
+                last_id = progress[1] if n == progress[0] else None
+                for start, end in _id_ranges(conn, table, last_id + 1 if last_id is not None else None, batch_size):
+                    with conn.begin():
+                        step(conn, start, end)
+                        set_progress(last_id=end - 1)
+                with conn.begin():
+                    set_progress(step=n + 1, last_id=None)
+
+            # Stamp
+            with conn.begin():
+                violations = conn.execute('PRAGMA foreign_key_check') if sqlite else None
+                if violations is not None and violations.returns_rows and violations.fetchall():
+                    raise SchemaVersionError('Migration to v{} broke foreign keys'.format(version))
+                conn.execute(P.delete().where(P.c.version == version))
+                conn.execute(models.SchemaVersion.__table__.update().values(version=version))
+        finally:
+            if sqlite:
+                conn.execute('PRAGMA foreign_keys={:d}'.format(foreign_keys))
+    finally:
+        conn.close()
+
+
+def migration(version, batches=None, batch_size=10000):
+    """ Decorator: register a migration step
+
+    A migration is a sequence of steps, in the order they're registered: `step(conn)`.
+    Every step runs in a transaction of its own, and records its progress along with it.
+
+    A batched step runs for every id range of a table: `step(conn, start, end)`, for the ids `start <= id < end`.
+    Every range is a transaction of its own, and records its progress along with it.
+
+    :param version: The version it upgrades to
+    :type version: int
+    :param batches: Batched step: the table to go through in id ranges
+    :type batches: sqlalchemy.sql.schema.Table|None
+    :param batch_size: Batched step: the number of rows in every id range
+    :type batch_size: int
+    """
+    def decorator(f):
+        MIGRATIONS.setdefault(version, []).append((f, batches, batch_size))
+        return f
+    return decorator
+
+
+#region Helpers
+
+def _add_column(conn, column, nullable=None, default=None, foreign_key=True):
+    """ Add a model column to its table
+
+    On SQLite, a foreign key can only be declared along with the column.
+
+    :param conn: Connection
+    :type conn: sqlalchemy.engine.Connection
+    :param column: Model column
+    :type column: sqlalchemy.sql.schema.Column
+    :param nullable: Override the column's nullability
+    :type nullable: bool|None
+    :param default: Default value (SQL) for the existing rows of a NOT NULL column. It stays as the column default.
+    :type default: str|None
+    :param foreign_key: Add the column's foreign key as well
+    :type foreign_key: bool
+    """
+    nullable = column.nullable if nullable is None else nullable
+    spec = '{} {}{}{}'.format(
+        conn.dialect.identifier_preparer.format_column(column),
+        column.type.compile(dialect=conn.dialect),
+        '' if nullable else ' NOT NULL',
+        '' if default is None else ' DEFAULT {}'.format(default))
+
+    fk = next(iter(column.foreign_keys), None) if foreign_key else None
+    if fk is not None and conn.dialect.name == 'sqlite':
+        spec += ' REFERENCES {} ({}){}'.format(fk.column.table.name, fk.column.name, ' ON DELETE {}'.format(fk.ondelete) if fk.ondelete else '')
+        fk = None
+
+    conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(column.table.name, spec))
+    if fk is not None:
+        conn.execute(AddConstraint(fk.constraint))
+
+
+def _create_indexes(conn, table, *names):
+    """ Create model indexes, by name """
+    for index in table.indexes:
+        if index.name in names:
+            index.create(bind=conn)
+
+
+def _sqlite_rebuild(conn, Model, values=None, drop=()):
+    """ SQLite: rebuild a table as the model declares it, which is the only way to change columns
+
+    The new table has the model's columns that the table has, in the model's order, then the other columns of the table.
+    The rows are copied, the old table is dropped, and the model's indexes are created.
+
+    :param conn: Connection. Foreign keys should be off.
+    :type conn: sqlalchemy.engine.Connection
+    :param Model: Model
+    :param values: Column values: { name: callable(old table): SQL expression }. Other columns are copied as they are.
+    :type values: dict|None
+    :param drop: Columns to drop
+    :type drop: tuple[str]
+    """
+    values = values or {}
+    table = Model.__table__
+    old = Table(table.name, MetaData(), autoload=True, autoload_with=conn)
+    names = [c.name for c in table.columns if c.name in old.c or c.name in values] + \
+            [c.name for c in old.columns if c.name not in table.c and c.name not in drop]
+
+    # Columns, then the model's constraints: copied columns do not bring them along
+    columns = [(table.c[name] if name in table.c else old.c[name]).copy() for name in names]
+    constraints = [
+        ForeignKeyConstraint([c.name for c in constraint.columns], [fk.column for fk in constraint.elements],
+                             name=constraint.name, ondelete=constraint.ondelete)
+        if isinstance(constraint, ForeignKeyConstraint) else
+        UniqueConstraint(*[c.name for c in constraint.columns], name=constraint.name)
+        for constraint in table.constraints
+        if isinstance(constraint, (ForeignKeyConstraint, UniqueConstraint)) and all(c.name in names for c in constraint.columns)
+    ]
+    new = Table(table.name + '__new', MetaData(), *(columns + constraints))
+    new.create(bind=conn)
+    conn.execute(new.insert().from_select(names, select([
+        values[name](old) if name in values else old.c[name]
+        for name in names
+    ])))
+    conn.execute('DROP TABLE {}'.format(table.name))
+    conn.execute('ALTER TABLE {} RENAME TO {}'.format(new.name, table.name))
+
+    for index in table.indexes:
+        if all(c.name in names for c in index.columns):
+            index.create(bind=conn)
+
+#endregion
+
+
+#region Migrations
+
+def _alert_severity(alerts):
+    """ Alert severity by channel & event, see `models.alert_severity()`: SQL expression """
+    return case([
+        (and_(alerts.c.channel == channel, alerts.c.event == event), int(severity))
+        for channel, event, severity in ((key.split('/', 1) + [severity]) for key, severity in models.ALERT_SEVERITY.items())
+    ], else_=int(models.state_t.FAIL))
+
+
+def _state_number(conn, label):
+    """ The number of a state label, see `models.state_t`: SQL. States were stored as labels until v3
+    :param label: SQL: the label column
+    :type label: str
+    :rtype: str
+    """
+    if conn.dialect.name == 'postgresql':
+        label += '::text'  # an ENUM
+    return 'CASE {} {} END'.format(label, ' '.join("WHEN '{}' THEN {:d}".format(name, n) for n, name in enumerate(models.state_t.states)))
+
+
+@migration(2)
+def _v2_structure(conn):
+    """ v2: current & previous state pointers, merged repeats, alert severity, rollups, time indexes. The tables """
+    S, Svc, A = models.ServiceState.__table__, models.Service.__table__, models.Alert.__table__
+
+    # Rollups
+    for Model in (models.ServiceStateHourly, models.ServiceStateDaily, models.RollupWatermark):
+        Model.__table__.create(bind=conn)
+
+    # Service states: merged repeats, the previous state.
+    # The previous states are found by (service_id, id): a temporary index
+    _add_column(conn, S.c.last_seen)
+    _add_column(conn, S.c.repeat_count, default='0')
+    _add_column(conn, S.c.prev_id)
+    _add_column(conn, S.c.prev_state)
+    _create_indexes(conn, S, 'idx_rtime')
+    conn.execute('CREATE INDEX idx_v2_service_id_id ON service_states (service_id, id)')
+
+    # Services: the current state
+    _add_column(conn, Svc.c.current_state_id)
+    _add_column(conn, Svc.c.current_state)
+    _add_column(conn, Svc.c.current_rtime)
+    _create_indexes(conn, Svc, 'idx_current_state_id')
+
+    # Alerts: severity. SQLite: the rebuild also makes the primary key auto-increment, and creates the indexes
+    if conn.dialect.name == 'sqlite':
+        _sqlite_rebuild(conn, models.Alert, {'severity': _alert_severity})
+    else:
+        _add_column(conn, A.c.severity, default=str(int(models.state_t.FAIL)))
+
+
+@migration(2, batches=models.ServiceState.__table__)
+def _v2_prev_states(conn, start, end):
+    """ v2: the previous state of every state """
+    state = _state_number(conn, 'p.state')
+    if conn.dialect.name == 'mysql':
+        # MySQL does not update a table it selects from in a subquery: unless it's a derived table it materializes
+        conn.execute(text(
+            'UPDATE service_states s JOIN ('
+            '   SELECT c.id, (SELECT MAX(p.id) FROM service_states p WHERE p.service_id = c.service_id AND p.id < c.id) AS prev_id'
+            '   FROM service_states c WHERE c.id >= :start AND c.id < :end'
+            ') d ON d.id = s.id '
+            'SET s.prev_id = d.prev_id'), start=start, end=end)
+        conn.execute(text(
+            'UPDATE service_states s JOIN service_states p ON p.id = s.prev_id '
+            'SET s.prev_state = {} '
+            'WHERE s.id >= :start AND s.id < :end'.format(state)), start=start, end=end)
+    else:
+        conn.execute(text(
+            'UPDATE service_states '
+            'SET prev_id = (SELECT MAX(p.id) FROM service_states p WHERE p.service_id = service_states.service_id AND p.id < service_states.id) '
+            'WHERE id >= :start AND id < :end'), start=start, end=end)
+        conn.execute(text(
+            'UPDATE service_states '
+            'SET prev_state = (SELECT {} FROM service_states p WHERE p.id = service_states.prev_id) '
+            'WHERE id >= :start AND id < :end AND prev_id IS NOT NULL'.format(state)), start=start, end=end)
+
+
+@migration(2, batches=models.Alert.__table__)
+def _v2_alert_severity(conn, start, end):
+    """ v2: alert severity. SQLite: set by the rebuild """
+    A = models.Alert.__table__
+    if conn.dialect.name != 'sqlite':
+        conn.execute(A.update().where(and_(A.c.id >= start, A.c.id < end)).values(severity=_alert_severity(A)))
+
+
+@migration(2)
+def _v2_current_states(conn):
+    """ v2: the current state of every service, the indexes """
+    conn.execute(
+        'UPDATE services '
+        'SET current_state_id = (SELECT MAX(s.id) FROM service_states s WHERE s.service_id = services.id)')
+    conn.execute(
+        'UPDATE services '
+        'SET current_state = (SELECT {} FROM service_states s WHERE s.id = services.current_state_id), '
+        '    current_rtime = (SELECT s.rtime FROM service_states s WHERE s.id = services.current_state_id) '
+        'WHERE current_state_id IS NOT NULL'.format(_state_number(conn, 's.state')))
+    conn.execute('DROP INDEX idx_v2_service_id_id{}'.format(' ON service_states' if conn.dialect.name == 'mysql' else ''))
+
+    if conn.dialect.name != 'sqlite':
+        _create_indexes(conn, models.Alert.__table__, 'idx_ctime_server_service', 'idx_server_ctime', 'idx_service_ctime')
+
+
+@migration(3)
+def _v3_state_column(conn):
+    """ v3: service states are small integers, see `models.StateType`. They were labels: an ENUM, or a string on SQLite.
+
+    The numbers go to a new column, then it replaces the labels.
+    SQLite: a table rebuild, which also drops the CHECK constraint of the labels, and makes the primary key auto-increment.
+    """
+    dialect = conn.dialect.name
+    if dialect in ('mysql', 'postgresql'):
+        conn.execute('ALTER TABLE service_states ADD COLUMN state_number SMALLINT NULL')
+    elif dialect == 'sqlite':
+        _sqlite_rebuild(conn, models.ServiceState, {'state': lambda states: case([
+            (states.c.state == name, n) for n, name in enumerate(models.state_t.states)
+        ])})
+    else:
+        raise SchemaVersionError('Migration to v3 does not support "{}"'.format(dialect))
+
+
+@migration(3, batches=models.ServiceState.__table__)
+def _v3_state_numbers(conn, start, end):
+    """ v3: the state numbers. SQLite: set by the rebuild """
+    if conn.dialect.name != 'sqlite':
+        conn.execute(text(
+            'UPDATE service_states SET state_number = {} '
+            'WHERE id >= :start AND id < :end'.format(_state_number(conn, 'state'))), start=start, end=end)
+
+
+@migration(3)
+def _v3_replace_labels(conn):
+    """ v3: the numbers replace the labels. MySQL: a single table rebuild """
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        conn.execute('ALTER TABLE service_states DROP COLUMN state, CHANGE state_number state SMALLINT NOT NULL')
+    elif dialect == 'postgresql':
+        conn.execute('ALTER TABLE service_states DROP COLUMN state')
+        conn.execute('ALTER TABLE service_states RENAME COLUMN state_number TO state')
+        conn.execute('ALTER TABLE service_states ALTER COLUMN state SET NOT NULL')
+        conn.execute('DROP TYPE service_state')
+
+
+@migration(4)
+def _v4_info_table(conn):
+    """ v4: info texts are stored once, in `service_state_infos`: states refer to them. They were stored with every state """
+    dialect = conn.dialect.name
+    if dialect not in ('mysql', 'postgresql', 'sqlite'):
+        raise SchemaVersionError('Migration to v4 does not support "{}"'.format(dialect))
+
+    models.ServiceStateInfo.__table__.create(bind=conn)
+    _add_column(conn, models.ServiceState.__table__.c.info_id, nullable=True, foreign_key=False)
+
+
+@migration(4, batches=models.ServiceState.__table__, batch_size=1000)
+def _v4_info_texts(conn, start, end):
+    """ v4: store every distinct text once, refer to it
+
+    The hashes are computed here, then the states are matched to the texts with a single statement:
+    by the hash computed in SQL (MySQL: `SHA1()`, SQLite: a function of our own), or by the text (PostgreSQL).
+    """
+    S, I = models.ServiceState.__table__, models.ServiceStateInfo.__table__
+    dialect = conn.dialect.name
+    hash_text = models.ServiceStateInfo.hash_text
+
+    # Texts: the new ones
+    info = literal_column('service_states.info', UnicodeText)
+    texts = OrderedDict(
+        (hash_text(info_text), info_text)
+        for id, info_text in conn.execute(select([S.c.id, info]).select_from(S).where(and_(S.c.id >= start, S.c.id < end)).order_by(S.c.id))
+    )
+    known = set()
+    hashes = texts.keys()
+    for i in range(0, len(hashes), 500):
+        known.update(row[0] for row in conn.execute(select([I.c.hash]).where(I.c.hash.in_(hashes[i:i + 500]))))
+    new = [{'hash': hash, 'text': info_text} for hash, info_text in texts.items() if hash not in known]
+    if new:
+        conn.execute(I.insert(), new)
+
+    # Refer to them
+    if dialect == 'mysql':
+        conn.execute(text(
+            'UPDATE service_states s JOIN service_state_infos i ON i.hash = SHA1(CONVERT(s.info USING utf8mb4)) '
+            'SET s.info_id = i.id '
+            'WHERE s.id >= :start AND s.id < :end'), start=start, end=end)
+    elif dialect == 'sqlite':
+        conn.connection.create_function('overc_sha1', 1, hash_text)
+        conn.execute(text(
+            'UPDATE service_states '
+            'SET info_id = (SELECT i.id FROM service_state_infos i WHERE i.hash = overc_sha1(service_states.info)) '
+            'WHERE id >= :start AND id < :end'), start=start, end=end)
+    else:
+        for i in range(0, len(hashes), 500):
+            conn.execute(S.update()
+                         .where(and_(S.c.id >= start, S.c.id < end, I.c.hash.in_(hashes[i:i + 500]), I.c.text == info))
+                         .values(info_id=I.c.id))
+
+    # Every state has its text
+    missing = conn.execute(select([func.count()]).select_from(S).where(and_(S.c.id >= start, S.c.id < end, S.c.info_id == None))).scalar()
+    if missing:
+        raise SchemaVersionError('Migration to v4: {} states in the ids {}..{} did not match their info texts'.format(missing, start, end - 1))
+
+
+@migration(4)
+def _v4_drop_texts(conn):
+    """ v4: not null, the foreign key, drop the texts. MySQL: a single table rebuild """
+    S = models.ServiceState.__table__
+    dialect = conn.dialect.name
+    if dialect == 'sqlite':
+        _sqlite_rebuild(conn, models.ServiceState, drop=('info',))
+    elif dialect == 'mysql':
+        conn.execute('ALTER TABLE service_states MODIFY info_id {} NOT NULL, ADD INDEX idx_info_id (info_id), '
+                     'ADD FOREIGN KEY (info_id) REFERENCES service_state_infos (id), DROP COLUMN info'.format(
+                         S.c.info_id.type.compile(dialect=conn.dialect)))
+    else:
+        conn.execute('ALTER TABLE service_states ALTER COLUMN info_id SET NOT NULL')
+        _create_indexes(conn, S, 'idx_info_id')
+        conn.execute(AddConstraint(next(iter(S.c.info_id.foreign_keys)).constraint))
+        conn.execute('ALTER TABLE service_states DROP COLUMN info')
+
+#endregion
@@ -0,0 +1,144 @@
+import zlib
+import gzip
+from cStringIO import StringIO
+
+from flask import request, current_app
+from werkzeug.utils import cached_property
+from werkzeug.wsgi import get_input_stream
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+
+#: Responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+#: The maximum decompressed size of request bodies, bytes: the default for the `GZIP_MAX_DECOMPRESSED_SIZE` config
+GZIP_MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+
+class GzipStream(object):
+    """ Read-only file-like object that decompresses a gzip stream on the fly
+
+    Memory use is bounded by `chunk_size` (plus the longest line, for readline())
+    """
+
+    def __init__(self, stream, max_size=None, chunk_size=16384):
+        """ Wrap a stream
+        :param stream: Compressed stream
+        :type stream: file
+        :param max_size: The maximum decompressed size, bytes
+        :type max_size: int|None
+        :param chunk_size: The size of chunks to read & decompress
+        :type chunk_size: int
+        :exception RequestEntityTooLarge: (when reading) decompressed data exceeds `max_size`
+        :exception BadRequest: (when reading) invalid compressed data
+        """
+        self._stream = stream
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip header
+        self._buffer = b''
+        self._eof = False
+        self._size = 0
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+
+    def _fill(self, size):
+        """ Decompress until the buffer has at least `size` bytes, or EOF """
+        while not self._eof and len(self._buffer) < size:
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._stream.read(self.chunk_size)
+            try:
+                if data:
+                    data = self._decompressor.decompress(data, self.chunk_size)
+                else:
+                    data = self._decompressor.flush()
+                    self._eof = True
+            except zlib.error as e:
+                raise BadRequest('Invalid gzip data: {}'.format(e))
+
+            # Limit
+            self._size += len(data)
+            if self.max_size is not None and self._size > self.max_size:
+                raise RequestEntityTooLarge()
+
+            self._buffer += data
+
+    def read(self, size=-1):
+        # Read all
+        if size is None or size < 0:
+            chunks = [self._buffer]
+            self._buffer = b''
+            while not self._eof:
+                self._fill(1)
+                chunks.append(self._buffer)
+                self._buffer = b''
+            return b''.join(chunks)
+
+        # Read some
+        self._fill(size)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while b'\n' not in self._buffer and not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill(len(self._buffer) + self.chunk_size)
+
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class GzipRequestMixin(object):
+    """ Request mixin: transparently decompress `Content-Encoding: gzip` bodies
+
+    The decompressed size is always limited, even when `max_content_length` is not set: a small compressed body
+    can expand to gigabytes. The limit is the `GZIP_MAX_DECOMPRESSED_SIZE` config, or `max_content_length`
+    if smaller. Larger bodies fail with `413 Request Entity Too Large`.
+    """
+
+    @property
+    def max_decompressed_size(self):
+        """ The maximum decompressed body size, bytes
+        :rtype: int
+        """
+        max_size = current_app.config.get('GZIP_MAX_DECOMPRESSED_SIZE') if current_app else None
+        max_size = int(max_size or GZIP_MAX_DECOMPRESSED_SIZE)
+        if self.max_content_length is not None:
+            max_size = min(max_size, self.max_content_length)
+        return max_size
+
+    @cached_property
+    def stream(self):
+        stream = get_input_stream(self.environ)
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            stream = GzipStream(stream, max_size=self.max_decompressed_size)
+        return stream
+
+
+def gzip_response(response):
+    """ Compress the response if the client accepts gzip
+    :param response: Response
+    :type response: flask.Response
+    :rtype: flask.Response
+    """
+    response.vary.add('Accept-Encoding')
+
+    # Acceptable?
+    if 'gzip' not in request.accept_encodings or 'Content-Encoding' in response.headers or response.direct_passthrough:
+        return response
+
+    # Worth it?
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+
+    # Compress
+    buf = StringIO()
+    with gzip.GzipFile(mode='wb', compresslevel=6, fileobj=buf) as f:
+        f.write(data)
+    response.set_data(buf.getvalue())
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -2,8 +2,10 @@ from functools import wraps
 from flask import request, jsonify, make_response
 from werkzeug.exceptions import HTTPException
 
+from .compress import gzip_response
+
 def json_response(res, code=200):
-    """ Make up a Response object from data
+    """ Make up a Response object from data, compressed if the client accepts it
     :param res: Response data
     :type res: *
     :param code: Response code
@@ -11,7 +13,7 @@ def json_response(res, code=200):
     :rtype: flask.Response
     """
     response = make_response(jsonify(res), code)
-    return response
+    return gzip_response(response)
 
 def jsonapi(f):
     """ Declare a view as JSON API method """
@@ -21,14 +23,17 @@ def jsonapi(f):
         try:
             res = f(*args, **kwargs)
         except HTTPException as e:
-            return json_response({'error': e.description}, e.code)
+            response = json_response({'error': e.description}, e.code)
+            if getattr(e, 'retry_after', None):
+                response.headers['Retry-After'] = str(e.retry_after)
+            return response
         except AssertionError as e:
             return json_response({ 'error': e.message }, 400)
 
         # Tuple response
         c = 200
         if isinstance(res, tuple):
-            result, c = res
+            res, c = res
 
         # Finish
         return json_response(res, c)
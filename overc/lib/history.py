@@ -0,0 +1,423 @@
+""" Service state history storage
+
+The SQL `service_states` table remains the working set: the supervisor, the alerts, the current state pointers
+and the rollups use it. A history backend stores the state history for the dashboard to read.
+
+* `SqlHistory`: the default, reads `service_states`;
+* `SegmentHistory`: a local append-only store. The ingestion appends the states it commits,
+  and `service_states` only needs to keep the recent ones: see `[rollup] downsample-after`.
+
+Ingestion collects the records in the session, and they are appended after the transaction commits:
+see `add_pending()`.
+"""
+
+import os
+import json
+import mmap
+import fcntl
+import errno
+import shutil
+import calendar
+from logging import getLogger
+from datetime import datetime
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+
+from overc.lib.db import models
+
+logger = getLogger(__name__)
+
+
+#region Records
+
+def _timestamp(dt):
+    """ Convert a naive UTC datetime to a UNIX timestamp
+    :type dt: datetime
+    :rtype: float
+    """
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+class HistoryState(object):
+    """ A service state read from the history: mimics `models.ServiceState` """
+
+    def __init__(self, id, service_id, rtime, state, info, repeat_count=0, last_seen=None):
+        self.id = id
+        self.service_id = service_id
+        self.rtime = rtime
+        self.last_seen = last_seen
+        self.repeat_count = repeat_count
+        self.state = state
+        self.info = info
+        self.alerts = []
+
+    @property
+    def seen(self):
+        """ Get the last time the state was seen
+        :rtype: datetime
+        """
+        return self.last_seen or self.rtime
+
+    def __repr__(self):
+        return '<HistoryState #{} service={}: {}>'.format(self.id, self.service_id, self.state.name)
+
+
+def state_record(id, service_id, rtime, state, info, repeat_count=0):
+    """ Make a history record: a new state
+    :rtype: dict
+    """
+    return {'type': 'state', 'id': id, 'service_id': service_id, 'rtime': _timestamp(rtime),
+            'state': int(state), 'info': info, 'repeat_count': repeat_count}
+
+
+def seen_record(id, service_id, last_seen, repeats):
+    """ Make a history record: a state seen again (change-only storage)
+    :rtype: dict
+    """
+    return {'type': 'seen', 'id': id, 'service_id': service_id, 'last_seen': _timestamp(last_seen), 'repeats': repeats}
+
+#endregion
+
+
+#region Pending records
+
+#: Session.info key: the backend
+INFO_BACKEND = 'history'
+#: Session.info key: the records to append once the transaction commits
+INFO_PENDING = 'history_pending'
+
+
+def add_pending(ssn, records):
+    """ Append records to the history once the session commits. See wants_records()
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param records: History records: see state_record(), seen_record()
+    :type records: list[dict]
+    """
+    if records:
+        ssn.info.setdefault(INFO_PENDING, []).extend(records)
+
+
+def pending_mark(ssn):
+    """ Mark the pending records: see discard_pending()
+    :rtype: int
+    """
+    return len(ssn.info.get(INFO_PENDING, ()))
+
+
+def discard_pending(ssn, mark):
+    """ Discard the records added after the mark, e.g. when rolling back to a savepoint
+    :param mark: The mark: see pending_mark()
+    :type mark: int
+    """
+    del ssn.info.get(INFO_PENDING, [])[mark:]
+
+
+def wants_records(ssn):
+    """ Does the session's history backend need records?
+    :rtype: bool
+    """
+    backend = ssn.info.get(INFO_BACKEND)
+    return backend is not None and backend.appends
+
+
+@event.listens_for(Session, 'after_commit')
+def _append_pending(ssn):
+    # Savepoints are committed as well: only the outermost transaction counts
+    if ssn.transaction._parent is not None:
+        return
+    records = ssn.info.pop(INFO_PENDING, None)
+    if records:
+        try:
+            ssn.info[INFO_BACKEND].append(records)
+        except Exception:
+            # The states are committed already: the history gets a gap, the request does not fail
+            logger.exception('Failed to append {} records to the history'.format(len(records)))
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_pending(ssn, transaction):
+    # Not committed: rolled back, or closed
+    if transaction._parent is None:
+        ssn.info.pop(INFO_PENDING, None)
+
+#endregion
+
+
+#region Backends
+
+class HistoryBackend(object):
+    """ State history storage backend """
+
+    #: Whether the ingestion should append records
+    appends = False
+
+    def append(self, records):
+        """ Append records to the history
+        :param records: History records: see state_record(), seen_record()
+        :type records: list[dict]
+        """
+        raise NotImplementedError()
+
+    def read(self, ssn, service_id, since):
+        """ Read the states of a service since the given time, alerts loaded
+
+        Includes the state which was current at `since` if it was still seen after that.
+
+        :param ssn: Database session: for the alerts
+        :type ssn: sqlalchemy.orm.session.Session
+        :param service_id: Service id
+        :type service_id: int
+        :param since: Period start
+        :type since: datetime
+        :return: States, newest first
+        :rtype: list[models.ServiceState|HistoryState]
+        """
+        raise NotImplementedError()
+
+    def prune(self, cutoff):
+        """ Delete the history older than the cutoff time
+        :param cutoff: Delete history older than this
+        :type cutoff: datetime
+        :returns: The number of items deleted
+        :rtype: int
+        """
+        raise NotImplementedError()
+
+
+class SqlHistory(HistoryBackend):
+    """ History in the SQL `service_states` table """
+
+    def append(self, records):
+        pass
+
+    def read(self, ssn, service_id, since):
+        S = models.ServiceState
+        states = ssn.query(S) \
+            .options(joinedload(S.alerts)) \
+            .filter(S.rtime >= since, S.service_id == service_id) \
+            .order_by(S.id.desc()) \
+            .all()
+
+        # The state which was current when the period started: still seen within it if repeated reports were merged
+        prev_state = ssn.query(S) \
+            .options(joinedload(S.alerts)) \
+            .filter(S.rtime < since, S.service_id == service_id) \
+            .order_by(S.id.desc()) \
+            .first()
+        if prev_state is not None and prev_state.last_seen is not None and prev_state.last_seen >= since:
+            states.append(prev_state)
+        return states
+
+    def prune(self, cutoff):
+        # See retention.prune_service_states()
+        return 0
+
+
+class SegmentHistory(HistoryBackend):
+    """ Local append-only history: segment files
+
+    Every time window gets a segment: `<start>.seg`, JSON records, one per line, in the order of appending.
+    Its index is a directory, `<start>.idx/`, with a file per service: `<service id>`,
+    a line per record: "<s|r> <offset>", 's' for states and 'r' for repeats.
+
+    Appends are sequential writes under an exclusive lock, and the data goes first: readers do not lock,
+    and never see an index entry before its record. A service history read looks up the segments that cover the period,
+    and only reads the service's index files and records.
+    """
+
+    appends = True
+
+    def __init__(self, path, window=86400, use_mmap=True):
+        """ Init the storage
+        :param path: Directory for the segments. Created if missing
+        :type path: str
+        :param window: Segment time window, seconds
+        :type window: int
+        :param use_mmap: Memory-map segments for reading
+        :type use_mmap: bool
+        """
+        self.path = path
+        self.window = int(window)
+        self.use_mmap = use_mmap
+        assert self.window > 0, 'History segment window should be positive'
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _segment_start(self, timestamp):
+        return int(timestamp) // self.window * self.window
+
+    def _filename(self, start, ext):
+        return os.path.join(self.path, '{:%Y%m%dT%H%M%S}{}'.format(datetime.utcfromtimestamp(start), ext))
+
+    def segments(self):
+        """ List the segments
+        :return: Segment start timestamps, ascending
+        :rtype: list[int]
+        """
+        return sorted(
+            calendar.timegm(datetime.strptime(name[:-4], '%Y%m%dT%H%M%S').utctimetuple())
+            for name in os.listdir(self.path)
+            if name.endswith('.seg')
+        )
+
+    def append(self, records):
+        # Group by segment: states by their time, repeats by the time they were seen
+        segments = defaultdict(list)
+        for record in records:
+            segments[self._segment_start(record['rtime'] if record['type'] == 'state' else record['last_seen'])].append(record)
+
+        for start in sorted(segments):
+            index_path = self._filename(start, '.idx')
+            with open(self._filename(start, '.seg'), 'ab') as data:
+                fcntl.flock(data.fileno(), fcntl.LOCK_EX)
+                try:
+                    data.seek(0, os.SEEK_END)
+                    offset = data.tell()
+                    lines, entries = [], defaultdict(list)
+                    for record in segments[start]:
+                        line = json.dumps(record, separators=(',', ':')) + '\n'
+                        lines.append(line)
+                        entries[record['service_id']].append('{} {}\n'.format('s' if record['type'] == 'state' else 'r', offset))
+                        offset += len(line)
+                    data.write(''.join(lines))
+                    data.flush()
+
+                    try:
+                        os.mkdir(index_path)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                    for service_id in sorted(entries):
+                        with open(os.path.join(index_path, str(service_id)), 'ab') as index:
+                            index.write(''.join(entries[service_id]))
+                finally:
+                    fcntl.flock(data.fileno(), fcntl.LOCK_UN)
+
+    def _index(self, start, service_id):
+        """ Read a segment index: the service's entries
+        :return: [ (type, offset), ... ]
+        :rtype: list[(str, int)]
+        """
+        try:
+            with open(os.path.join(self._filename(start, '.idx'), str(service_id)), 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        data = data[:data.rfind('\n') + 1]  # the last line is incomplete, if at all
+        return [(type, int(offset)) for type, offset in (line.split(' ') for line in data.splitlines())]
+
+    def _read_records(self, start, offsets):
+        """ Read records from a segment
+        :param offsets: Record offsets, ascending
+        :type offsets: list[int]
+        :rtype: list[dict]
+        """
+        with open(self._filename(start, '.seg'), 'rb') as f:
+            if self.use_mmap:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return [json.loads(m[offset:m.find('\n', offset)]) for offset in offsets]
+                finally:
+                    m.close()
+            records = []
+            for offset in offsets:
+                f.seek(offset)
+                records.append(json.loads(f.readline()))
+            return records
+
+    def read(self, ssn, service_id, since):
+        since_ts = _timestamp(since)
+        segments = self.segments()
+
+        # Read the segments that cover the period
+        first = max([i for i, start in enumerate(segments) if start <= since_ts] or [0])
+        chunks = []  # [ [record, ...], ... ], segments in descending order
+        for start in reversed(segments[first:]):
+            index = self._index(start, service_id)
+            chunks.append(self._read_records(start, [offset for type, offset in index]) if index else [])
+
+        # The state current when the period started is only wanted if it was seen during the period:
+        # then, the period has its repeats. Go back to its segment: its other repeats are in between
+        loaded = set(r['id'] for records in chunks for r in records if r['type'] == 'state')
+        wanted = max([r['id'] for records in chunks for r in records
+                      if r['type'] == 'seen' and r['last_seen'] >= since_ts and r['id'] not in loaded] or [None])
+        for start in reversed(segments[:first]) if wanted is not None else ():
+            index = self._index(start, service_id)
+            records = self._read_records(start, [offset for type, offset in index]) if index else []
+            chunks.append(records)
+            if any(r['type'] == 'state' and r['id'] <= wanted for r in records):
+                break
+
+        # Fold the repeats into the states
+        states = OrderedDict()
+        for records in reversed(chunks):
+            for r in records:
+                if r['type'] == 'state':
+                    states[r['id']] = HistoryState(
+                        r['id'], r['service_id'], datetime.utcfromtimestamp(r['rtime']),
+                        models.state_t(r['state']), r['info'], r['repeat_count'])
+                elif r['id'] in states:
+                    state = states[r['id']]
+                    state.last_seen = max(state.seen, datetime.utcfromtimestamp(r['last_seen']))
+                    state.repeat_count += r['repeats']
+
+        # The period, and the state current when it started
+        states = states.values()
+        result = [s for s in states if s.rtime >= since]
+        prev_state = next((s for s in reversed(states) if s.rtime < since), None)
+        if prev_state is not None and prev_state.last_seen is not None and prev_state.last_seen >= since:
+            result.insert(0, prev_state)
+        result.reverse()
+
+        # Alerts: they're raised after the state is received
+        if result:
+            A = models.Alert
+            states = {s.id: s for s in result}
+            for alert in ssn.query(A).filter(
+                A.service_id == service_id,
+                A.ctime >= min(s.rtime for s in result),
+                A.service_state_id >= min(states)
+            ).order_by(A.id.desc()):
+                if alert.service_state_id in states:
+                    states[alert.service_state_id].alerts.append(alert)
+        return result
+
+    def prune(self, cutoff):
+        cutoff_ts = _timestamp(cutoff)
+        n = 0
+        for start in self.segments():
+            if start + self.window > cutoff_ts:
+                break
+            shutil.rmtree(self._filename(start, '.idx'), ignore_errors=True)
+            try:
+                os.unlink(self._filename(start, '.seg'))
+            except OSError:
+                pass
+            n += 1
+        return n
+
+
+def init_history(config):
+    """ Init the history backend from the application config
+    :param config: Application config: HISTORY_BACKEND, HISTORY_PATH, HISTORY_SEGMENT_HOURS, HISTORY_MMAP
+    :type config: dict
+    :rtype: HistoryBackend
+    """
+    backend = config.get('HISTORY_BACKEND') or 'sql'
+    if backend == 'sql':
+        return SqlHistory()
+    elif backend == 'segments':
+        assert config.get('HISTORY_PATH'), 'Config: history.path is required for the "segments" backend'
+        return SegmentHistory(
+            config['HISTORY_PATH'],
+            int(float(config.get('HISTORY_SEGMENT_HOURS', 24)) * 3600),
+            bool(config.get('HISTORY_MMAP', True))
+        )
+    raise AssertionError('Config: history.backend should be either "sql" or "segments"')
+
+#endregion
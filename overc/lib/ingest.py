@@ -0,0 +1,718 @@
+from datetime import datetime, timedelta
+from logging import getLogger
+from collections import OrderedDict, defaultdict
+
+from werkzeug.exceptions import Forbidden
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql.expression import func, bindparam, or_, case, literal_column
+
+from overc.lib.db import models
+from overc.lib.db.bulk import insert_ignore
+from overc.lib import history
+
+logger = getLogger(__name__)
+
+
+def options(config):
+    """ Get ingestion options from the application config
+    :param config: Application config
+    :type config: dict
+    :return: Keyword arguments for set_service_status(), set_report()
+    :rtype: dict
+    """
+    return {
+        'changes_only': config.get('STATE_STORAGE', 'full') == 'changes',
+    }
+
+
+#region Validation
+
+def validate_ping(data):
+    """ Validate input: /api/ping
+    :param data: Input data
+    :type data: dict
+    :exception AssertionError: Validation error
+    """
+    assert isinstance(data, dict), 'Invalid data: should be JSON object'
+    assert 'server' in data, 'Data: "server" key is missing'
+
+
+def validate_service_status(data):
+    """ Validate input: /api/set/service/status
+    :param data: Input data. Modified in-place: `period` is converted to int
+    :type data: dict
+    :exception AssertionError: Validation error
+    """
+    assert isinstance(data, dict), 'Invalid data: should be JSON object'
+    assert 'server' in data, 'Data: "server" key is missing'
+    assert 'period' in data, 'Data: "period" key is missing'
+    assert 'services' in data, 'Data: "services" key is missing'
+
+    # Input validation: period
+    try:
+        data['period'] = int(data['period'])
+    except ValueError:
+        raise AssertionError('Data: "period" should be an integer')
+
+    # Input validation: services
+    assert isinstance(data['services'], list), 'Data: "services" should be a list'
+    assert all(
+        isinstance(s, dict) and
+        'name' in s and isinstance(s['name'], basestring) and
+        'state' in s and isinstance(s['state'], basestring) and
+        ('info' not in s or isinstance(s['info'], basestring))
+        for s in data['services']
+    ), 'Data: "services" should be a list of objects with keys "name", "state", "info"?, "period"?'
+
+
+def validate_alerts(data):
+    """ Validate input: /api/set/alerts
+    :param data: Input data
+    :type data: dict
+    :exception AssertionError: Validation error
+    """
+    assert isinstance(data, dict), 'Invalid data: should be JSON object'
+    assert 'server' in data, 'Data: "server" key is missing'
+    assert 'alerts' in data, 'Data: "alerts" key is missing'
+
+    # Input validation: alerts
+    assert isinstance(data['alerts'], list), 'Data: "alerts" should be a list'
+    assert all(
+        isinstance(s, dict) and
+        'message' in s and isinstance(s['message'], basestring) and
+        ('service' not in s or isinstance(s['service'], basestring)) and
+        set(s.keys()) <= {'title', 'message', 'service'}
+        for s in data['alerts']
+    ), 'Data: "alerts" should be a list of objects with keys "title", "message"?, "service"?'
+
+
+def validate_report(data):
+    """ Validate input: a single report of a batch: {server, period?, services?, alerts?}
+    :param data: Input data. Modified in-place: `period` is converted to int
+    :type data: dict
+    :exception AssertionError: Validation error
+    """
+    assert isinstance(data, dict), 'Invalid data: should be JSON object'
+    assert 'services' in data or 'alerts' in data, 'Data: either "services" or "alerts" key is required'
+
+    if 'services' in data:
+        validate_service_status(data)
+    if 'alerts' in data:
+        validate_alerts(data)
+
+
+def validate_server_spec(server_spec):
+    """ Validate input: server identification
+    :param server_spec: Server identification dictionary: {name: String, key: String}
+    :type server_spec: dict
+    :exception AssertionError: Validation error
+    """
+    assert isinstance(server_spec, dict), 'Data: "server" should be a dict'
+    assert 'name' in server_spec and isinstance(server_spec['name'], basestring), 'Data: "server.name" should be a string'
+    assert 'key'  in server_spec and isinstance(server_spec['key'],  basestring), 'Data: "server.key" should be a string'
+
+#endregion
+
+
+#region Identification
+
+#: Session.info key: servers identified within the transaction: [ (cache, name, Server, key, ip) ]
+INFO_SERVER_CACHE = 'server_cache_pending'
+
+
+@event.listens_for(Session, 'after_commit')
+def _cache_servers(ssn):
+    # Savepoints are committed as well: only the outermost transaction counts
+    if ssn.transaction._parent is not None:
+        return
+    for cache, name, server, key, ip in ssn.info.pop(INFO_SERVER_CACHE, ()):
+        # A new server rolled back to a savepoint has no identity
+        identity = inspect(server).identity
+        if identity is not None:
+            cache.set(name, (identity[0], key, ip))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_servers(ssn):
+    # A stale cached identity might be the reason, e.g. a server deleted by another process.
+    # Forget them, so the next report checks the database
+    for cache, name, server, key, ip in ssn.info.pop(INFO_SERVER_CACHE, ()):
+        cache.pop(name)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_servers(ssn, transaction):
+    if transaction._parent is None:
+        ssn.info.pop(INFO_SERVER_CACHE, None)
+
+
+def check_server_key_cached(server_cache, server_spec):
+    """ Check the server key against the cache only
+    :param server_cache: Server identity cache: { name: (id, key, ip) }
+    :type server_cache: overc.lib.cache.TTLCache
+    :param server_spec: Server identification dictionary: {name: String, key: String}
+    :type server_spec: dict
+    :returns: Whether the server is known to the cache
+    :rtype: bool
+    :exception AssertionError: Validation error
+    :exception Forbidden: Invalid server key
+    """
+    validate_server_spec(server_spec)
+
+    cached = server_cache.get(server_spec['name'])
+    if cached is None:
+        return False
+
+    if cached[1] != server_spec['key']:
+        logger.warning(u'Invalid server key supplied: name="{name}", key="{key}"'.format(**server_spec))
+        raise Forbidden('Invalid server key')
+    return True
+
+
+def identify_server(ssn, server_spec, remote_addr, server_cache, identified=None):
+    """ Identity the server, create if missing
+
+    Known servers are authenticated against `server_cache` and are not loaded from the DB.
+    New and updated servers are cached once the session commits. When the transaction is rolled back,
+    the server is removed from the cache: the cache is local to the process, and another process
+    might have deleted the server.
+
+    When a transaction handles multiple reports, use `identified` so the same server is not created twice.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param server_spec: Server identification dictionary: {name: String, key: String}
+    :type server_spec: dict
+    :param remote_addr: Remote IP address of the server
+    :type remote_addr: str|None
+    :param server_cache: Server identity cache: { name: (id, key, ip) }
+    :type server_cache: overc.lib.cache.TTLCache
+    :param identified: Servers already identified within this transaction: { name: Server }. Updated in-place.
+    :type identified: dict|None
+    :rtype: models.Server
+    :exception AssertionError: Validation error
+    :exception Forbidden: Invalid server key
+    """
+    # Input validation: server
+    validate_server_spec(server_spec)
+
+    # Already identified within this transaction?
+    if identified is not None and server_spec['name'] in identified:
+        server = identified[server_spec['name']]
+        if server.key != server_spec['key']:
+            logger.warning(u'Invalid server key supplied: name="{name}", key="{key}"'.format(**server_spec))
+            raise Forbidden('Invalid server key')
+        return server
+
+    # Known server? Authenticate from the cache
+    cached = server_cache.get(server_spec['name'])
+    if cached is not None:
+        server_id, server_key, server_ip = cached
+        if server_key != server_spec['key']:
+            logger.warning(u'Invalid server key supplied: name="{name}", key="{key}"'.format(**server_spec))
+            raise Forbidden('Invalid server key')
+
+        # Already in the session? Otherwise, attach as a persistent object: no SELECT
+        server = ssn.identity_map.get(ssn.identity_key(models.Server, server_id))
+        if server is None:
+            server = models.Server(id=server_id, name=server_spec['name'], key=server_key, ip=server_ip)
+            make_transient_to_detached(server)
+            ssn.add(server)
+    else:
+        # Identify server or create
+        server = ssn.query(models.Server).filter(models.Server.name == server_spec['name']).first()
+        if server is not None:
+            # Check key
+            key_ok = server.key != server_spec['key']
+            if key_ok:
+                logger.warning(u'Invalid server key supplied: name="{name}", key="{key}"'.format(**server_spec))
+                raise Forbidden('Invalid server key')
+        else:
+            # Create
+            server = models.Server(
+                name=server_spec['name'],
+                title=unicode(server_spec['name']),
+                key=server_spec['key']
+            )
+            ssn.add(server)
+            logger.info(u'Created new Server(name="{name}")'.format(**server_spec))
+
+    # Update IP: only when changed, so steady-state reports do not UPDATE the server
+    if server.ip != remote_addr:
+        server.ip = remote_addr
+
+    # Remember: a server loaded from the DB right away, a new or updated one once committed
+    if server.id is not None and cached is None and not ssn.is_modified(server):
+        server_cache.set(server.name, (server.id, server.key, server.ip))
+    ssn.info.setdefault(INFO_SERVER_CACHE, []).append((server_cache, server_spec['name'], server, server_spec['key'], remote_addr))
+
+    # Finish
+    if identified is not None:
+        identified[server.name] = server
+    logger.debug(u'Identified server by name="{name}", id={id}'.format(id=server.id or '<new server>', **server_spec))
+    return server
+
+
+def _match_service_names(names, services):
+    """ Match the requested service names to the services found by them
+
+    The database might have matched a name that differs from the stored one: MySQL collations are case-insensitive,
+    and ignore trailing spaces. An exact match is preferred.
+
+    :param names: Requested service names
+    :type names: list[str]
+    :param services: Services found by the names
+    :type services: collections.Iterable[models.Service]
+    :return: Services: { requested name: Service }
+    :rtype: dict[str, models.Service]
+    """
+    collate = lambda name: name.rstrip(' ').lower()
+    services = list(services)
+    exact = {service.name: service for service in services}
+    loose = {collate(service.name): service for service in services}
+
+    matched = {}
+    for name in names:
+        service = exact.get(name) or loose.get(collate(name))
+        if service is not None:
+            matched[name] = service
+    return matched
+
+
+def identify_services(ssn, server, service_names):
+    """ Identify services by name, create the missing ones
+
+    The whole batch is resolved with a single `IN (...)` lookup, and the missing services
+    are created with a single bulk insert.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param server: Server to lookup the services at
+    :type server: models.Server
+    :param service_names: Service names on the server (may contain duplicates)
+    :type service_names: list[str]
+    :return: Services, by the requested names: { name: Service }
+    :rtype: dict[str, models.Service]
+    """
+    service_names = list(OrderedDict.fromkeys(service_names))  # unique, in the reported order
+    if not service_names:
+        return {}
+
+    # New server needs an id
+    if server.id is None:
+        ssn.flush()
+
+    # Lookup
+    services = _match_service_names(service_names, ssn.query(models.Service).filter(
+        models.Service.server_id == server.id,
+        models.Service.name.in_(service_names)
+    ))
+
+    # Create the missing ones
+    missing = [name for name in service_names if name not in services]
+    if missing:
+        # Concurrent reports from the same server might be creating them right now:
+        # ignore the duplicates, and use a locking read to see the rows committed by others
+        insert_ignore(ssn, models.Service.__table__, [
+            {'server_id': server.id, 'name': name, 'title': unicode(name)}
+            for name in missing
+        ])
+        services.update(_match_service_names(missing, ssn.query(models.Service).filter(
+            models.Service.server_id == server.id,
+            models.Service.name.in_(missing)
+        ).with_for_update(read=True)))
+        for name in missing:
+            logger.info(u'Created new Service(name="{name}", server="{server}")'.format(name=name, server=server.name))
+    return services
+
+def identify_infos(ssn, texts):
+    """ Identify service info texts by hash, store the missing ones
+
+    Info texts rarely change between reports: every distinct text is stored once, and states refer to it.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param texts: Info texts (may contain duplicates)
+    :type texts: list[unicode]
+    :return: Info ids: { text: id }
+    :rtype: dict[unicode, int]
+    """
+    hashes = {models.ServiceStateInfo.hash_text(text): text for text in texts}
+    if not hashes:
+        return {}
+
+    # Lookup. Not a locking read: on MySQL, it would lock the gaps of the missing hashes,
+    # and concurrent reports storing new texts would deadlock on their inserts
+    I = models.ServiceStateInfo
+    ids = {
+        hashes[hash]: id
+        for id, hash in ssn.query(I.id, I.hash).filter(I.hash.in_(hashes.keys()))
+    }
+
+    # Store the missing ones. Concurrent reports might be storing them right now: ignore the duplicates,
+    # and use a locking read to see the rows committed by others. They all exist by then: no gaps are locked
+    missing = [hash for hash, text in hashes.items() if text not in ids]
+    if missing:
+        insert_ignore(ssn, I.__table__, [{'hash': hash, 'text': hashes[hash]} for hash in missing])
+        ids.update(
+            (hashes[hash], id)
+            for id, hash in ssn.query(I.id, I.hash).filter(I.hash.in_(missing)).with_for_update(read=True)
+        )
+    return ids
+
+#endregion
+
+
+#region Ingestion
+
+def set_service_status(ssn, server, data, changes_only=False):
+    """ Store services' status reported by a server. Does not commit.
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param server: The reporting server
+    :type server: models.Server
+    :param data: Validated input: {period, services}
+    :type data: dict
+    :param changes_only: Change-only storage: see insert_service_states()
+    :type changes_only: bool
+    """
+    # Services
+    services = identify_services(ssn, server, [s['name'] for s in data['services']])
+    for s in data['services']:
+        service = services[s['name']]
+
+        # Update period
+        try:
+            service_period = int(s['period'])
+        except (KeyError, ValueError):
+            service_period = data['period']
+
+        if service.period != service_period:
+            service.period = service_period
+
+    # States
+    insert_service_states(ssn, server, services, data['services'], changes_only)
+
+
+def _current_states(ssn, services):
+    """ Load the current states of services, by their `current_state_id` pointers
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param services: Services
+    :type services: list[models.Service]
+    :return: { service_id: {id, state, info_id} }
+    :rtype: dict
+    """
+    state_ids = [service.current_state_id for service in services if service.current_state_id is not None]
+    if not state_ids:
+        return {}
+    return {
+        service_id: {'id': id, 'state': state, 'info_id': info_id}
+        for id, service_id, state, info_id in
+        ssn.query(models.ServiceState.id, models.ServiceState.service_id, models.ServiceState.state, models.ServiceState.info_id)
+            .filter(models.ServiceState.id.in_(state_ids))
+    }
+
+
+def _latest_states(ssn, services, rtime):
+    """ Find the latest states of services, inserted at `rtime`
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param services: Services that have got new states
+    :type services: list[models.Service]
+    :param rtime: Received time of the new states
+    :type rtime: datetime
+    :return: The new states: [ (id, service_id, state, rtime), ... ]
+    :rtype: list[tuple]
+    """
+    # Ids of the new states: a range scan over (service_id, rtime).
+    # Allow for DBs that round the time to seconds
+    latest = ssn.query(func.max(models.ServiceState.id).label('id')) \
+        .filter(
+            models.ServiceState.service_id.in_([service.id for service in services]),
+            models.ServiceState.rtime >= rtime - timedelta(seconds=1)
+        ) \
+        .group_by(models.ServiceState.service_id) \
+        .subquery()
+    return ssn.query(models.ServiceState.id, models.ServiceState.service_id, models.ServiceState.state, models.ServiceState.rtime) \
+        .join(latest, latest.c.id == models.ServiceState.id) \
+        .all()
+
+
+#: Rows per multi-row INSERT: keeps the statements below the parameter limits
+INSERT_CHUNK_SIZE = 1000
+
+
+def _insert_states(ssn, services, rows, rtime):
+    """ Insert new states, and get their ids back from the insert
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param services: Services that have got new states: { id: Service }
+    :type services: dict[int, models.Service]
+    :param rows: New state rows, at most one per service
+    :type rows: list[dict]
+    :param rtime: Received time of the new states
+    :type rtime: datetime
+    :return: The new states: [ (id, service_id, state, rtime), ... ]
+    :rtype: list[tuple]
+    """
+    table = models.ServiceState.__table__
+    dialect = ssn.get_bind().dialect.name
+
+    # SQLite: a single writer, so the rows get consecutive ids, up to the last inserted one
+    if dialect == 'sqlite':
+        ssn.execute(table.insert(), rows)
+        last_id = ssn.execute('SELECT last_insert_rowid()').scalar()
+        return [(last_id - len(rows) + 1 + i, row['service_id'], row['state'], rtime) for i, row in enumerate(rows)]
+
+    new_states = []
+    for n in range(0, len(rows), INSERT_CHUNK_SIZE):
+        chunk = rows[n:n + INSERT_CHUNK_SIZE]
+        # PostgreSQL: the ids are returned
+        if dialect == 'postgresql':
+            ids = dict((service_id, id) for id, service_id in ssn.execute(
+                table.insert().values(chunk).returning(table.c.id, table.c.service_id)
+            ))
+            new_states.extend((ids[row['service_id']], row['service_id'], row['state'], rtime) for row in chunk)
+        # MySQL: a multi-row INSERT gets consecutive ids, starting with LAST_INSERT_ID()
+        elif dialect == 'mysql':
+            first_id = ssn.execute(table.insert().values(chunk)).lastrowid
+            step = _auto_increment_step(ssn)
+            new_states.extend((first_id + i * step, row['service_id'], row['state'], rtime) for i, row in enumerate(chunk))
+        # Others: look the ids up
+        else:
+            ssn.execute(table.insert(), chunk)
+            new_states.extend(_latest_states(ssn, [services[row['service_id']] for row in chunk], rtime))
+    return new_states
+
+
+def _auto_increment_step(ssn):
+    """ Get the MySQL auto-increment step of the session's connection: it's not 1 on multi-master setups
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :rtype: int
+    """
+    info = ssn.connection().info
+    if 'auto_increment_increment' not in info:
+        info['auto_increment_increment'] = ssn.execute('SELECT @@auto_increment_increment').scalar()
+    return info['auto_increment_increment']
+
+
+def _int_case(column, values):
+    """ CASE column WHEN key THEN value ... END, for integer keys & values
+    The integers are inlined: a report can have more services than SQLite allows parameters.
+    :param column: The column to switch on
+    :type column: sqlalchemy.Column
+    :param values: { key: value }
+    :type values: dict[int, int]
+    :rtype: sqlalchemy.sql.expression.Case
+    """
+    return case([(literal_column(str(int(k))), literal_column(str(int(v)))) for k, v in values.items()], value=column)
+
+
+def _update_current_states(ssn, services, states):
+    """ Point services to their new states, with a single UPDATE
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param services: Services that have got new states: { id: Service }
+    :type services: dict[int, models.Service]
+    :param states: The new states, all received at the same time: [ (id, service_id, state, rtime), ... ]
+    :type states: list[tuple]
+    """
+    # Update: never move the pointer back, in case a concurrent report is newer
+    table = models.Service.__table__
+    state_ids = _int_case(table.c.id, {service_id: id for id, service_id, state, rtime in states})
+    ssn.execute(
+        table.update()
+            .where(table.c.id.in_([literal_column(str(int(service_id))) for id, service_id, state, rtime in states]))
+            .where(or_(table.c.current_state_id == None, table.c.current_state_id <= state_ids))
+            .values(
+                current_state_id=state_ids,
+                current_state=_int_case(table.c.id, {service_id: state for id, service_id, state, rtime in states}),
+                current_rtime=states[0][3]
+            )
+    )
+
+    # Sync the loaded objects, without making them dirty
+    for id, service_id, state, rtime in states:
+        service = services[service_id]
+        set_committed_value(service, 'current_state_id', id)
+        set_committed_value(service, 'current_state', state)
+        set_committed_value(service, 'current_rtime', rtime)
+        ssn.expire(service, ['state'])
+
+
+def insert_service_states(ssn, server, services, states, changes_only=False):
+    """ Insert service states with a single multi-row INSERT
+
+    Bypasses the ORM unit-of-work: with hundreds of services per report, building & flushing
+    individual `ServiceState` objects is the main ingestion cost.
+    A single state is a plain ORM insert, though.
+    The new ids come back from the insert, and the services are pointed to their new states with a single UPDATE.
+
+    Every new state records its predecessor: `prev_id`, `prev_state`.
+    Info texts are stored once, and are referred to by id: see identify_infos().
+
+    In change-only storage mode, a state identical to the current one (same state and info)
+    is not inserted: the current state's `last_seen` and `repeat_count` are updated instead.
+
+    When the history backend appends, the records are appended once the session commits: see `overc.lib.history`.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param server: The reporting server
+    :type server: models.Server
+    :param services: Identified services: { name: Service }
+    :type services: dict[str, models.Service]
+    :param states: Reported states: [ {name, state, info}, ... ]
+    :type states: list[dict]
+    :param changes_only: Change-only storage: merge repeated states
+    :type changes_only: bool
+    :returns: The number of states inserted
+    :rtype: int
+    """
+    rtime = datetime.utcnow()
+    table = models.ServiceState.__table__
+
+    # Current states: { service_id: row }. Rows loaded from the DB have an 'id'.
+    current = _current_states(ssn, services.values()) if changes_only else {}
+
+    # State
+    for s in states:
+        if not models.state_t.is_valid(s['state']):
+            s['info'] = s.get('info', u'') + u' (sent unsupported state: "{}")'.format(s['state'])
+            s['state'] = 'UNK'
+        s['info'] = unicode(s.get('info', u''))
+
+    # Info
+    info_ids = identify_infos(ssn, [s['info'] for s in states])
+
+    generations = []  # [ [row, ...], ... ]: a service has at most one row per generation
+    repeats = defaultdict(int)  # { state id: number of repeats }
+    repeated = {}  # { state id: service_id }
+    for s in states:
+        service_id = services[s['name']].id
+        state = models.state_t(s['state'])
+        info, info_id = s['info'], info_ids[s['info']]
+
+        # Repeated state?
+        cur = current.get(service_id)
+        if changes_only and cur is not None and cur['state'] == state and cur['info_id'] == info_id:
+            if 'id' in cur:
+                repeats[cur['id']] += 1
+                repeated[cur['id']] = service_id
+            else:
+                cur['repeat_count'] += 1
+            logger.debug(u'Service {server}:`{name}` state repeated: {state}'.format(server=server.name, name=s['name'], state=s['state']))
+            continue
+
+        # New state
+        row = {
+            'service_id': service_id,
+            'checked': False,
+            'rtime': rtime,
+            'last_seen': rtime,
+            'repeat_count': 0,
+            'state': state,
+            'info_id': info_id,
+        }
+        generation = next((rows for rows in generations if service_id not in rows), None)
+        if generation is None:
+            generation = OrderedDict()
+            generations.append(generation)
+        generation[service_id] = row
+        current[service_id] = row
+        logger.debug(u'Service {server}:`{name}` state update: {state}: {info}'.format(server=server.name, name=s['name'], state=s['state'], info=info))
+
+    # Insert: multi-row INSERTs, which give the new ids back.
+    # A service reported more than once gets its states inserted in generations, so each one can point to its predecessor.
+    services = {service.id: service for service in services.values()}
+    records = [] if history.wants_records(ssn) else None
+    infos = {info_id: info for info, info_id in info_ids.items()}
+    for generation in generations:
+        for service_id, row in generation.items():
+            row['prev_id'] = services[service_id].current_state_id
+            row['prev_state'] = services[service_id].current_state
+        if len(generations) == 1 and len(generation) == 1:
+            service_id, row = generation.items()[0]
+            state = models.ServiceState(**row)
+            ssn.add(state)
+            ssn.flush()
+            new_states = [(state.id, service_id, state.state, rtime)]
+        else:
+            new_states = _insert_states(ssn, services, generation.values(), rtime)
+        _update_current_states(ssn, services, new_states)
+
+        # History
+        if records is not None:
+            ids = {service_id: id for id, service_id, state, state_rtime in new_states}
+            records.extend(
+                history.state_record(ids[service_id], service_id, rtime, row['state'], infos[row['info_id']], row['repeat_count'])
+                for service_id, row in generation.items()
+            )
+
+    # Repeats
+    if repeats:
+        ssn.execute(
+            table.update()
+                .where(table.c.id == bindparam('_id'))
+                .values(last_seen=rtime, repeat_count=table.c.repeat_count + bindparam('_n')),
+            [{'_id': id, '_n': n} for id, n in repeats.items()]
+        )
+        if records is not None:
+            records.extend(history.seen_record(id, repeated[id], rtime, n) for id, n in repeats.items())
+
+    if records is not None:
+        history.add_pending(ssn, records)
+    return sum(len(generation) for generation in generations)
+
+
+def set_report(ssn, server, data, changes_only=False):
+    """ Store a report of a batch: services' status and/or alerts. Does not commit.
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param server: The reporting server
+    :type server: models.Server
+    :param data: Validated input: {period?, services?, alerts?}
+    :type data: dict
+    :param changes_only: Change-only storage: see insert_service_states()
+    :type changes_only: bool
+    """
+    if 'services' in data:
+        set_service_status(ssn, server, data, changes_only)
+    if 'alerts' in data:
+        set_alerts(ssn, server, data)
+
+
+def set_alerts(ssn, server, data):
+    """ Store alerts reported by a server. Does not commit.
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param server: The reporting server
+    :type server: models.Server
+    :param data: Validated input: {alerts}
+    :type data: dict
+    """
+    # Services
+    services = identify_services(ssn, server, [a['service'] for a in data['alerts'] if 'service' in a])
+
+    # Alerts
+    for a in data['alerts']:
+        # Service (if any)
+        service = services[a['service']] if 'service' in a else None
+
+        # Raise
+        alert = models.Alert(
+            server=server,
+            service=service,
+            ctime=datetime.utcnow(),
+            channel='api',
+            event='alert',
+            message=unicode(a['message'])
+        )
+        ssn.add(alert)
+        logger.debug(u'Alert reported for {server}:`{service}`: {message}'.format(server=server.name, service=service.name if service else '-', message=a['message']))
+
+#endregion
@@ -0,0 +1,81 @@
+import threading
+from time import time
+from math import ceil
+
+from werkzeug.exceptions import TooManyRequests
+
+from overc.lib.cache import TTLCache
+
+
+class RateLimited(TooManyRequests):
+    """ 429 Too Many Requests, with a `Retry-After` hint """
+
+    def __init__(self, retry_after, description=None):
+        """ Init the error
+        :param retry_after: The number of seconds the client should wait before retrying
+        :type retry_after: int
+        """
+        super(RateLimited, self).__init__(description)
+        self.retry_after = retry_after
+
+
+class TokenBuckets(object):
+    """ Token bucket rate limiter: one bucket per key
+
+    Every bucket holds up to `burst` tokens, and is refilled at `rate` tokens per second.
+    Each request takes a token; when the bucket is empty, the request is rejected.
+
+    The buckets are in-process: with multiple worker processes, every process has buckets of its own.
+    Thread-safe.
+    """
+
+    def __init__(self, rate, burst, maxsize=10000):
+        """ Init the limiter
+        :param rate: Refill rate, tokens per second
+        :type rate: float
+        :param burst: Bucket size: the number of requests allowed at once
+        :type burst: int
+        :param maxsize: The maximum number of buckets to keep
+        :type maxsize: int
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+        # A bucket left alone for `burst/rate` seconds is full again, and can be forgotten
+        self._buckets = TTLCache(maxsize, self.burst / self.rate)  # key -> (tokens, timestamp)
+        self._lock = threading.Lock()
+
+    def take(self, key, n=1):
+        """ Take tokens from the bucket
+        :param key: Bucket key
+        :type key: str
+        :param n: The number of tokens to take
+        :type n: int
+        :return: 0 when the tokens are taken; otherwise, the number of seconds to wait before retrying
+        :rtype: float
+        """
+        with self._lock:
+            now = time()
+            tokens, last = self._buckets.get(key, (self.burst, now))
+
+            # Refill
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            # Take
+            if tokens >= n:
+                self._buckets.set(key, (tokens - n, now))
+                return 0.0
+            self._buckets.set(key, (tokens, now))
+            return (n - tokens) / self.rate
+
+    def check(self, key, n=1):
+        """ Take tokens from the bucket, or fail
+        :param key: Bucket key
+        :type key: str
+        :param n: The number of tokens to take
+        :type n: int
+        :exception RateLimited: The bucket is empty
+        """
+        wait = self.take(key, n)
+        if wait:
+            raise RateLimited(int(ceil(wait)), 'Rate limit exceeded for "{}"'.format(key))
@@ -0,0 +1,210 @@
+import logging
+from time import time
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import func, and_, or_, select, exists
+
+from overc.lib.db import models
+from overc.lib.db.bulk import delete_id_ranges
+
+logger = logging.getLogger(__name__)
+
+#: Tables with retention policies: { table name: model }
+TABLES = OrderedDict([
+    ('service_states', models.ServiceState),
+    ('alerts', models.Alert),
+    ('service_states_hourly', models.ServiceStateHourly),
+    ('service_states_daily', models.ServiceStateDaily),
+])
+
+
+def _until_id(ssn, Model, time_column, cutoff):
+    """ Find the last id received before the cutoff time
+
+    Ids grow with time, so the first row at the cutoff is found with a single index seek.
+
+    :rtype: int|None
+    """
+    first_kept = ssn.query(Model.id).filter(time_column >= cutoff).order_by(time_column).limit(1).scalar()
+    if first_kept is not None:
+        return first_kept - 1
+    return ssn.query(func.max(Model.id)).scalar()
+
+
+def prune_service_states(ssn, cutoff, batch_size, seen_before=None, deadline=None, info_ids=None):
+    """ Delete service states received before the cutoff time
+
+    Current states and states not checked by the supervisor yet are kept.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param cutoff: Delete states older than this
+    :type cutoff: datetime
+    :param batch_size: The size of every id range to delete
+    :type batch_size: int
+    :param seen_before: Also keep the states seen at this time or later
+    :type seen_before: datetime|None
+    :param deadline: Stop at this time (see `time.time()`): the rest is left for the next run
+    :type deadline: float|None
+    :param info_ids: Collects the info text ids of the deleted states: candidates for `prune_infos()`
+    :type info_ids: set|None
+    :returns: The number of rows deleted
+    :rtype: int
+    """
+    S = models.ServiceState
+    until_id = _until_id(ssn, S, S.rtime, cutoff)
+    if until_id is None:
+        return 0
+
+    def collect_infos(batch):
+        info_ids.update(row[0] for row in ssn.execute(select([S.info_id]).where(batch).distinct()))
+
+    return delete_id_ranges(ssn, S.__table__, and_(
+        S.rtime < cutoff,
+        S.checked == True,
+        or_(S.last_seen == None, S.last_seen < seen_before) if seen_before is not None else True,
+        ~S.id.in_(select([models.Service.current_state_id]).where(models.Service.current_state_id != None))
+    ), until_id, batch_size, deadline, collect_infos if info_ids is not None else None)
+
+
+def prune_infos(ssn, batch_size, info_ids=None):
+    """ Delete service info texts no state refers to
+
+    Runs after the service states are pruned. Only the texts of the deleted states can become unused:
+    with `info_ids` given, only these are checked. Otherwise, the whole table is swept, in id ranges.
+
+    A batch that races with the ingestion (a state referring to the text was inserted meanwhile)
+    fails on the foreign key, and is skipped. The other way round, a report that has just looked the text up
+    fails on the foreign key: the ingestion does not lock the texts it reads. The next report stores the text again.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param batch_size: The size of every batch to delete
+    :type batch_size: int
+    :param info_ids: The info text ids to check, see `prune_service_states()`
+    :type info_ids: set|None
+    :returns: The number of rows deleted
+    :rtype: int
+    """
+    I, S = models.ServiceStateInfo, models.ServiceState
+    table = I.__table__
+    unused = ~exists().where(S.info_id == table.c.id)
+
+    # Batches
+    if info_ids is not None:
+        info_ids = sorted(info_ids)
+        batches = [table.c.id.in_(info_ids[i:i + batch_size]) for i in range(0, len(info_ids), batch_size)]
+    else:
+        start, until_id = ssn.query(func.min(I.id), func.max(I.id)).one()
+        batches = [and_(table.c.id >= i, table.c.id < i + batch_size) for i in range(start, until_id + 1, batch_size)] if start is not None else []
+
+    total = 0
+    for batch in batches:
+        try:
+            total += ssn.execute(table.delete().where(and_(batch, unused))).rowcount
+            ssn.commit()
+        except IntegrityError:
+            ssn.rollback()
+    return total
+
+
+def prune_alerts(ssn, cutoff, batch_size, deadline=None):
+    """ Delete alerts created before the cutoff time. Alerts not reported yet are kept.
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param cutoff: Delete alerts older than this
+    :type cutoff: datetime
+    :param batch_size: The size of every id range to delete
+    :type batch_size: int
+    :param deadline: Stop at this time (see `time.time()`): the rest is left for the next run
+    :type deadline: float|None
+    :returns: The number of rows deleted
+    :rtype: int
+    """
+    A = models.Alert
+    until_id = _until_id(ssn, A, A.ctime, cutoff)
+    if until_id is None:
+        return 0
+
+    return delete_id_ranges(ssn, A.__table__, and_(
+        A.ctime < cutoff,
+        A.reported == True
+    ), until_id, batch_size, deadline)
+
+
+def prune_rollups(ssn, Rollup, cutoff, deadline=None):
+    """ Delete rollups for periods before the cutoff time, one day at a time
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param Rollup: Rollup model
+    :type Rollup: type
+    :param cutoff: Delete rollups older than this
+    :type cutoff: datetime
+    :param deadline: Stop at this time (see `time.time()`): the rest is left for the next run. At least one day is deleted.
+    :type deadline: float|None
+    :returns: The number of rows deleted
+    :rtype: int
+    """
+    table = Rollup.__table__
+
+    total = 0
+    start = ssn.query(func.min(Rollup.period)).scalar()
+    while start is not None and start < cutoff:
+        end = min(start + timedelta(days=1), cutoff)
+        total += ssn.execute(table.delete().where(and_(table.c.period >= start, table.c.period < end))).rowcount
+        ssn.commit()
+        if deadline is not None and time() >= deadline:
+            break
+        start = end
+    return total
+
+
+def prune(app, ssn, now=None, time_budget=None):
+    """ Apply the retention policies: delete old rows
+
+    With a time budget (the supervisor), tables are pruned until it's used up: the rest is left for the next run,
+    and only the info texts of the deleted states are checked.
+    Without one (`overc prune`), everything is pruned, and all the info texts are swept.
+
+    :param app: Application
+    :type app: OvercApplication
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param now: Current time
+    :type now: datetime|None
+    :param time_budget: Stop after this many seconds
+    :type time_budget: float|None
+    :return: The number of rows deleted, per table: { table name: int }, and the number of history segments: 'history'.
+    :rtype: OrderedDict
+    """
+    config = app.app.config
+    now = now or datetime.utcnow()
+    batch_size = int(config['RETENTION_BATCH_SIZE'])
+    deadline = time() + time_budget if time_budget is not None else None
+
+    removed = OrderedDict()
+    for name, Model in TABLES.items():
+        days = config['RETENTION'].get(name)
+        if not days:
+            continue
+        if deadline is not None and time() >= deadline:
+            break
+        cutoff = now - timedelta(days=float(days))
+
+        if Model is models.ServiceState:
+            info_ids = set() if deadline is not None else None
+            removed[name] = prune_service_states(ssn, cutoff, batch_size, deadline=deadline, info_ids=info_ids)
+            removed['service_state_infos'] = prune_infos(ssn, batch_size, info_ids)
+        elif Model is models.Alert:
+            removed[name] = prune_alerts(ssn, cutoff, batch_size, deadline)
+        else:
+            removed[name] = prune_rollups(ssn, Model, cutoff, deadline)
+
+    # History backend: segments
+    if config['RETENTION'].get('history'):
+        removed['history'] = app.history.prune(now - timedelta(days=float(config['RETENTION']['history'])))
+
+    logger.info('Retention: removed {}'.format(', '.join('{}={}'.format(*i) for i in removed.items()) or 'nothing'))
+    return removed
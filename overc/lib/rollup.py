@@ -0,0 +1,476 @@
+import logging
+from time import time
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import select, func, case, and_, bindparam
+
+from overc.lib.db import models
+from overc.lib.retention import prune_service_states, prune_infos
+
+logger = logging.getLogger(__name__)
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+#: SQL expressions that floor a time to the hour, by dialect. Strings are parsed with `HOUR_FORMAT`
+HOUR_SQL = {
+    'mysql': lambda column: func.date_format(column, '%Y-%m-%d %H:00:00'),
+    'sqlite': lambda column: func.strftime('%Y-%m-%d %H:00:00', column),
+    'postgresql': lambda column: func.date_trunc('hour', column),
+}
+HOUR_FORMAT = '%Y-%m-%d %H:00:00'
+
+
+def _floor_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _floor_day(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _get_watermark(ssn, name):
+    """ Get the rollup progress
+    :rtype: models.RollupWatermark|None
+    """
+    return ssn.query(models.RollupWatermark).get(name)
+
+
+def _set_watermark(ssn, name, until):
+    """ Set the rollup progress. Does not commit. """
+    ssn.merge(models.RollupWatermark(name=name, until=until))
+
+
+def _new_bucket(service_id, period):
+    """ Make an empty aggregate
+    :rtype: dict
+    """
+    return {
+        'service_id': service_id, 'period': period,
+        'n_ok': 0, 'n_warn': 0, 'n_fail': 0, 'n_unk': 0, 'n_states': 0, 'transitions': 0,
+        'first_rtime': None, 'last_seen': None,
+    }
+
+
+def _state_bucket(service_id, period, state, n, repeats, transitions, first_rtime, last_seen):
+    """ Make an aggregate of the states of a single state value
+    :rtype: dict
+    """
+    bucket = _new_bucket(service_id, period)
+    bucket['n_' + state.name.lower()] = n + int(repeats or 0)
+    bucket['n_states'] = n
+    bucket['transitions'] = int(transitions or 0)
+    bucket['first_rtime'], bucket['last_seen'] = first_rtime, last_seen
+    return bucket
+
+
+def _merge_bucket(bucket, other):
+    """ Merge aggregates: add `other` to `bucket` """
+    for k in ('n_ok', 'n_warn', 'n_fail', 'n_unk', 'n_states', 'transitions'):
+        bucket[k] += other[k]
+    bucket['first_rtime'] = min(filter(None, (bucket['first_rtime'], other['first_rtime'])))
+    bucket['last_seen'] = max(filter(None, (bucket['last_seen'], other['last_seen'])))
+
+
+def aggregate_states(ssn, since, till, service_id=None):
+    """ Aggregate raw service states received within a period
+
+    Counts are the numbers of reports: a state with repeated reports merged counts as `1 + repeat_count`.
+    The latest state of every service might get more repeats after the period: its id and repeats
+    are returned as `last_state_id`, `last_repeat_count`. See count_late_repeats()
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param since: Period start, inclusive
+    :type since: datetime
+    :param till: Period end, exclusive
+    :type till: datetime
+    :param service_id: Only aggregate this service
+    :type service_id: int|None
+    :return: Aggregates, with `period=since`: { service_id: dict }
+    :rtype: dict[int, dict]
+    """
+    S = models.ServiceState
+    period = and_(
+        S.rtime >= since,
+        S.rtime < till,
+        S.service_id == service_id if service_id else True
+    )
+
+    # The latest states: counted from a single read, so `last_repeat_count` is exactly what's counted
+    latest_ids = select([func.max(S.id).label('id')]).where(period).group_by(S.service_id).alias()
+    latest = ssn.query(S.id, S.service_id, S.state, S.repeat_count, S.prev_state, S.rtime, S.last_seen) \
+        .join(latest_ids, latest_ids.c.id == S.id) \
+        .all()
+
+    # The others
+    rows = ssn.query(
+        S.service_id, S.state,
+        func.count(S.id),
+        func.sum(S.repeat_count),
+        func.sum(case([(and_(S.prev_state != None, S.prev_state != S.state), 1)], else_=0)),
+        func.min(S.rtime),
+        func.max(func.coalesce(S.last_seen, S.rtime)),
+    ) \
+        .filter(period, ~S.id.in_(select([latest_ids.c.id]))) \
+        .group_by(S.service_id, S.state)
+    rows = rows.all() + [
+        (service_id, state, 1, repeat_count, int(prev_state is not None and prev_state != state), rtime, last_seen or rtime)
+        for id, service_id, state, repeat_count, prev_state, rtime, last_seen in latest
+    ]
+
+    buckets = {}
+    for service_id, state, n, repeats, transitions, first_rtime, last_seen in rows:
+        bucket = _state_bucket(service_id, since, state, n, repeats, transitions, first_rtime, last_seen)
+        if service_id in buckets:
+            _merge_bucket(buckets[service_id], bucket)
+        else:
+            buckets[service_id] = bucket
+
+    for id, service_id, state, repeat_count, prev_state, rtime, last_seen in latest:
+        buckets[service_id].update(last_state_id=id, last_repeat_count=repeat_count)
+    return buckets
+
+
+def aggregate_service_hours(ssn, service_id, since, till):
+    """ Aggregate the raw states of a service by hour, with a single query
+
+    Like aggregate_states(), without the latest states: they're only needed for the rollups.
+    Dialects missing from `HOUR_SQL` get a query per hour.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param service_id: Service id
+    :type service_id: int
+    :param since: Period start, inclusive: an hour
+    :type since: datetime
+    :param till: Period end, exclusive
+    :type till: datetime
+    :return: Aggregates, by hour: { hour: dict }
+    :rtype: dict[datetime, dict]
+    """
+    floor = HOUR_SQL.get(ssn.get_bind().dialect.name)
+    if floor is None:
+        hours = {}
+        hour = since
+        while hour < till:
+            bucket = aggregate_states(ssn, hour, hour + HOUR, service_id).get(service_id)
+            if bucket is not None:
+                hours[hour] = bucket
+            hour += HOUR
+        return hours
+
+    S = models.ServiceState
+    hour = floor(S.rtime)
+    rows = ssn.query(
+        hour, S.state,
+        func.count(S.id),
+        func.sum(S.repeat_count),
+        func.sum(case([(and_(S.prev_state != None, S.prev_state != S.state), 1)], else_=0)),
+        func.min(S.rtime),
+        func.max(func.coalesce(S.last_seen, S.rtime)),
+    ) \
+        .filter(S.service_id == service_id, S.rtime >= since, S.rtime < till) \
+        .group_by(hour, S.state)
+
+    hours = {}
+    for hour, state, n, repeats, transitions, first_rtime, last_seen in rows:
+        if not isinstance(hour, datetime):
+            hour = datetime.strptime(hour, HOUR_FORMAT)
+        bucket = _state_bucket(service_id, hour, state, n, repeats, transitions, first_rtime, last_seen)
+        if hour in hours:
+            _merge_bucket(hours[hour], bucket)
+        else:
+            hours[hour] = bucket
+    return hours
+
+
+def count_late_repeats(ssn, until):
+    """ Add the repeats that rolled up states got later to their rollups. Does not commit.
+
+    A state gets repeats for as long as it is current, and only the latest state of an hour can still be current.
+    Its hourly rollup remembers the number of its repeats counted. The states that might have been repeated
+    since the last time are the current ones, and the ones replaced after the watermark.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param until: The hourly rollup watermark
+    :type until: datetime
+    :returns: The number of states with new repeats
+    :rtype: int
+    """
+    S, H, D = models.ServiceState, models.ServiceStateHourly, models.ServiceStateDaily
+    Prev = aliased(S)
+    candidates = (
+        select([models.Service.current_state_id]).where(models.Service.current_rtime < until),
+        select([Prev.prev_id]).where(and_(Prev.rtime >= until, Prev.prev_id != None)),
+    )
+
+    # The states with new repeats: { id: (service_id, state, repeat_count, last_seen, hour, delta) }
+    states = {}
+    for ids in candidates:
+        for id, service_id, state, repeat_count, last_seen, hour, counted in ssn.query(
+                S.id, S.service_id, S.state, S.repeat_count, S.last_seen, H.period, H.last_repeat_count) \
+                .join(H, H.last_state_id == S.id) \
+                .filter(H.last_state_id.in_(ids), S.repeat_count > H.last_repeat_count):
+            states[id] = (service_id, state, repeat_count, last_seen, hour, repeat_count - counted)
+
+    # Update the hourly rollups, and the daily ones, if any: a statement per state column
+    for state in models.state_t.states:
+        column = 'n_' + state.lower()
+        params = [
+            {'_service_id': service_id, '_period': hour, '_day': _floor_day(hour), '_delta': delta,
+             '_repeat_count': repeat_count, '_last_seen': last_seen}
+            for service_id, s, repeat_count, last_seen, hour, delta in states.values()
+            if s.name == state
+        ]
+        if not params:
+            continue
+        for table, period, values in (
+            (H.__table__, '_period', {'last_repeat_count': bindparam('_repeat_count')}),
+            (D.__table__, '_day', {}),
+        ):
+            values.update({column: table.c[column] + bindparam('_delta'), 'last_seen': bindparam('_last_seen')})
+            ssn.execute(
+                table.update()
+                    .where(and_(table.c.service_id == bindparam('_service_id'), table.c.period == bindparam(period)))
+                    .values(**values),
+                params
+            )
+    return len(states)
+
+
+def aggregate_rollups(ssn, Rollup, since, till, service_id=None):
+    """ Aggregate rollups within a period
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param Rollup: Rollup model to aggregate
+    :type Rollup: type
+    :param since: Period start, inclusive
+    :type since: datetime
+    :param till: Period end, exclusive
+    :type till: datetime
+    :param service_id: Only aggregate this service
+    :type service_id: int|None
+    :return: Aggregates, with `period=since`: { service_id: dict }
+    :rtype: dict[int, dict]
+    """
+    R = Rollup
+    rows = ssn.query(
+        R.service_id,
+        func.sum(R.n_ok), func.sum(R.n_warn), func.sum(R.n_fail), func.sum(R.n_unk),
+        func.sum(R.n_states), func.sum(R.transitions),
+        func.min(R.first_rtime), func.max(R.last_seen),
+    ) \
+        .filter(
+            R.period >= since,
+            R.period < till,
+            R.service_id == service_id if service_id else True
+        ) \
+        .group_by(R.service_id)
+
+    return {
+        row[0]: dict(zip(
+            ('service_id', 'n_ok', 'n_warn', 'n_fail', 'n_unk', 'n_states', 'transitions', 'first_rtime', 'last_seen'),
+            (row[0],) + tuple(int(n) for n in row[1:7]) + tuple(row[7:])
+        ), period=since)
+        for row in rows
+    }
+
+
+def rollup_hours(ssn, now, max_hours, deadline=None):
+    """ Roll up raw service states into hourly aggregates: complete hours only. Commits every hour.
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param now: Current time
+    :type now: datetime
+    :param max_hours: The maximum number of hours to roll up in one go
+    :type max_hours: int
+    :param deadline: Stop at this time (see `time.time()`): the rest is left for the next run. At least one hour is rolled up.
+    :type deadline: float|None
+    :returns: The number of rollup rows written
+    :rtype: int
+    """
+    # Where to start
+    watermark = _get_watermark(ssn, 'hourly')
+    if watermark is not None:
+        hour = watermark.until
+    else:
+        first = ssn.query(func.min(models.ServiceState.rtime)).scalar()
+        if first is None:
+            return 0
+        hour = _floor_hour(first)
+    end = min(_floor_hour(now), hour + max_hours * HOUR)
+
+    # The hours rolled up already: states repeated since
+    if watermark is not None and hour < end:
+        count_late_repeats(ssn, hour)
+
+    n = 0
+    while hour < end:
+        buckets = aggregate_states(ssn, hour, hour + HOUR)
+        if buckets:
+            ssn.execute(models.ServiceStateHourly.__table__.insert(), buckets.values())
+            n += len(buckets)
+            next_hour = hour + HOUR
+        else:
+            # Skip the gap
+            next_rtime = ssn.query(func.min(models.ServiceState.rtime)).filter(models.ServiceState.rtime >= hour).scalar()
+            next_hour = min(_floor_hour(next_rtime), end) if next_rtime is not None else end
+            next_hour = max(next_hour, hour + HOUR)
+
+        _set_watermark(ssn, 'hourly', next_hour)
+        ssn.commit()
+        hour = next_hour
+        if deadline is not None and time() >= deadline:
+            break
+    return n
+
+
+def rollup_days(ssn, deadline=None):
+    """ Roll up hourly aggregates into daily ones: complete days only. Commits every day.
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param deadline: Stop at this time (see `time.time()`): the rest is left for the next run. At least one day is rolled up.
+    :type deadline: float|None
+    :returns: The number of rollup rows written
+    :rtype: int
+    """
+    hourly = _get_watermark(ssn, 'hourly')
+    if hourly is None:
+        return 0
+
+    # Where to start
+    watermark = _get_watermark(ssn, 'daily')
+    if watermark is not None:
+        day = watermark.until
+    else:
+        first = ssn.query(func.min(models.ServiceStateHourly.period)).scalar()
+        if first is None:
+            return 0
+        day = _floor_day(first)
+    end = _floor_day(hourly.until)
+
+    n = 0
+    while day < end:
+        buckets = aggregate_rollups(ssn, models.ServiceStateHourly, day, day + DAY)
+        if buckets:
+            ssn.execute(models.ServiceStateDaily.__table__.insert(), buckets.values())
+            n += len(buckets)
+        _set_watermark(ssn, 'daily', day + DAY)
+        ssn.commit()
+        day += DAY
+        if deadline is not None and time() >= deadline:
+            break
+    return n
+
+
+def downsample(ssn, now, age, batch_size, deadline=None):
+    """ Delete raw service states that are older than `age` and are rolled up already
+
+    Current states, states not checked by the supervisor yet, and states with repeats not rolled up yet are kept.
+    Info texts no longer referred to are deleted as well.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param now: Current time
+    :type now: datetime
+    :param age: Keep raw states for this long
+    :type age: timedelta
+    :param batch_size: The size of every id range to delete
+    :type batch_size: int
+    :param deadline: Stop at this time (see `time.time()`): the rest is left for the next run
+    :type deadline: float|None
+    :returns: The number of raw states deleted
+    :rtype: int
+    """
+    hourly = _get_watermark(ssn, 'hourly')
+    if hourly is None:
+        return 0
+    # States seen after the watermark might have repeats to count yet: see count_late_repeats()
+    info_ids = set()
+    n = prune_service_states(ssn, min(now - age, hourly.until), batch_size, seen_before=hourly.until,
+                             deadline=deadline, info_ids=info_ids)
+    prune_infos(ssn, batch_size, info_ids)
+    return n
+
+
+def rollup_once(app, ssn, now=None, time_budget=None):
+    """ Perform the rollup job once: hourly & daily rollups, downsampling
+
+    With a time budget (the supervisor), the steps run until it's used up: the rest is left for the next run.
+
+    :param app: Application
+    :type app: OvercApplication
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param now: Current time
+    :type now: datetime|None
+    :param time_budget: Stop after this many seconds
+    :type time_budget: float|None
+    :returns: (hourly rows, daily rows, raw states deleted)
+    :rtype: (int, int, int)
+    """
+    config = app.app.config
+    now = now or datetime.utcnow()
+    deadline = time() + time_budget if time_budget is not None else None
+    out_of_time = lambda: deadline is not None and time() >= deadline
+
+    n_hours = rollup_hours(ssn, now, int(config['ROLLUP_MAX_HOURS']), deadline)
+    n_days = rollup_days(ssn, deadline) if not out_of_time() else 0
+    n_deleted = 0
+    if config.get('ROLLUP_DOWNSAMPLE_AFTER') and not out_of_time():
+        n_deleted = downsample(ssn, now, timedelta(hours=float(config['ROLLUP_DOWNSAMPLE_AFTER'])), int(config['ROLLUP_BATCH_SIZE']),
+                               deadline)
+
+    logger.debug('Rollup finished: {} hourly, {} daily, {} raw states deleted'.format(n_hours, n_days, n_deleted))
+    return n_hours, n_days, n_deleted
+
+
+def service_history(ssn, service_id, since, till, resolution):
+    """ Aggregated service state history, from the rollups and the raw states not yet rolled up
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param service_id: Service id
+    :type service_id: int
+    :param since: Period start
+    :type since: datetime
+    :param till: Period end
+    :type till: datetime
+    :param resolution: 'hour' or 'day'
+    :type resolution: str
+    :return: Aggregates, in chronological order
+    :rtype: list[dict]
+    """
+    floor = {'hour': _floor_hour, 'day': _floor_day}[resolution]
+    buckets = OrderedDict()
+
+    def add(bucket):
+        period = floor(bucket['period'])
+        if period in buckets:
+            _merge_bucket(buckets[period], bucket)
+        else:
+            buckets[period] = dict(bucket, period=period)
+
+    # Rollups
+    since = floor(since)
+    hourly = _get_watermark(ssn, 'hourly')
+    daily = _get_watermark(ssn, 'daily')
+    hourly_until = hourly.until if hourly is not None else since
+    daily_until = daily.until if daily is not None and resolution == 'day' else since
+    if resolution == 'day':
+        D = models.ServiceStateDaily
+        for r in ssn.query(D).filter(D.service_id == service_id, D.period >= since, D.period < daily_until).order_by(D.period):
+            add(dict(_new_bucket(service_id, r.period), **{c.name: getattr(r, c.name) for c in D.__table__.columns}))
+    H = models.ServiceStateHourly
+    for r in ssn.query(H).filter(H.service_id == service_id, H.period >= max(since, daily_until), H.period < hourly_until).order_by(H.period):
+        add(dict(_new_bucket(service_id, r.period), **{c.name: getattr(r, c.name) for c in H.__table__.columns}))
+
+    # Not rolled up yet: aggregate the raw states
+    raw = aggregate_service_hours(ssn, service_id, max(since, hourly_until), till)
+    for hour in sorted(raw):
+        add(raw[hour])
+
+    return buckets.values()
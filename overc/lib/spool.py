@@ -0,0 +1,234 @@
+import json
+import fcntl
+import sqlite3
+import logging
+from time import sleep
+from contextlib import closing
+
+from werkzeug.exceptions import Forbidden
+from sqlalchemy.exc import OperationalError
+
+from overc.src.init import init_db_engine, init_db_session
+from overc.lib.cache import TTLCache
+from overc.lib import ingest, history
+
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """ Durable local queue of accepted API reports
+
+    Backed by an SQLite file, so it can be shared by multiple processes and survives restarts.
+    Items are only removed after they're committed to the database.
+
+    Delivery is at-least-once: if the writer dies after the database commit, but before the items are removed,
+    the batch is written again on restart, and its states & alerts are stored twice.
+
+    Items that fail to write are moved to the `dead` table, with the error, for inspection.
+    """
+
+    def __init__(self, filename):
+        """ Open the spool, create if missing
+        :param filename: Spool file path
+        :type filename: str
+        """
+        self.filename = filename
+
+        with closing(self._connect()) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS spool ('
+                       'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                       'method TEXT NOT NULL, '
+                       'remote_addr TEXT, '
+                       'data TEXT NOT NULL'
+                       ')')
+            db.execute('CREATE TABLE IF NOT EXISTS dead ('
+                       'id INTEGER PRIMARY KEY, '
+                       'method TEXT NOT NULL, '
+                       'remote_addr TEXT, '
+                       'data TEXT NOT NULL, '
+                       'error TEXT NOT NULL'
+                       ')')
+
+    def _connect(self):
+        """ Connect to the spool file
+        :rtype: sqlite3.Connection
+        """
+        db = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+        db.execute('PRAGMA synchronous=FULL')
+        return db
+
+    def append(self, method, remote_addr, data):
+        """ Put a report into the spool
+        :param method: API method name: 'service/status', 'alerts', 'report'
+        :type method: str
+        :param remote_addr: Remote IP address of the server
+        :type remote_addr: str|None
+        :param data: Validated input
+        :type data: dict
+        """
+        with closing(self._connect()) as db:
+            db.execute('INSERT INTO spool (method, remote_addr, data) VALUES (?, ?, ?)',
+                       (method, remote_addr, json.dumps(data)))
+
+    def extend(self, items):
+        """ Put many reports into the spool, in a single transaction
+        :param items: [ (method, remote_addr, data), ... ]
+        :type items: list[tuple]
+        """
+        with closing(self._connect()) as db:
+            db.execute('BEGIN')
+            db.executemany('INSERT INTO spool (method, remote_addr, data) VALUES (?, ?, ?)',
+                           [(method, remote_addr, json.dumps(data)) for method, remote_addr, data in items])
+            db.execute('COMMIT')
+
+    def peek(self, limit):
+        """ Get the oldest items, without removing them
+        :param limit: The maximum number of items
+        :type limit: int
+        :return: [ (id, method, remote_addr, data), ... ]
+        :rtype: list[tuple]
+        """
+        with closing(self._connect()) as db:
+            return [
+                (id, method, remote_addr, json.loads(data))
+                for id, method, remote_addr, data in
+                db.execute('SELECT id, method, remote_addr, data FROM spool ORDER BY id LIMIT ?', (limit,))
+            ]
+
+    def remove(self, max_id, dead=None):
+        """ Remove items up to the given id, inclusive
+        :param max_id: The last id to remove
+        :type max_id: int
+        :param dead: Items to move to the `dead` table instead: { id: error }
+        :type dead: dict|None
+        """
+        with closing(self._connect()) as db:
+            db.execute('BEGIN')
+            db.executemany('INSERT OR REPLACE INTO dead (id, method, remote_addr, data, error) '
+                           'SELECT id, method, remote_addr, data, ? FROM spool WHERE id = ?',
+                           [(error, id) for id, error in (dead or {}).items()])
+            db.execute('DELETE FROM spool WHERE id <= ?', (max_id,))
+            db.execute('COMMIT')
+
+    def dead(self):
+        """ Get the items that failed to write
+        :return: [ (id, method, remote_addr, data, error), ... ]
+        :rtype: list[tuple]
+        """
+        with closing(self._connect()) as db:
+            return [
+                (id, method, remote_addr, json.loads(data), error)
+                for id, method, remote_addr, data, error in
+                db.execute('SELECT id, method, remote_addr, data, error FROM dead ORDER BY id')
+            ]
+
+    def __len__(self):
+        with closing(self._connect()) as db:
+            return db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+
+def _rollback_item(ssn, savepoint, mark, identified):
+    """ Roll a spooled report back to its savepoint """
+    savepoint.rollback()
+    history.discard_pending(ssn, mark)
+
+    # The current state pointers are set on the loaded objects without making them dirty, and the servers
+    # might have been created within the savepoint: reload
+    ssn.expire_all()
+    identified.clear()
+
+
+def drain_spool(ssn, spool, batch_size, server_cache, ingest_options=None):
+    """ Write one batch of spooled reports to the database, in a single transaction
+
+    Every report is written within a savepoint. A rejected report is dropped.
+    A report that fails to write is moved to the dead items: see `Spool.dead()`.
+    Operational errors (connection lost, deadlock, lock timeout) fail the batch: it's retried later.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param spool: The spool
+    :type spool: Spool
+    :param batch_size: The maximum number of reports to write
+    :type batch_size: int
+    :param server_cache: Server identity cache
+    :type server_cache: overc.lib.cache.TTLCache
+    :param ingest_options: Ingestion options: see `ingest.options()`
+    :type ingest_options: dict
+    :returns: The number of reports processed
+    :rtype: int
+    """
+    ingest_options = ingest_options or {}
+
+    items = spool.peek(batch_size)
+    if not items:
+        return 0
+
+    identified = {}
+    dead = {}
+    for id, method, remote_addr, data in items:
+        savepoint, mark = ssn.begin_nested(), history.pending_mark(ssn)
+        try:
+            server = ingest.identify_server(ssn, data['server'], remote_addr, server_cache, identified)
+            if method == 'service/status':
+                ingest.set_service_status(ssn, server, data, **ingest_options)
+            elif method == 'alerts':
+                ingest.set_alerts(ssn, server, data)
+            elif method == 'report':
+                ingest.set_report(ssn, server, data, **ingest_options)
+            else:
+                raise AssertionError('Unknown method: {}'.format(method))
+            savepoint.commit()
+        except OperationalError:
+            raise
+        except (AssertionError, Forbidden) as e:
+            # Rejected reports are dropped: there's no one to tell
+            _rollback_item(ssn, savepoint, mark, identified)
+            logger.warning(u'Spooled report #{} rejected: {}'.format(id, e))
+        except Exception as e:
+            _rollback_item(ssn, savepoint, mark, identified)
+            dead[id] = u'{}: {}'.format(type(e).__name__, e)
+            logger.exception(u'Spooled report #{} failed to write: moved to the dead items'.format(id))
+
+    # Commit, then forget
+    ssn.commit()
+    spool.remove(items[-1][0], dead)
+    return len(items)
+
+
+def spool_writer_loop(app):
+    """ Spool writer main loop which drains the spool into the database
+    :param app: Application
+    :type app: OvercApplication
+    """
+    config = app.app.config
+    flush_interval = float(config['SPOOL_FLUSH_INTERVAL'])
+    batch_size = int(config['SPOOL_BATCH_SIZE'])
+
+    db_engine = init_db_engine(config['DATABASE'], config)
+    Session = init_db_session(db_engine, {history.INFO_BACKEND: app.history})
+    server_cache = TTLCache(int(config['SERVER_CACHE_SIZE']), float(config['SERVER_CACHE_TTL']))
+
+    # Only one writer at a time: the others wait
+    with open(app.spool.filename + '.lock', 'w') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+        while True:
+            sleep(flush_interval)
+
+            # Drain
+            ssn = Session()
+            try:
+                n = batch_size
+                while n == batch_size:
+                    n = drain_spool(ssn, app.spool, batch_size, server_cache, ingest.options(config))
+                    if n and app.wakeup is not None:
+                        app.wakeup.send()
+            except Exception:
+                # Keep the items: retry later
+                logger.exception('Spool writer error')
+                ssn.rollback()
+                server_cache.clear()
+            finally:
+                Session.remove()
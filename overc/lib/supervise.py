@@ -1,52 +1,113 @@
 import logging
-from time import sleep
+import socket
+from time import sleep, time
 import os, tempfile
 
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql.expression import func, and_, bindparam
+
 from overc.src.init import init_db_engine, init_db_session
 from overc.lib.db import models
 from overc.lib import alerts
+from overc.lib.rollup import rollup_once
+from overc.lib.retention import prune
+from overc.lib.wakeup import WakeupListener
 
 logger = logging.getLogger(__name__)
 
 # TODO: these routines should obtain an exclusive lock so multiple supervise processes does not issue alerts multiple times
 
 
-def _check_service_states(ssn):
-    """ Test all service states, raise alerts if necessary
+def _check_service_state_range(ssn, first_id, last_id):
+    """ Test the service states within an id range, raise alerts if necessary. Commits.
+
+    Set-based: every state records its predecessor's state (`prev_state`) on insert,
+    so the changes are found with a single query, and only they are loaded.
+    Alerts are inserted in bulk. The other states are marked as checked with a single UPDATE by id range.
+
     :param ssn: Database session
     :type ssn: sqlalchemy.orm.session.Session
+    :param first_id: The first state id, inclusive
+    :type first_id: int
+    :param last_id: The last state id, inclusive
+    :type last_id: int
     :returns: The number of new alerts reported
     :rtype: int
     """
-    # Fetch all states that are not yet checked
-    service_states = ssn.query(models.ServiceState)\
-        .filter(models.ServiceState.checked == False)\
-        .order_by(models.ServiceState.id.asc())\
+    S = models.ServiceState
+    table = S.__table__
+    unchanged = S.state == func.coalesce(S.prev_state, int(models.state_t.OK))  # a missing predecessor counts as OK
+
+    # State changes
+    changes = ssn.query(S.id, S.service_id, models.Service.server_id, S.state, S.prev_state) \
+        .join(models.Service, models.Service.id == S.service_id) \
+        .filter(S.checked == False, S.id.between(first_id, last_id), ~unchanged) \
+        .order_by(S.id) \
         .all()
 
-    # Check them one by one
-    new_alerts = 0
-    for s in service_states:
-        logger.debug(u'Checking service {server}:`{service}` state #{id}: {state}'.format(id=s.id, server=s.service.server, service=s.service, state=s.state))
-
-        # Report state changes and abnormal states
-        if s.state != (s.prev.state if s.prev else 'OK'):
-            ssn.add(models.Alert(
-                server=s.service.server,
-                service=s.service,
-                service_state=s,
-                channel='service:state',
-                event=s.state,
-                message=u'State changed: "{}" -> "{}"'.format(s.prev.state if s.prev else '(?)', s.state)
-            ))
-            new_alerts += 1
-
-        # Save
-        s.checked = True
-        ssn.add(s)
+    # Report them
+    new_alerts = []
+    for id, service_id, server_id, state, prev_state in changes:
+        logger.debug(u'Service #{service_id} state #{id} changed: {prev} -> {state}'.format(
+            id=id, service_id=service_id, prev=prev_state.name if prev_state is not None else '(?)', state=state.name))
+        new_alerts.append({
+            'server_id': server_id,
+            'service_id': service_id,
+            'service_state_id': id,
+            'channel': 'service:state',
+            'event': state.name,
+            'message': u'State changed: "{}" -> "{}"'.format(prev_state.name if prev_state is not None else '(?)', state.name),
+        })
+    if new_alerts:
+        ssn.execute(models.Alert.__table__.insert(), new_alerts)
+
+    # Save: the unchanged states by range, the changed ones by id.
+    # A state that a concurrent transaction inserts within the range, and the queries above did not see,
+    # only gets marked as checked when it needs no alert.
+    ssn.execute(table.update().where(and_(table.c.id.between(first_id, last_id), table.c.checked == False, unchanged)).values(checked=True))
+    if changes:
+        ssn.execute(table.update().where(table.c.id == bindparam('_id')).values(checked=True),
+                    [{'_id': id} for id, service_id, server_id, state, prev_state in changes])
 
     # Finish
     ssn.commit()
+    return len(new_alerts)
+
+
+def _check_service_states(ssn, batch_size=10000, time_budget=None):
+    """ Test all service states, raise alerts if necessary
+
+    The states are checked in id ranges of `batch_size`, committing after each one (keyset pagination):
+    memory use does not depend on the backlog, and an interrupted run does not start over.
+    States received meanwhile are left for the next run.
+
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :param batch_size: The size of every id range
+    :type batch_size: int
+    :param time_budget: Stop after this many seconds: the rest is left for the next run. At least one range is checked.
+    :type time_budget: float|None
+    :returns: The number of new alerts reported
+    :rtype: int
+    """
+    S = models.ServiceState
+    deadline = time() + time_budget if time_budget is not None else None
+
+    until_id = ssn.query(func.max(S.id)).filter(S.checked == False).scalar()
+    first_id = ssn.query(func.min(S.id)).filter(S.checked == False).scalar()
+
+    new_alerts = 0
+    while first_id is not None and first_id <= until_id:
+        last_id = min(first_id + batch_size - 1, until_id)
+        new_alerts += _check_service_state_range(ssn, first_id, last_id)
+
+        # Out of time?
+        if deadline is not None and time() >= deadline:
+            logger.info('Service state check: out of time at state #{}, continuing on the next run'.format(last_id))
+            break
+
+        # Next range: skip the gap
+        first_id = ssn.query(func.min(S.id)).filter(S.checked == False, S.id > last_id).scalar()
     return new_alerts
 
 
@@ -60,9 +121,11 @@ def _check_service_timeouts(ssn):
     # Fetch all services which have enough data
     services = ssn.query(models.Service)\
         .filter(
-            models.Service.period is not None,
-            models.Service.state is not None
-        ).all()
+            models.Service.period != None,
+            models.Service.current_state_id != None
+        )\
+        .options(joinedload(models.Service.state))\
+        .all()
 
     # Detect timeouts
     new_alerts = 0
@@ -96,38 +159,69 @@ def _check_service_timeouts(ssn):
     return new_alerts
 
 
-def _send_pending_alerts(ssn, alert_plugins):
+def _send_pending_alerts(ssn, alert_plugins, batch_size=100, time_budget=None):
     """ Send pending alerts
+
+    The alerts are loaded in chunks of `batch_size`, by id (keyset pagination), and marked as reported after each one:
+    an interrupted run only sends the current chunk again.
+
     :param ssn: Database session
     :type ssn: sqlalchemy.orm.session.Session
     :param alert_plugins: Application config for alerts
     :type alert_plugins: list[alerts.AlertPlugin]
+    :param batch_size: The number of alerts to load at once
+    :type batch_size: int
+    :param time_budget: Stop after this many seconds: the rest is left for the next run. At least one alert is sent.
+    :type time_budget: float|None
     :returns: The number of alerts sent
     :rtype: int
     """
-    # Fetch all alerts which were not reported
-    pending_alerts = ssn.query(models.Alert)\
-        .filter(models.Alert.reported == False)\
-        .all()
-
-    # Report them one by one
-    for a in pending_alerts:
-        logger.debug(u'Sending alert #{id}: server={server}, service={service}, [{channel}/{event}]'.format(id=a.id, server=a.server, service=a.service, channel=a.channel, event=a.event))
-
-        # Prepare alert message
-        alert_message = unicode(a) + "\n"
-        if a.service and a.service.state:
-            s = a.service.state
-            alert_message += u"Current: {}: {}\n".format(s.state, s.info)
-
-        # Potential exceptions are handled & logged down there
-        alerts.send_alert_with_plugins(alert_plugins, alert_message)
-        a.reported = True
-        ssn.add(a)
+    deadline = time() + time_budget if time_budget is not None else None
 
-    # Finish
-    ssn.commit()
-    return len(pending_alerts)
+    sent_alerts = 0
+    after_id = 0
+    while True:
+        # Fetch a chunk of alerts which were not reported
+        pending_alerts = ssn.query(models.Alert)\
+            .filter(models.Alert.reported == False, models.Alert.id > after_id)\
+            .options(joinedload(models.Alert.service).joinedload(models.Service.state))\
+            .order_by(models.Alert.id)\
+            .limit(batch_size)\
+            .all()
+        if not pending_alerts:
+            break
+
+        # Report them one by one
+        out_of_time = False
+        for a in pending_alerts:
+            logger.debug(u'Sending alert #{id}: server={server}, service={service}, [{channel}/{event}]'.format(id=a.id, server=a.server, service=a.service, channel=a.channel, event=a.event))
+
+            # Prepare alert message
+            alert_message = unicode(a) + "\n"
+            if a.service and a.service.state:
+                s = a.service.state
+                alert_message += u"Current: {}: {}\n".format(s.state.name, s.info)
+
+            # Potential exceptions are handled & logged down there
+            alerts.send_alert_with_plugins(alert_plugins, alert_message)
+            a.reported = True
+            ssn.add(a)
+            sent_alerts += 1
+            after_id = a.id
+
+            # Out of time?
+            if deadline is not None and time() >= deadline:
+                out_of_time = True
+                break
+
+        # Save the chunk
+        ssn.commit()
+        if out_of_time:
+            logger.info('Alerts: out of time at alert #{}, continuing on the next run'.format(after_id))
+            break
+        if len(pending_alerts) < batch_size:
+            break
+    return sent_alerts
 
 
 def supervise_once(app, ssn):
@@ -137,16 +231,22 @@ def supervise_once(app, ssn):
     * Check for service timeouts
     * Send alerts
 
+    Service state checks and alert sending get a time budget each, so a backlog
+    does not hold timeout detection back: it's cleared over several runs.
+
     :param app: Application
     :type app: OvercApplication
     :returns: (New alerts created, Alerts sent)
     :rtype: (int, int)
     """
+    config = app.app.config
+    time_budget = float(config['SUPERVISOR_TIME_BUDGET']) if config.get('SUPERVISOR_TIME_BUDGET') else None
+
     # Act
     new_alerts, sent_alerts = 0, 0
-    new_alerts += _check_service_states(ssn)
+    new_alerts += _check_service_states(ssn, int(config['SUPERVISOR_BATCH_SIZE']), time_budget)
     new_alerts += _check_service_timeouts(ssn)
-    sent_alerts = _send_pending_alerts(ssn, app.app.config['ALERT_PLUGINS'])
+    sent_alerts = _send_pending_alerts(ssn, config['ALERT_PLUGINS'], int(config['SUPERVISOR_ALERT_BATCH_SIZE']), time_budget)
 
     # Finish
     logger.debug('Supervise loop finished: {} new alerts, {} sent alerts'.format(new_alerts, sent_alerts))
@@ -156,6 +256,16 @@ def supervise_once(app, ssn):
 
 
 
+def has_backlog(ssn):
+    """ Are there states not checked yet, or alerts not sent yet?
+    :param ssn: Database session
+    :type ssn: sqlalchemy.orm.session.Session
+    :rtype: bool
+    """
+    return ssn.query(models.ServiceState.id).filter(models.ServiceState.checked == False).first() is not None or \
+           ssn.query(models.Alert.id).filter(models.Alert.reported == False).first() is not None
+
+
 import signal, errno
 from contextlib import contextmanager
 import fcntl
@@ -168,6 +278,7 @@ def flock_timeout(filename, seconds): # TODO: if this works, move to lib/
         with open(filename, 'w') as f:
             try:
                 fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                signal.alarm(0)  # locked: the timeout is only for waiting
                 yield
             except IOError as e:
                 if e.errno != errno.EINTR:
@@ -183,25 +294,78 @@ def flock_timeout(filename, seconds): # TODO: if this works, move to lib/
 
 def supervise_loop(app):
     """ Supervisor main loop which performs background actions
+
+    Every cycle starts when the API sends a wake-up, or when the poll interval passes.
+    The poll interval adapts: it's the shortest right after a cycle that had work, and doubles while idle.
+
     :param app: Application
     :type app: OvercApplication
     """
-    db_engine = init_db_engine(app.app.config['DATABASE'])
+    config = app.app.config
+    db_engine = init_db_engine(config['DATABASE'], config, 'supervisor')
     Session = init_db_session(db_engine)
 
     lockfile = os.path.join(tempfile.gettempdir(), 'overc.lock')
 
-    while True:
-        sleep(3)
+    rollup_interval = float(config['ROLLUP_INTERVAL'])
+    next_rollup = 0
+    retention_interval = float(config['RETENTION_INTERVAL'])
+    next_retention = 0
+    time_budget = float(config['SUPERVISOR_TIME_BUDGET']) if config.get('SUPERVISOR_TIME_BUDGET') else None
+
+    # Wake-ups from the API
+    poll_min, poll_max = float(config['SUPERVISOR_POLL_MIN']), float(config['SUPERVISOR_POLL_MAX'])
+    poll_interval = poll_min
+    listener = None
+    if config.get('SUPERVISOR_WAKEUP'):
+        try:
+            listener = WakeupListener(config['SUPERVISOR_WAKEUP'])
+        except socket.error as e:
+            logger.warning('Supervisor wake-ups disabled: {}: {}'.format(config['SUPERVISOR_WAKEUP'], e))
 
-        # Locking
-        with flock_timeout(lockfile, seconds=2):
-            # Supervise
-            ssn = Session()
-            try:
-                # TODO: receive notifications from the API for immediate supervision
-                supervise_once(app, ssn)
-            except Exception:
-                logger.exception('Supervise loop error')
-            finally:
-                Session.remove()
+    try:
+        while True:
+            if listener is not None:
+                woken = listener.wait(poll_interval)
+            else:
+                sleep(poll_interval)
+                woken = False
+
+            # Locking
+            with flock_timeout(lockfile, seconds=2):
+                # Supervise
+                ssn = Session()
+                try:
+                    new_alerts, sent_alerts = supervise_once(app, ssn)
+
+                    # Poll often while there's work (or a backlog left by the time budgets), back off when idle
+                    if woken or new_alerts or sent_alerts or has_backlog(ssn):
+                        poll_interval = poll_min
+                    else:
+                        poll_interval = min(poll_interval * 2, poll_max)
+
+                    # Rollups: not that often, within the time budget. When it's used up, the rest is done on the next cycle
+                    if time() >= next_rollup:
+                        started = time()
+                        rollup_once(app, ssn, time_budget=time_budget)
+                        if time_budget is None or time() - started < time_budget:
+                            next_rollup = time() + rollup_interval
+
+                        # Report pool usage as well
+                        if hasattr(db_engine.pool, 'stats'):
+                            logger.info('Database pool: {}'.format(db_engine.pool.stats))
+
+                    # Retention: within the time budget. When it's used up, the rest is pruned on the next cycle
+                    if config['RETENTION'] and time() >= next_retention:
+                        started = time()
+                        prune(app, ssn, time_budget=time_budget)
+                        if time_budget is None or time() - started < time_budget:
+                            next_retention = time() + retention_interval
+                except Exception:
+                    logger.exception('Supervise loop error')
+                    ssn.rollback()
+                finally:
+                    Session.remove()
+    finally:
+        if listener is not None:
+            listener.close()
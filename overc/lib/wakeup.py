@@ -0,0 +1,122 @@
+""" Supervisor wake-ups
+
+The API signals the supervisor after it commits new states or alerts: a datagram to a local Unix socket.
+The supervisor waits on the socket between its cycles, so it checks them right away.
+
+Wake-ups are best-effort: when the supervisor is not listening, or runs on another host,
+it finds the new states with its regular poll.
+"""
+
+import os
+import errno
+import socket
+import select
+import tempfile
+from hashlib import sha1
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+def default_path(instance_path, database):
+    """ Get the default socket path of an instance: unique per instance & database,
+    so instances on a single host do not collide
+    :param instance_path: Application instance path
+    :type instance_path: str
+    :param database: Database URL
+    :type database: str
+    :rtype: str
+    """
+    key = sha1('{}\n{}'.format(instance_path, database)).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), 'overc-supervisor-{}.sock'.format(key))
+
+
+class WakeupSender(object):
+    """ Sends wake-ups to the supervisor. Thread-safe. """
+
+    def __init__(self, path):
+        """ Init the sender
+        :param path: Supervisor socket path
+        :type path: str
+        """
+        self.path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+
+    def send(self):
+        """ Wake the supervisor up. Never fails """
+        try:
+            self._sock.sendto('!', self.path)
+        except socket.error as e:
+            # No supervisor (ENOENT, ECONNREFUSED), or it has plenty of wake-ups queued already (EAGAIN)
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN):
+                logger.warning('Failed to wake the supervisor up: {}'.format(e))
+
+
+class WakeupListener(object):
+    """ Receives wake-ups: the supervisor side """
+
+    def __init__(self, path):
+        """ Bind the socket. A stale socket file is replaced
+        :param path: Socket path
+        :type path: str
+        :exception socket.error: Another process is listening already
+        """
+        self.path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self._sock.bind(path)
+        except socket.error as e:
+            if e.errno != errno.EADDRINUSE or self._is_alive(path):
+                self._sock.close()
+                raise
+            os.unlink(path)
+            self._sock.bind(path)
+        self._sock.setblocking(False)
+
+    @staticmethod
+    def _is_alive(path):
+        """ Is someone listening on the socket?
+        :rtype: bool
+        """
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            probe.connect(path)
+            return True
+        except socket.error:
+            return False
+        finally:
+            probe.close()
+
+    def wait(self, timeout):
+        """ Wait for a wake-up. All the queued ones are consumed
+        :param timeout: The maximum time to wait, seconds
+        :type timeout: float
+        :return: Whether woken up
+        :rtype: bool
+        """
+        try:
+            ready = select.select([self._sock], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if not ready:
+            return False
+
+        # Drain
+        while True:
+            try:
+                self._sock.recv(16)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                raise
+
+    def close(self):
+        """ Close the socket, remove the file """
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -1,16 +1,22 @@
-from datetime import datetime
 from logging import getLogger
 
-from flask import Blueprint
+from flask import Blueprint, json
 from flask.globals import g, request
 from werkzeug.exceptions import Forbidden
 
-from overc.lib.db import models
+from overc.lib import ingest
+from overc.lib.ratelimit import RateLimited
 from overc.lib.flask.json import jsonapi
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 logger = getLogger(__name__)
 
+#: /api/set/stream: the maximum size of a single line, bytes
+STREAM_MAX_LINE_SIZE = 1024 * 1024
+
+#: /api/set/stream: the maximum number of errors listed; the rest are only counted
+STREAM_MAX_ERRORS = 100
+
 
 def _identify_server(ssn, server_spec):
     """ Identity the server, create if missing
@@ -22,59 +28,116 @@ def _identify_server(ssn, server_spec):
     :exception AssertionError: Validation error
     :exception Forbidden: Invalid server key
     """
+    return ingest.identify_server(ssn, server_spec, request.remote_addr, g.app.server_cache)
+
+
+def _authenticate_cached(server_spec):
+    """ Authenticate a server known to the cache, and take a token from its bucket
+
+    Buckets are only charged for authenticated servers: otherwise, anyone could drain a server's bucket.
+    Servers missing from the cache are charged with `_admit()` once identified.
+
+    :param server_spec: Server identification dictionary: {name: String, key: String}
+    :type server_spec: dict
+    :returns: Whether the server is known to the cache, and was charged
+    :rtype: bool
+    :exception AssertionError: Validation error
+    :exception Forbidden: Invalid server key
+    :exception RateLimited: The server has exceeded its rate limit
+    """
+    if not ingest.check_server_key_cached(g.app.server_cache, server_spec):
+        return False
+    _admit(server_spec['name'])
+    return True
+
+
+def _admit(server_name):
+    """ Per-server admission control: take a token from the bucket of an authenticated server
+    :param server_name: Server name
+    :type server_name: str
+    :exception RateLimited: The server has exceeded its rate limit
+    """
+    if g.app.rate_limiter is not None:
+        g.app.rate_limiter.check(server_name)
 
-    # Input validation: server
-    assert isinstance(server_spec, dict), 'Data: "server" should be a dict'
-    assert 'name' in server_spec and isinstance(server_spec['name'], basestring), 'Data: "server.name" should be a string'
-    assert 'key'  in server_spec and isinstance(server_spec['key'],  basestring), 'Data: "server.key" should be a string'
-
-    # Identify server or create
-    server = ssn.query(models.Server).filter(models.Server.name == server_spec['name']).first()
-    if server is not None:
-        # Check key
-        key_ok = server.key != server_spec['key']
-        if key_ok:
-            logger.warning(u'Invalid server key supplied: name="{name}", key="{key}"'.format(**server_spec))
-            raise Forbidden('Invalid server key')
-    else:
-        # Create
-        server = models.Server(
-            name=server_spec['name'],
-            title=unicode(server_spec['name']),
-            key=server_spec['key']
-        )
-        logger.info(u'Created new Server(name="{name}")'.format(**server_spec))
-
-    # Update IP
-    server.ip = request.remote_addr
-
-    # Finish
-    logger.debug(u'Identified server by name="{name}", id={id}'.format(id=server.id or '<new server>', **server_spec))
-    return server
-
-
-def _identify_service(ssn, server, service_name):
-    """ Identify the service, create if missing
+
+def _set_report(ssn, report, identified, spooled):
+    """ Store a single report of a batch: services' status and/or alerts. Does not commit.
     :param ssn: Database session
     :type ssn: sqlalchemy.orm.session.Session
-    :param server: Server to lookup the service at
-    :type server: models.Server
-    :param service_name: Service name on the server
-    :type service_name: str
-    :rtype: models.Service
+    :param report: Input report: {server, period?, services?, alerts?}
+    :type report: dict
+    :param identified: Servers already identified within this transaction: { name: Server }. Updated in-place.
+    :type identified: dict
+    :param spooled: Spool mode: the reports to spool: [ (method, remote_addr, data) ]. Updated in-place.
+    :type spooled: list
+    :return: Result: `{ok: 1}`, or `{error: String, code: Number, retry_after: Number?}`
+    :rtype: dict
+    """
+    try:
+        ingest.validate_report(report)
+        admitted = _authenticate_cached(report['server'])
+        if g.app.spool is not None:
+            spooled.append(('report', request.remote_addr, report))
+        else:
+            server = ingest.identify_server(ssn, report['server'], request.remote_addr, g.app.server_cache, identified)
+            if not admitted:
+                _admit(server.name)
+            ssn.add(server)
+            ingest.set_report(ssn, server, report, **ingest.options(g.app.app.config))
+    except AssertionError as e:
+        return {'error': e.message, 'code': 400}
+    except Forbidden as e:
+        return {'error': e.description, 'code': e.code}
+    except RateLimited as e:
+        return {'error': e.description, 'code': e.code, 'retry_after': e.retry_after}
+    return {'ok': 1}
+
+
+def _wake_supervisor():
+    """ Let the supervisor check the new states & alerts right away """
+    if g.app.wakeup is not None:
+        g.app.wakeup.send()
+
+
+def _ndjson_lines(stream, max_size):
+    """ Read lines from a stream, one at a time
+    :param stream: Input stream
+    :type stream: file
+    :param max_size: The maximum line size, bytes
+    :type max_size: int
+    :return: Iterator of (line number, line). Lines longer than `max_size` are skipped and give `None`.
+    :rtype: collections.Iterator[(int, str|None)]
+    """
+    lineno = 0
+    while True:
+        line = stream.readline(max_size + 1)
+        if not line:
+            return
+        lineno += 1
+
+        # Too long: skip the rest of it
+        if len(line) > max_size and not line.endswith(b'\n'):
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_size)
+            yield lineno, None
+            continue
+
+        yield lineno, line
+
+
+def _spool(method, data):
+    """ Put a validated report into the ingestion spool
+
+    Known servers are authenticated & rate-limited beforehand: see `_authenticate_cached()`.
+    The others are authenticated by the spool writer.
+
+    :param method: API method name
+    :type method: str
+    :param data: Validated input
+    :type data: dict
     """
-    service = ssn.query(models.Service).filter(
-        models.Service.server == server,
-        models.Service.name == service_name
-    ).first()
-    if service is None:
-        service = models.Service(
-            server=server,
-            name=service_name,
-            title=unicode(service_name)
-        )
-        logger.info(u'Created new Service(name="{name}", server="{server}")'.format(name=service.name, server=server.name))
-    return service
+    g.app.spool.append(method, request.remote_addr, data)
 
 
 @bp.route('/ping', methods=['POST'])
@@ -90,13 +153,15 @@ def ping():
 
     # Input validation
     data = request.get_json()
-    assert isinstance(data, dict), 'Invalid data: should be JSON object'
-    assert 'server' in data, 'Data: "server" key is missing'
+    ingest.validate_ping(data)
 
     # Identify server (will raise exception if not fine)
     server = _identify_server(ssn, data['server'])
     ssn.add(server)
-    ssn.commit()
+
+    # Save: only when something has changed (new server, new IP)
+    if ssn.new or ssn.dirty:
+        ssn.commit()
 
     return {'pong': 1}
 
@@ -107,72 +172,37 @@ def set_service_status():
     """ Receive single service status
 
         Status codes:
+            202 accepted into the spool
             400 invalid input
             403 invalid server key
+            429 rate limit exceeded: see the `Retry-After` header
     """
     ssn = g.db
 
     # Input validation
     data = request.get_json()
-    assert isinstance(data, dict), 'Invalid data: should be JSON object'
-    assert 'server' in data, 'Data: "server" key is missing'
-    assert 'period' in data, 'Data: "period" key is missing'
-    assert 'services' in data, 'Data: "services" key is missing'
+    ingest.validate_service_status(data)
 
-    # Input validation: period
-    try:
-        data['period'] = int(data['period'])
-    except ValueError:
-        raise AssertionError('Data: "period" should be an integer')
-
-    # Input validation: services
-    assert isinstance(data['services'], list), 'Data: "services" should be a list'
-    assert all(
-        isinstance(s, dict) and
-        'name' in s and isinstance(s['name'], basestring) and
-        'state' in s and isinstance(s['state'], basestring) and
-        ('info' not in s or isinstance(s['info'], basestring))
-        for s in data['services']
-    ), 'Data: "services" should be a list of objects with keys "name", "state", "info"?, "period"?'
-
-    # Identify server
+    # Authenticate & rate limit: known servers
+    admitted = _authenticate_cached(data['server'])
+
+    # Spool mode
+    if g.app.spool is not None:
+        _spool('service/status', data)
+        return {'ok': 1}, 202
+
+    # Identify server, rate limit
     server = _identify_server(ssn, data['server'])
+    if not admitted:
+        _admit(server.name)
     ssn.add(server)
 
-    # Services
-    services_cache = {}
-    for s in data['services']:
-        # Identify service
-        try:
-            service = services_cache[s['name']]
-        except KeyError:
-            service = _identify_service(ssn, server, s['name'])
-            services_cache[service.name] = service
-        ssn.add(service)
-
-        # Update period
-        try:
-            service_period = int(s['period'])
-        except (KeyError, ValueError):
-            service_period = data['period']
-
-        service.period = service_period
-
-        # State
-        if not models.state_t.is_valid(s['state']):
-            s['info'] += u' (sent unsupported state: "{}")'.format(s['state'])
-            s['state'] = 'UNK'
-        state = models.ServiceState(
-            service=service,
-            rtime=datetime.utcnow(),
-            state=s['state'],
-            info=s['info']
-        )
-        ssn.add(state)
-        logger.debug(u'Service {server}:`{name}` state update: {state}: {info}'.format(server=server.name, **s))
+    # Services & states
+    ingest.set_service_status(ssn, server, data, **ingest.options(g.app.app.config))
 
     # Save
     ssn.commit()
+    _wake_supervisor()
 
     return {'ok': 1}
 
@@ -183,57 +213,148 @@ def set_alerts():
     """ Receive custom alerts
 
         Status codes:
+            202 accepted into the spool
             400 invalid input
             403 invalid server key
+            429 rate limit exceeded: see the `Retry-After` header
     """
     ssn = g.db
 
     # Input validation
     data = request.get_json()
-    assert isinstance(data, dict), 'Invalid data: should be JSON object'
-    assert 'server' in data, 'Data: "server" key is missing'
-    assert 'alerts' in data, 'Data: "alerts" key is missing'
-
-    # Input validation: alerts
-    assert isinstance(data['alerts'], list), 'Data: "alerts" should be a list'
-    assert all(
-        isinstance(s, dict) and
-        'message' in s and isinstance(s['message'], basestring) and
-        ('service' not in s or isinstance(s['service'], basestring)) and
-        set(s.keys()) <= {'title', 'message', 'service'}
-        for s in data['alerts']
-    ), 'Data: "alerts" should be a list of objects with keys "title", "message"?, "service"?'
-
-    # Identify server
+    ingest.validate_alerts(data)
+
+    # Authenticate & rate limit: known servers
+    admitted = _authenticate_cached(data['server'])
+
+    # Spool mode
+    if g.app.spool is not None:
+        _spool('alerts', data)
+        return {'ok': 1}, 202
+
+    # Identify server, rate limit
     server = _identify_server(ssn, data['server'])
+    if not admitted:
+        _admit(server.name)
     ssn.add(server)
 
     # Alerts
-    services_cache = {}
-    for a in data['alerts']:
-        # Identify service (if any)
-        service = None
-        if 'service' in a:
-            try:
-                service = services_cache[a['service']]
-            except KeyError:
-                service = _identify_service(ssn, server, a['service'])
-                services_cache[service.name] = service
-                ssn.add(service)
-
-        # Raise
-        alert = models.Alert(
-            server=server,
-            service=service,
-            ctime=datetime.utcnow(),
-            channel='api',
-            event='alert',
-            message=unicode(a['message'])
-        )
-        ssn.add(alert)
-        logger.debug(u'Alert reported for {server}:`{service}`: {message}'.format(server=server.name, service=service.name if service else '-', message=a['message']))
+    ingest.set_alerts(ssn, server, data)
 
     # Save
     ssn.commit()
+    _wake_supervisor()
 
     return {'ok': 1}
+
+
+@bp.route('/set/batch', methods=['POST'])
+@jsonapi
+def set_batch():
+    """ Receive reports from many servers at once: services' status and/or alerts
+
+        Every report is authenticated & rate-limited on its own, and gets a result of its own:
+        `{ok: 1}`, `{error: String, code: 400|403}`, or `{error: String, code: 429, retry_after: Number}`.
+        Accepted reports are saved in a single transaction.
+
+        Status codes:
+            202 accepted into the spool
+            400 invalid input
+    """
+    ssn = g.db
+
+    # Input validation
+    data = request.get_json()
+    assert isinstance(data, dict), 'Invalid data: should be JSON object'
+    assert 'reports' in data, 'Data: "reports" key is missing'
+    assert isinstance(data['reports'], list), 'Data: "reports" should be a list'
+
+    # Reports
+    identified, spooled = {}, []
+    results = [_set_report(ssn, report, identified, spooled) for report in data['reports']]
+
+    # Spool mode
+    if g.app.spool is not None:
+        g.app.spool.extend(spooled)
+        return {'results': results}, 202
+
+    # Save
+    ssn.commit()
+    _wake_supervisor()
+
+    return {'results': results}
+
+
+@bp.route('/set/stream', methods=['POST'])
+@jsonapi
+def set_stream():
+    """ Receive a stream of reports: NDJSON, one report per line
+
+        Every line is a report, just like in /api/set/batch.
+        The body is read line by line, and the reports are saved in chunks of `STREAM_CHUNK_SIZE`,
+        so memory use does not depend on the body size.
+
+        Every line that's not accepted gets an error of its own, up to `STREAM_MAX_ERRORS`; the rest are counted:
+        `{ok: Number, errors: [ {line: Number, error: String, code: 400|403|413|429, retry_after: Number?}, ... ], errors_omitted: Number}`.
+        Empty lines are ignored.
+
+        Status codes:
+            202 accepted into the spool
+    """
+    ssn = g.db
+    chunk_size = int(g.app.app.config.get('STREAM_CHUNK_SIZE', 500))
+
+    def save(spooled):
+        """ Save a chunk """
+        if g.app.spool is not None:
+            if spooled:
+                g.app.spool.extend(spooled)
+        else:
+            ssn.commit()
+            _wake_supervisor()
+
+    # Errors: the first ones are listed, so the response size does not depend on the body size either
+    errors, omitted = [], [0]
+
+    def error(e):
+        """ Report an error of a line """
+        if len(errors) < STREAM_MAX_ERRORS:
+            errors.append(e)
+        else:
+            omitted[0] += 1
+
+    # Reports
+    ok = 0
+    identified, spooled, n = {}, [], 0
+    for lineno, line in _ndjson_lines(request.stream, STREAM_MAX_LINE_SIZE):
+        # Parse
+        if line is None:
+            error({'line': lineno, 'error': 'Line is too long', 'code': 413})
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            report = json.loads(line)
+        except ValueError as e:
+            error({'line': lineno, 'error': 'Invalid JSON: {}'.format(e), 'code': 400})
+            continue
+
+        # Ingest
+        result = _set_report(ssn, report, identified, spooled)
+        if 'error' in result:
+            result['line'] = lineno
+            error(result)
+        else:
+            ok += 1
+
+        # Save the chunk
+        n += 1
+        if n >= chunk_size:
+            save(spooled)
+            identified, spooled, n = {}, [], 0
+
+    # Save the rest
+    save(spooled)
+
+    return {'ok': ok, 'errors': errors, 'errors_omitted': omitted[0]}, 202 if g.app.spool is not None else 200
@@ -1,7 +1,8 @@
+import os
 from datetime import datetime, timedelta
 from logging import getLogger
 from collections import defaultdict
-from sqlalchemy.orm import contains_eager, joinedload
+from sqlalchemy.orm import contains_eager
 
 from sqlalchemy.sql import func
 from flask import Blueprint
@@ -10,6 +11,7 @@ from flask.globals import g, request
 
 from overc import __version__
 from overc.lib.db import models
+from overc.lib import rollup
 from overc.lib.flask.json import jsonapi
 
 bp = Blueprint('ui', __name__, url_prefix='/ui', template_folder='templates',
@@ -35,12 +37,12 @@ def index():
 @jsonapi
 def api_status(server_id=None, service_id=None):
     """ Get all available information """
-    ssn = g.db
+    ssn = g.db_read
 
     # Filter servers
     servers = ssn.query(models.Server) \
         .join(models.Server.services) \
-        .options(contains_eager(models.Server.services)) \
+        .options(contains_eager(models.Server.services).joinedload(models.Service.state)) \
         .filter(
             models.Server.id == server_id   if server_id  else True,
             models.Service.id == service_id if service_id else True
@@ -51,7 +53,7 @@ def api_status(server_id=None, service_id=None):
     alert_counts = ssn.query(
         models.Alert.server_id,
         models.Alert.service_id,
-        func.count(models.Alert)
+        func.count(models.Alert.id)
     ) \
         .filter(
             models.Alert.ctime >= (datetime.utcnow() - timedelta(hours=24)),
@@ -110,8 +112,8 @@ def api_status(server_id=None, service_id=None):
                         'state': {
                             'rtime': service.state.rtime.isoformat(sep=' '),
                             'timed_out': service.timed_out,
-                            'seen_ago': str(datetime.utcnow() - service.state.rtime).split('.')[0],
-                            'state': service.state.state,
+                            'seen_ago': str(datetime.utcnow() - service.state.seen).split('.')[0],
+                            'state': service.state.state.name,
                             'info': service.state.info,
                         } if service.state else None
                     } for service in server.services
@@ -125,19 +127,14 @@ def api_status(server_id=None, service_id=None):
 @jsonapi
 def api_status_service_states(service_id):
     """ Service states for 24h """
-    ssn = g.db
+    ssn = g.db_read
 
     dtime = timedelta(hours=float(request.args.get('hours', default=24)))
+    since = datetime.utcnow() - dtime
 
     # Load states & alerts
-    states = ssn.query(models.ServiceState) \
-        .options(joinedload(models.ServiceState.alerts)) \
-        .filter(
-            models.ServiceState.rtime >= (datetime.utcnow() - dtime),
-            models.ServiceState.service_id == service_id
-        ) \
-        .order_by(models.ServiceState.id.desc()) \
-        .all()
+    service = ssn.query(models.Service).get(service_id)
+    states = g.app.history.read(ssn, service_id, since)
 
     # Collapse
     groups = request.args.get('groups', default=False)
@@ -193,7 +190,7 @@ def api_status_service_states(service_id):
             # Replace with group
             states[grp[0] : grp[1]+1] = [ {
                                               'id': ss[0].id,  # Just for Angular
-                                              'state': ss[0].state,
+                                              'state': ss[0].state.name,
                                               'group': '-'.join(map(str, ss_ids)),
                                               'group_count': grp[1] - grp[0] + 1
                                           } ]
@@ -203,7 +200,9 @@ def api_status_service_states(service_id):
             {
                 'id': state.id,
                 'rtime': state.rtime.isoformat(sep=' '),
-                'state': state.state,
+                'last_seen': state.seen.isoformat(sep=' '),
+                'repeat_count': state.repeat_count,
+                'state': state.state.name,
                 'info': state.info,
 
                 'alerts': [ {
@@ -211,23 +210,57 @@ def api_status_service_states(service_id):
                         'channel': alert.channel,
                         'event': alert.event,
                         'message': alert.message,
-                        'severity': models.state_t.states[alert.severity]
+                        'severity': models.state_t(alert.severity).name
                     } for alert in state.alerts ],
-                'service': unicode(state.service),
+                'service': unicode(service),
                 'service_id': state.service_id,
-            } if isinstance(state, models.ServiceState) else state  # Groups :)
+            } if not isinstance(state, dict) else state  # Groups :)
             for state in states
         ]
     }
 
 
+@bp.route('/api/status/service/<int:service_id>/history')
+@jsonapi
+def api_status_service_history(service_id):
+    """ Service state history, aggregated by hour or by day, for 7 days
+
+    Reads the rollups, so it stays fast for long periods.
+    The resolution defaults to hours for up to 31 days, days otherwise.
+    """
+    ssn = g.db_read
+
+    hours = float(request.args.get('hours', default=24*7))
+    resolution = request.args.get('resolution', default='hour' if hours <= 31*24 else 'day')
+    assert resolution in ('hour', 'day'), 'Resolution should be either "hour" or "day"'
+
+    now = datetime.utcnow()
+    buckets = rollup.service_history(ssn, service_id, now - timedelta(hours=hours), now, resolution)
+
+    # Format
+    return {
+        'resolution': resolution,
+        'history': [
+            {
+                'period': b['period'].isoformat(sep=' '),
+                'counts': {'OK': b['n_ok'], 'WARN': b['n_warn'], 'FAIL': b['n_fail'], 'UNK': b['n_unk']},
+                'n_states': b['n_states'],
+                'transitions': b['transitions'],
+                'first_rtime': b['first_rtime'].isoformat(sep=' '),
+                'last_seen': b['last_seen'].isoformat(sep=' '),
+            }
+            for b in buckets
+        ]
+    }
+
+
 @bp.route('/api/status/alerts/')
 @bp.route('/api/status/alerts/server/<int:server_id>')
 @bp.route('/api/status/alerts/service/<int:service_id>')
 @jsonapi
 def api_status_alerts(server_id=None, service_id=None):
     """ Alerts for 24h """
-    ssn = g.db
+    ssn = g.db_read
 
     dtime = timedelta(hours=float(request.args.get('hours', default=24)))
 
@@ -261,6 +294,23 @@ def api_status_alerts(server_id=None, service_id=None):
         ]
     }
 
+@bp.route('/api/status/db')
+@jsonapi
+def api_status_db():
+    """ Database connection pool usage of this worker process: primary, read replica (if any) """
+    def pool_stats(engine):
+        stats = getattr(engine.pool, 'stats', None)
+        if stats is None:
+            return None
+        return dict(stats.as_dict(), size=engine.pool.size(), overflow=engine.pool.overflow())
+
+    # Format
+    return {
+        'pid': os.getpid(),
+        'pool': pool_stats(g.app.db_engine),
+        'read_pool': pool_stats(g.app.db_read_engine) if g.app.db_read_engine is not g.app.db_engine else None,
+    }
+
 #region Items
 
 @bp.route('/api/item/server/<int:server_id>', methods=['DELETE'])
@@ -270,9 +320,13 @@ def api_server_delete(server_id):
     ssn = g.db
 
     server = ssn.query(models.Server).get(server_id)
+    server_name = server.name
     ssn.delete(server)
     ssn.commit()
 
+    # Forget the identity
+    g.app.server_cache.pop(server_name)
+
     return {'ok': 1}
 
 
@@ -60,6 +60,10 @@
                     templateUrl: 'ctrl/states.htm',
                     controller: 'statesCtrl'
                 },
+                history: {
+                    templateUrl: 'ctrl/history.htm',
+                    controller: 'historyCtrl'
+                },
                 alerts: {
                     templateUrl: 'ctrl/alerts.htm',
                     controller: 'alertsCtrl'
@@ -173,6 +177,9 @@
             service_states: $resource('api/status/service/:service_id/states', {service_id: undefined}, {
                     get: { method: 'GET', params: { hours: 24, groups: undefined, expand: [] } }
                 }),
+            service_history: $resource('api/status/service/:service_id/history', {service_id: undefined}, {
+                    get: { method: 'GET', params: { hours: 24*7 } }
+                }),
 
             alerts: {
                 all: $resource('api/status/alerts/', {}, {
@@ -333,11 +340,6 @@
          * @type {Object}
          */
         $scope.sets = {
-            /** States load period
-             * @type {Number}
-             */
-            hours: 24,
-
             /** List of groups to expand
              * @type {Array.<Number>}
              */
@@ -347,11 +349,6 @@
         /** Action handlers
          */
         $scope.actions = {
-            /** Load more alerts
-             */
-            load_more_states: function(){
-                $scope.sets.hours += 24;
-            },
             /** Expand a group
              * @param {String} group
              */
@@ -368,7 +365,6 @@
         var loadStates = function(){
             api.status.service_states.get({
                     service_id: $state.params.service_id,
-                    hours: $scope.sets.hours,
                     groups: 'yes',
                     expand: $scope.sets.expand
             }, function(res){
@@ -385,13 +381,61 @@
         };
 
         $scope.$on('update-states', _.debounce(loadStates, 100));
-        $scope.$watchCollection('sets.hours', function(val, oldVal){
+        $scope.$watchCollection('sets.expand', function(val, oldVal){
             if (val != oldVal)
                 loadStates();
         });
-        $scope.$watchCollection('sets.expand', function(val, oldVal){
+    }]);
+
+
+
+    /** Service History controller: aggregated from the rollups
+     */
+    overcApplication.controller('historyCtrl', ['$scope', '$state', 'api', 'X', function($scope, $state, api, X){
+        /** Settings
+         * @type {Object}
+         */
+        $scope.sets = {
+            /** History load period
+             * @type {Number}
+             */
+            hours: 24*7
+        };
+
+        /** Action handlers
+         */
+        $scope.actions = {
+            /** Load more history
+             */
+            load_more_history: function(){
+                $scope.sets.hours += 24*7;
+            }
+        };
+
+        /** History: periods, newest first
+         * @type {Array}
+         */
+        $scope.history = [];
+
+        /** History resolution: 'hour', 'day'
+         * @type {String}
+         */
+        $scope.resolution = undefined;
+
+        var loadHistory = function(){
+            api.status.service_history.get({
+                    service_id: $state.params.service_id,
+                    hours: $scope.sets.hours
+            }, function(res){
+                $scope.resolution = res.resolution;
+                $scope.history = res.history.reverse();
+            });
+        };
+
+        $scope.$on('update-states', _.debounce(loadHistory, 100));
+        $scope.$watch('sets.hours', function(val, oldVal){
             if (val != oldVal)
-                loadStates();
+                loadHistory();
         });
     }]);
 
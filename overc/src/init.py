@@ -1,43 +1,191 @@
-from sqlalchemy import create_engine
+from logging import getLogger
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-def init_db_engine(connect):
+from overc.lib.db.pool import TimedQueuePool
+
+logger = getLogger(__name__)
+
+#: Statement timeout, per dialect: SQL template, milliseconds
+STATEMENT_TIMEOUT_SQL = {
+    'mysql': 'SET SESSION max_execution_time={:d}',  # MySQL 5.7.8+: SELECT statements only
+    'postgresql': 'SET statement_timeout={:d}',
+}
+
+def db_pool_options(config, role='app'):
+    """ Get connection pool options for a process role
+    :param config: Application config: DATABASE_POOL, SUPERVISOR_DATABASE_POOL
+    :type config: dict
+    :param role: Process role: 'app', 'supervisor'
+    :type role: str
+    :return: {size, max_overflow, recycle, timeout, pre_ping, statement_timeout}
+    :rtype: dict
+    """
+    options = dict(config.get('DATABASE_POOL') or {})
+    if role == 'supervisor':
+        options.update(config.get('SUPERVISOR_DATABASE_POOL') or {})
+    return options
+
+def is_sqlite_file(connect):
+    """ Is it an SQLite database file? In-memory databases are not
+    :param connect: Database connection string
+    :type connect: str
+    :rtype: bool
+    """
+    url = make_url(connect)
+    return url.drivername.startswith('sqlite') and url.database not in (None, '', ':memory:')
+
+def init_db_engine(connect, config=None, role='app'):
     """ Init Sqlalchemy engine
+
+    The connection pool collects usage statistics: `engine.pool.stats`.
+    SQLite databases get the high-throughput profile: see init_sqlite_engine()
+
     :param connect: Database connection string
     :type connect: str
+    :param config: Application config: engine & pool options
+    :type config: dict|None
+    :param role: Engine role, for the pool options: 'app', 'supervisor', or 'read' for a read-only replica
+    :type role: str
     :rtype: sqlalchemy.engine.Engine
     """
-    return create_engine(connect, convert_unicode=True)
+    config = config or {}
+    if is_sqlite_file(connect):
+        return init_sqlite_engine(connect, config, read_only=role == 'read')
+    if make_url(connect).drivername.startswith('sqlite'):
+        return create_engine(connect, convert_unicode=True)
+
+    # Pool
+    pool = db_pool_options(config, role)
+    pool_args = {k: v for k, v in {
+        'pool_size': pool.get('size'),
+        'max_overflow': pool.get('max_overflow'),
+        'pool_recycle': pool.get('recycle'),
+        'pool_timeout': pool.get('timeout'),
+    }.items() if v is not None}
+    engine = create_engine(connect, convert_unicode=True, poolclass=TimedQueuePool, **pool_args)
+
+    # Pre-ping: test connections on checkout, replace the dead ones
+    if pool.get('pre_ping'):
+        @event.listens_for(engine, 'checkout')
+        def ping_connection(dbapi_connection, connection_record, connection_proxy):
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            except Exception:
+                # The pool retries with a new connection
+                raise DisconnectionError()
+            finally:
+                cursor.close()
+
+    # Statement timeout
+    if pool.get('statement_timeout'):
+        sql = STATEMENT_TIMEOUT_SQL.get(engine.dialect.name)
+        if sql is None:
+            logger.warning('Statement timeout is not supported for "{}": ignored'.format(engine.dialect.name))
+        else:
+            sql = sql.format(int(float(pool['statement_timeout']) * 1000))
+
+            @event.listens_for(engine, 'connect')
+            def set_statement_timeout(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute(sql)
+                cursor.close()
 
-def init_db_session(engine):
+    return engine
+
+def init_sqlite_engine(connect, config, read_only=False):
+    """ Init Sqlalchemy engine for an SQLite database file: the high-throughput profile
+
+    * WAL journal: readers do not block the writer, and vice versa;
+    * A single connection per process: writes from all threads go through it, and the page cache is kept;
+    * Transactions take the write lock upfront (`BEGIN IMMEDIATE`), so concurrent writers from other processes
+      wait for each other for up to `busy_timeout`, instead of failing with "database is locked";
+    * Foreign keys are enforced.
+
+    Read-only engines are for the reads that should neither wait for the writers nor hold the write lock:
+    deferred transactions (`BEGIN`), `query_only`, and a pool of `SQLITE_READ_POOL_SIZE` connections, since readers run concurrently.
+
+    :param connect: Database connection string
+    :type connect: str
+    :param config: Application config: SQLITE_BUSY_TIMEOUT, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE, SQLITE_READ_POOL_SIZE
+    :type config: dict
+    :param read_only: The engine is only used for reading
+    :type read_only: bool
+    :rtype: sqlalchemy.engine.Engine
+    """
+    busy_timeout = float(config.get('SQLITE_BUSY_TIMEOUT', 30))
+    pragmas = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous={}'.format(config.get('SQLITE_SYNCHRONOUS', 'NORMAL')),
+        'PRAGMA busy_timeout={:d}'.format(int(busy_timeout * 1000)),
+        'PRAGMA cache_size=-{:d}'.format(int(float(config.get('SQLITE_CACHE_SIZE', 64)) * 1024)),  # KiB
+        'PRAGMA foreign_keys=ON',
+    ) + (('PRAGMA query_only=ON',) if read_only else ())
+    pool_size = int(config.get('SQLITE_READ_POOL_SIZE', 4)) if read_only else 1
+
+    engine = create_engine(connect, convert_unicode=True,
+                           poolclass=TimedQueuePool, pool_size=pool_size, max_overflow=0, pool_timeout=busy_timeout,
+                           connect_args={'timeout': busy_timeout, 'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def sqlite_connect(dbapi_connection, connection_record):
+        # Disable pysqlite transaction handling: see sqlite_begin()
+        dbapi_connection.isolation_level = None
+        for pragma in pragmas:
+            dbapi_connection.execute(pragma)
+
+    @event.listens_for(engine, 'begin')
+    def sqlite_begin(conn):
+        # A deferred transaction that reads, then writes, fails when another process writes meanwhile
+        conn.connection.execute('BEGIN' if read_only else 'BEGIN IMMEDIATE')
+
+    return engine
+
+def init_db_session(engine, info=None):
     """ Init DB session
+
+    Tables are not created here: the schema version is checked, and `overc db upgrade` creates them.
+
     :param engine: Engine
     :type engine: sqlalchemy.engine.Engine
+    :param info: Initial `Session.info` for every session, e.g. the history backend
+    :type info: dict|None
     :rtype: sqlalchemy.orm.scoped_session
+    :exception overc.lib.db.schema.SchemaVersionError: The schema is missing or out of date
     """
-    Session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    Session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine, info=info))
 
     # Models
     from overc.lib.db.models import Base
+    from overc.lib.db import schema
     Base.query = Session.query_property()
-    Base.metadata.create_all(bind=engine)  # TODO: remove automatic table creation
+    schema.check(engine)
 
     return Session
 
 
-def init_db_session_for_flask(engine, app):
+def init_db_session_for_flask(engine, app, info=None):
     """ Init DB session for Flask app
     :param engine: Engine
     :type engine: sqlalchemy.engine.Engine
     :param app: Flask application
     :type app: Flask
+    :param info: Initial `Session.info`: see init_db_session()
+    :type info: dict|None
     :rtype: sqlalchemy.orm.session.scoped_session
     """
-    Session = init_db_session(engine)
+    Session = init_db_session(engine, info)
 
     # Tear-down
     @app.teardown_appcontext
     def shutdown_session(exception=None):
+        # Roll back explicitly on failure: listeners rely on `after_rollback`, which closing does not emit
+        if exception is not None:
+            Session.rollback()
         Session.remove()
 
     return Session
@@ -6,6 +6,7 @@ import multiprocessing
 
 from overc import OvercApplication
 from overc.lib.supervise import supervise_loop
+from overc.lib.spool import spool_writer_loop
 
 def init_application(app_config_file):
     """ Initialize application from config file path
@@ -30,6 +31,12 @@ def init_application(app_config_file):
     p.daemon = True
     p.start()
 
+    # Spool writer
+    if application.spool is not None:
+        p = multiprocessing.Process(name='spool-writer', target=spool_writer_loop, args=(application,))
+        p.daemon = True
+        p.start()
+
     # Finish
     return application
 
@@ -6,7 +6,7 @@ from ConfigParser import ConfigParser
 
 from . import __author__, __email__, __version__
 from .overclient import Overclient
-from .monitor import ServicesMonitor, Service
+from .monitor import ServicesMonitor, Service, StatusReporter
 
 logger = logging.getLogger(__name__)
 
@@ -49,7 +49,8 @@ def cmd_monitor(args, overc):
         overc = Overclient(
             ini.get('overc', 'server'),
             ini.get('overc', 'my-name'),
-            ini.get('overc', 'my-key')
+            ini.get('overc', 'my-key'),
+            compress_threshold=ini.getint('overc', 'compress-threshold') if ini.has_option('overc', 'compress-threshold') else None
         )
 
     # Parse config file
@@ -87,18 +88,22 @@ def _cmd_monitor_daemon(services, overc):
 
     # Init monitor
     monitor = ServicesMonitor(services)
+    reporter = StatusReporter(overc)
 
     while True:
-        # Determine sleep time
+        # Determine sleep time: the next check, or the pending report
         delay = monitor.sleep_time()
+        retry_in = reporter.retry_in()
+        if retry_in is not None:
+            delay = min(delay, retry_in)
         time.sleep(delay)
 
         # Check
         period, service_states = monitor.check()
 
-        # Report
+        # Report (or postpone, if the server asked to back off)
         try:
-            overc.set_service_status(period, service_states)
+            reporter.report(period, service_states)
         except Exception as e:
             logger.exception('Failed to report service status!')
             # proceed
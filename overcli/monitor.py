@@ -1,7 +1,10 @@
 import logging
 import subprocess, shlex
 import threading
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from .overclient import RetryLater
 
 logger = logging.getLogger(__name__)
 
@@ -188,3 +191,70 @@ class ServicesMonitor(object):
 
         # Report
         return int(period), service_states
+
+
+class StatusReporter(object):
+    """ Reports service states, honouring the server's backpressure
+
+    When the server asks to retry later, the states are kept: newer states of the same services
+    replace the pending ones, and everything is reported at once when the delay is over.
+    """
+
+    def __init__(self, overc):
+        """ Init the reporter
+        :param overc: API client
+        :type overc: Overclient
+        """
+        self.overc = overc
+
+        #: Pending service states: { name: state }
+        self.pending = OrderedDict()
+        self.period = 0
+
+        #: Do not report until
+        self.retry_at = None
+
+    def retry_in(self):
+        """ Determine how many seconds to wait before the pending states can be reported
+        :return: Delay, seconds, or `None` when nothing is pending
+        :rtype: float|None
+        """
+        if not self.pending:
+            return None
+        if self.retry_at is None:
+            return 0.0
+        return max((self.retry_at - datetime.utcnow()).total_seconds(), 0.0)
+
+    def report(self, period, service_states):
+        """ Report service states, or keep them for later
+        :param period: Promised reporting period
+        :type period: int
+        :param service_states: Service states to report
+        :type service_states: list[dict]
+        :return: Whether the states were reported
+        :rtype: bool
+        :exception urllib2.URLError: Connection errors (the states are dropped)
+        """
+        # Merge
+        for state in service_states:
+            self.pending.pop(state['name'], None)
+            self.pending[state['name']] = state
+        self.period = max(self.period, period)
+
+        # Not now
+        if self.retry_in() != 0.0:
+            return False
+
+        # Report
+        period, service_states = self.period, self.pending.values()
+        self.pending, self.period, self.retry_at = OrderedDict(), 0, None
+        try:
+            self.overc.set_service_status(period, service_states)
+        except RetryLater as e:
+            # Keep them
+            self.pending.update((state['name'], state) for state in service_states)
+            self.period = period
+            self.retry_at = datetime.utcnow() + timedelta(seconds=e.retry_after)
+            logger.warning(u'Server asked to retry in {}s: {} service states pending'.format(e.retry_after, len(self.pending)))
+            return False
+        return True
@@ -1,9 +1,25 @@
-import json, urlparse, urllib2, base64
+import json, urlparse, urllib2, base64, gzip
+from cStringIO import StringIO
+
+class RetryLater(Exception):
+    """ The server is overloaded, or the rate limit is exceeded: retry later """
+
+    def __init__(self, retry_after):
+        """ Init the error
+        :param retry_after: The number of seconds to wait before retrying
+        :type retry_after: int
+        """
+        super(RetryLater, self).__init__('Retry after {}s'.format(retry_after))
+        self.retry_after = retry_after
+
 
 class Overclient(object):
     """ OverC API client """
 
-    def __init__(self, url, server_name, server_key):
+    #: Retry delay when the server does not specify one, seconds
+    DEFAULT_RETRY_AFTER = 60
+
+    def __init__(self, url, server_name, server_key, compress_threshold=None):
         """ Initialize the client
         :param url: OverC server URL
         :type url: str
@@ -11,6 +27,8 @@ class Overclient(object):
         :type server_name: str
         :param server_key: Server identification: key
         :type server_key: str
+        :param compress_threshold: Compress request bodies larger than this size, bytes. `None` to disable.
+        :type compress_threshold: int|None
         """
         # Parse URL
         headers = {}
@@ -25,6 +43,7 @@ class Overclient(object):
         self._url = url
         self._headers = headers
         self._server_id = {'name': server_name, 'key': server_key}
+        self._compress_threshold = compress_threshold
 
     def _jsonpost(self, path, data=None):
         """ Execute an API method
@@ -35,23 +54,52 @@ class Overclient(object):
         :return: Response
         :rtype: dict
         :exception urllib2.URLError: Connection errors
+        :exception RetryLater: The server asked to retry later
         """
         # Prepare
         url = urlparse.urljoin(self._url, path)
         req = urllib2.Request(url)
+        req.add_header('Accept-Encoding', 'gzip')
+        body = None
         if data:
             req.add_header('Content-Type', 'application/json')
+            body = json.dumps(data)
+            if self._compress_threshold is not None and len(body) > self._compress_threshold:
+                req.add_header('Content-Encoding', 'gzip')
+                body = self._gzip(body)
         for name, value in self._headers.items():
             req.add_header(name, value)
 
         # Request
-        response = urllib2.urlopen(req, json.dumps(data) if data else None)
+        try:
+            response = urllib2.urlopen(req, body)
+        except urllib2.HTTPError as e:
+            if e.code in (429, 503):
+                try:
+                    retry_after = int(e.info().get('Retry-After'))
+                except (TypeError, ValueError):
+                    retry_after = self.DEFAULT_RETRY_AFTER
+                raise RetryLater(retry_after)
+            raise
 
         # Read
         res_str = response.read()
+        if response.info().get('Content-Encoding') == 'gzip':
+            res_str = gzip.GzipFile(fileobj=StringIO(res_str)).read()
         res = json.loads(res_str)
         return res
 
+    @staticmethod
+    def _gzip(data):
+        """ Compress data with gzip
+        :type data: str
+        :rtype: str
+        """
+        buf = StringIO()
+        with gzip.GzipFile(mode='wb', fileobj=buf) as f:
+            f.write(data)
+        return buf.getvalue()
+
     def ping(self):
         """ Test connection
         :exception urllib2.URLError: Connection errors
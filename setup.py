@@ -21,6 +21,7 @@ setup(
     entry_points={
         'console_scripts': [
             'overcli = overcli:main',
+            'overc = overc.commands:main',
         ]
     },
 
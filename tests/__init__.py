@@ -4,7 +4,8 @@ from flask.testing import FlaskClient
 from flask import request, json
 
 from overc import OvercApplication
-from overc.lib.db import models
+from overc.src.init import init_db_engine
+from overc.lib.db import models, schema
 
 
 
@@ -47,6 +48,12 @@ class ApplicationTest(object):
         app_config_file = 'tests/data/overc-server/server.ini'
         app_config = OvercApplication.loadConfigFile(app_config_file)
 
+        # Reset DB
+        db_engine = init_db_engine(app_config['DATABASE'], app_config)
+        models.Base.metadata.drop_all(bind=db_engine)
+        schema.upgrade(db_engine)
+        db_engine.dispose()
+
         # Init app
         self.instance_path = app_config['INSTANCE_PATH']
         self.app = OvercApplication(__name__, self.instance_path, app_config)
@@ -55,10 +62,6 @@ class ApplicationTest(object):
         # Customize
         self.app.app.test_client_class = CustomFlaskClient
 
-        # Reset DB
-        models.Base.metadata.drop_all(bind=self.app.db_engine)
-        models.Base.metadata.create_all(bind=self.app.db_engine)
-
     def tearDown(self):
         # Close & reset DB
         self.app.db.close()
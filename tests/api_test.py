@@ -1,14 +1,34 @@
 # -*- coding: utf-8 -*-
 
 from time import sleep
+import threading
+import socket
 import unittest
 import os
+import gzip
+import tempfile
+from cStringIO import StringIO
 from datetime import datetime
 
 from . import ApplicationTest
-from overc.lib.db import models
+from flask import json
+from freezegun import freeze_time
+from sqlalchemy import event, inspect
+from sqlalchemy.schema import MetaData, Table, Column, ForeignKey, UniqueConstraint, Index
+from sqlalchemy.sql.sqltypes import Boolean, Integer, BigInteger, String, Unicode, UnicodeText, DateTime, Enum
+
+from overc import OvercApplication
+from overc.src.init import init_db_engine
+from overc.lib.db import models, schema
 from overc.lib.alerts import AlertPlugin
-from overc.lib.supervise import supervise_once
+from overc.lib.supervise import supervise_once, _check_service_states, _send_pending_alerts
+from overc.lib.spool import Spool, drain_spool
+from overc.lib.cache import TTLCache
+from overc.lib.ratelimit import TokenBuckets
+from overc.lib.retention import prune
+from overc.lib.db.bulk import delete_id_ranges
+from overc.lib.wakeup import WakeupListener, default_path as wakeup_default_path
+from overc.lib.ingest import _match_service_names
 
 
 class ApiTest(ApplicationTest, unittest.TestCase):
@@ -47,8 +67,10 @@ class ApiTest(ApplicationTest, unittest.TestCase):
                 self.assertEqual(service.state.id, expected[i]['state']['id'])
                 self.assertEqual(service.state.checked, expected[i]['state']['checked'])
                 self.assertIsInstance(service.state.rtime, datetime)
-                self.assertEqual(service.state.state, expected[i]['state']['state'])
+                self.assertEqual(service.state.state, models.state_t(expected[i]['state']['state']))
                 self.assertEqual(service.state.info, expected[i]['state']['info'])
+                self.assertEqual((service.current_state_id, service.current_state, service.current_rtime),
+                                 (service.state.id, service.state.state, service.state.rtime))
 
     def assertAlerts(self, server, expected):
         """ Helper to test for server alerts """
@@ -66,6 +88,7 @@ class ApiTest(ApplicationTest, unittest.TestCase):
             self.assertEqual(alert.channel, expected[i]['channel'])
             self.assertEqual(alert.event, expected[i]['event'])
             self.assertEqual(alert.message, expected[i]['message'])
+            self.assertEqual(alert.severity, models.alert_severity(alert.channel, alert.event))
 
     def test_ping(self):
         """ Test /api/ping """
@@ -387,3 +410,883 @@ class ApiTest(ApplicationTest, unittest.TestCase):
             { 'name': u'сервис', 'state': u'ХОРОШО', 'info': u'Всё отлично' }
         ])
         self.assertEqual(rv.status_code, 200)
+
+    def test_spool(self):
+        """ Test ingestion through the spool """
+        fd, spool_file = tempfile.mkstemp(suffix='.spool')
+        os.close(fd)
+        try:
+            self.app.spool = Spool(spool_file)
+
+            # Reports are accepted, but not written
+            res, rv = self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+                dict(name='app', state='OK', info='up 30s'),
+            ])
+            self.assertEqual(rv.status_code, 202)
+            res, rv = self.send_alerts({'name': 'localhost', 'key': '1234'}, [
+                dict(message='Server lags', service='app'),
+            ])
+            self.assertEqual(rv.status_code, 202)
+            res, rv = self.send_alerts({'name': 'localhost', 'key': '____'}, [
+                dict(message='Not me'),
+            ])
+            self.assertEqual(rv.status_code, 202)  # not known yet: authenticated by the writer
+
+            # Validation still works
+            res, rv = self.send_service_status({'name': 'localhost'}, [])
+            self.assertEqual(rv.status_code, 400)
+
+            self.assertEqual(self.db.query(models.Server).count(), 0)
+            self.assertEqual(len(self.app.spool), 3)
+
+            # Survives a restart
+            self.app.spool = Spool(spool_file)
+            self.assertEqual(len(self.app.spool), 3)
+
+            # A report that fails to write
+            self.app.spool.append('service/status', '127.0.0.1', {'server': {'name': 'localhost', 'key': '1234'}, 'period': 60})
+
+            # Drain
+            server_cache = TTLCache(100, 60)
+            self.assertEqual(drain_spool(self.db, self.app.spool, 2, server_cache), 2)
+            self.assertEqual(drain_spool(self.db, self.app.spool, 2, server_cache), 2)  # invalid key: dropped; failed: dead
+            self.assertEqual(drain_spool(self.db, self.app.spool, 2, server_cache), 0)
+            self.assertEqual(len(self.app.spool), 0)
+            self.assertEqual([(id, method, error) for id, method, remote_addr, data, error in self.app.spool.dead()],
+                             [(4, 'service/status', "KeyError: 'services'")])
+
+            server = self.db.query(models.Server).filter(models.Server.id == 1).first()
+            self.assertServices(server, [
+                dict(id=1, period=60, name='app', title=u'app', state=dict(id=1, checked=False, state='OK', info='up 30s')),
+            ])
+            self.assertAlerts(server, [
+                dict(id=1, service_id=1, reported=False, channel='api', event='alert', message=u'Server lags'),
+            ])
+
+            # Now the server is known: invalid keys are rejected right away
+            res, rv = self.test_client.jsonapi('POST', '/api/ping', {'server': {'name': 'localhost', 'key': '1234'}})
+            res, rv = self.send_alerts({'name': 'localhost', 'key': '____'}, [
+                dict(message='Not me'),
+            ])
+            self.assertEqual(rv.status_code, 403)
+        finally:
+            self.app.spool = None
+            os.unlink(spool_file)
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(spool_file + suffix):
+                    os.unlink(spool_file + suffix)
+
+    def test_service_name_matching(self):
+        """ Test matching reported service names to the services a case-insensitive collation has found """
+        app, app_upper = models.Service(name='app'), models.Service(name='App')
+
+        # MySQL: 'App ' finds 'app'
+        self.assertEqual(_match_service_names(['app', 'App ', 'db'], [app]), {'app': app, 'App ': app})
+
+        # Exact matches are preferred
+        self.assertEqual(_match_service_names(['app', 'App'], [app_upper, app]), {'app': app, 'App': app_upper})
+
+    def test_batch(self):
+        """ Test /api/set/batch """
+        # Register a server
+        res, rv = self.test_client.jsonapi('POST', '/api/ping', {'server': {'name': 'b', 'key': '1234'}})
+        self.assertEqual(rv.status_code, 200)
+
+        # Report for many servers
+        res, rv = self.test_client.jsonapi('POST', '/api/set/batch', {'reports': [
+            {'server': {'name': 'a', 'key': '1234'}, 'period': 60, 'services': [
+                dict(name='app', state='OK', info='up 30s'),
+            ]},
+            {'server': {'name': 'b', 'key': '____'}, 'alerts': [  # invalid key
+                dict(message='Not me'),
+            ]},
+            {'server': {'name': 'b', 'key': '1234'}, 'period': 30, 'services': [
+                dict(name='db', state='WARN', info='slow'),
+            ], 'alerts': [
+                dict(message='Disk full', service='db'),
+            ]},
+            {'server': {'name': 'a', 'key': '1234'}, 'alerts': [  # the same server again
+                dict(message='Server lags'),
+            ]},
+            {'server': {'name': 'c', 'key': '1234'}},  # nothing to report
+        ]})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(res['results'], [
+            {'ok': 1},
+            {'error': 'Invalid server key', 'code': 403},
+            {'ok': 1},
+            {'ok': 1},
+            {'error': 'Data: either "services" or "alerts" key is required', 'code': 400},
+        ])
+
+        # Check
+        self.assertEqual(self.db.query(models.Server).count(), 2)
+        server = self.db.query(models.Server).filter(models.Server.name == 'a').first()
+        self.assertServices(server, [
+            dict(id=1, period=60, name='app', title=u'app', state=dict(id=1, checked=False, state='OK', info='up 30s')),
+        ])
+        self.assertAlerts(server, [
+            dict(id=2, service_id=None, reported=False, channel='api', event='alert', message=u'Server lags'),
+        ])
+
+        server = self.db.query(models.Server).filter(models.Server.name == 'b').first()
+        self.assertServices(server, [
+            dict(id=2, period=30, name='db', title=u'db', state=dict(id=2, checked=False, state='WARN', info='slow')),
+        ])
+        self.assertAlerts(server, [
+            dict(id=1, service_id=2, reported=False, channel='api', event='alert', message=u'Disk full'),
+        ])
+
+        # Invalid input
+        res, rv = self.test_client.jsonapi('POST', '/api/set/batch', {'reports': {}})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_gzip(self):
+        """ Test compressed request & response bodies """
+        def gzip_str(data):
+            buf = StringIO()
+            with gzip.GzipFile(mode='wb', fileobj=buf) as f:
+                f.write(data)
+            return buf.getvalue()
+
+        # Compressed request
+        rv = self.test_client.post('/api/set/service/status', content_type='application/json', headers={'Content-Encoding': 'gzip'}, data=gzip_str(json.dumps({
+            'server': {'name': 'localhost', 'key': '1234'},
+            'period': 60,
+            'services': [dict(name='app{}'.format(i), state='OK', info='up 30s' * 100) for i in range(10)]
+        })))
+        self.assertEqual(rv.status_code, 200)
+
+        server = self.db.query(models.Server).filter(models.Server.id == 1).first()
+        self.assertEqual(len(server.services), 10)
+        self.assertEqual(server.services[0].state.info, 'up 30s' * 100)
+
+        # Broken request
+        rv = self.test_client.post('/api/ping', content_type='application/json', headers={'Content-Encoding': 'gzip'}, data='{}')
+        self.assertEqual(rv.status_code, 400)
+
+        # Decompressed size is limited, even with no MAX_CONTENT_LENGTH
+        self.app.app.config['GZIP_MAX_DECOMPRESSED_SIZE'] = 1024
+        rv = self.test_client.post('/api/ping', content_type='application/json', headers={'Content-Encoding': 'gzip'}, data=gzip_str(json.dumps({
+            'server': {'name': 'localhost', 'key': '1234'},
+            'padding': ' ' * 2048
+        })))
+        self.assertEqual(rv.status_code, 413)
+        self.app.app.config['GZIP_MAX_DECOMPRESSED_SIZE'] = 16 * 1024 * 1024
+
+        # Compressed response: only when accepted
+        rv = self.test_client.get('/ui/api/status/')
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotIn('Content-Encoding', rv.headers)
+
+        rv = self.test_client.get('/ui/api/status/', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        res = json.loads(gzip.GzipFile(fileobj=StringIO(rv.get_data())).read())
+        self.assertEqual(len(res['servers'][0]['services']), 10)
+
+        # Small responses are not compressed
+        res, rv = self.test_client.jsonapi('POST', '/api/ping', {'server': {'name': 'localhost', 'key': '1234'}}, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotIn('Content-Encoding', rv.headers)
+
+    def test_change_only_storage(self):
+        """ Test change-only state storage: repeated states are merged """
+        self.app.app.config['STATE_STORAGE'] = 'changes'
+
+        def states():
+            return [(s.id, s.state.name, s.info, s.repeat_count, s.rtime, s.last_seen)
+                    for s in self.db.query(models.ServiceState).order_by(models.ServiceState.id)]
+
+        # Report the same state several times
+        with freeze_time('2014-01-01 00:00:00'):
+            self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+                dict(name='a', state='OK', info='fine'),
+                dict(name='b', state='OK', info='fine'),
+            ])
+        with freeze_time('2014-01-01 00:00:30'):
+            self.assertEqual(supervise_once(self.app, self.db), (0, 0))
+            self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+                dict(name='a', state='OK', info='fine'),
+                dict(name='b', state='OK', info='fine'),
+                dict(name='b', state='OK', info='fine'),  # twice in a single report
+            ])
+        with freeze_time('2014-01-01 00:01:00'):
+            self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+                dict(name='a', state='OK', info='fine'),
+                dict(name='b', state='WARN', info='slow'),
+                dict(name='b', state='WARN', info='slow'),
+            ])
+
+            # Only changes were stored
+            t0, t1 = datetime(2014, 1, 1, 0, 0, 0), datetime(2014, 1, 1, 0, 1, 0)
+            self.assertEqual(states(), [
+                (1, 'OK', 'fine', 2, t0, t1),
+                (2, 'OK', 'fine', 2, t0, datetime(2014, 1, 1, 0, 0, 30)),
+                (3, 'WARN', 'slow', 1, t1, t1),
+            ])
+
+            # Supervisor: only the change is checked
+            self.assertEqual(supervise_once(self.app, self.db), (1, 1))
+
+        # Timeouts are detected by the last time the state was seen
+        with freeze_time('2014-01-01 00:01:59'):
+            self.assertEqual(supervise_once(self.app, self.db), (0, 0))
+        with freeze_time('2014-01-01 00:02:01'):
+            self.assertEqual(supervise_once(self.app, self.db), (2, 2))  # both went offline
+
+        # History shows merged states, even those that started before the requested period
+        with freeze_time('2014-01-01 00:01:30'):
+            res, rv = self.test_client.jsonapi('GET', '/ui/api/status/service/1/states?hours=0.0166')  # ~1 minute
+            self.assertEqual([(s['id'], s['repeat_count'], s['last_seen']) for s in res['states']], [
+                (1, 2, '2014-01-01 00:01:00'),
+            ])
+            res, rv = self.test_client.jsonapi('GET', '/ui/api/status/service/2/states?hours=0.0166')
+            self.assertEqual([(s['id'], s['repeat_count'], s['last_seen']) for s in res['states']], [
+                (3, 1, '2014-01-01 00:01:00'),
+            ])
+
+    def test_prev_state(self):
+        """ Test that states record their predecessors """
+        self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+            dict(name='a', state='OK'),
+            dict(name='b', state='OK'),
+        ])
+        self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+            dict(name='a', state='WARN'),
+            dict(name='a', state='FAIL'),  # twice in a single report
+            dict(name='b', state='OK'),
+        ])
+
+        states = self.db.query(models.ServiceState).order_by(models.ServiceState.id).all()
+        self.assertEqual([(s.id, s.service.name, s.state.name, s.prev_id, s.prev_state.name if s.prev_state is not None else None) for s in states], [
+            (1, 'a', 'OK', None, None),
+            (2, 'b', 'OK', None, None),
+            (3, 'a', 'WARN', 1, 'OK'),
+            (4, 'b', 'OK', 2, 'OK'),
+            (5, 'a', 'FAIL', 3, 'WARN'),
+        ])
+        self.assertIs(states[4].prev, states[2])
+        self.assertIsNone(states[0].prev)
+
+    def test_check_service_states(self):
+        """ Test state change detection on a backlog: a fixed number of statements """
+        services = ['s{}'.format(i) for i in range(50)]
+        for state in ('OK', 'OK', 'WARN', 'WARN', 'FAIL', 'OK'):
+            self.send_service_status({'name': 'localhost', 'key': '1234'}, [dict(name=name, state=state) for name in services])
+        S = models.ServiceState
+
+        # Checked already: left alone
+        self.db.query(S).filter(S.id == 120).update({'checked': True})
+        self.db.commit()
+
+        statements = []
+        @event.listens_for(self.app.db_engine, 'before_cursor_execute')
+        def log_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(' '.join(statement.split()))
+
+        self.assertEqual(_check_service_states(self.db), 50 * 3 - 1)
+        event.remove(self.app.db_engine, 'before_cursor_execute', log_statement)
+        self.assertEqual([s.split(' ')[0] for s in statements], ['SELECT', 'SELECT', 'SELECT', 'INSERT', 'UPDATE', 'UPDATE', 'SELECT'])
+
+        # Alerts: the first states of the services have no predecessors, and count as OK
+        self.assertEqual(self.db.query(S).filter(S.checked == False).count(), 0)
+        alerts = self.db.query(models.Alert).order_by(models.Alert.id).all()
+        self.assertEqual([(a.service_state_id, a.server_id, a.service.name, a.event, a.severity, a.message) for a in alerts[:2]], [
+            (101, 1, 's0', 'WARN', models.state_t.WARN, u'State changed: "OK" -> "WARN"'),
+            (102, 1, 's1', 'WARN', models.state_t.WARN, u'State changed: "OK" -> "WARN"'),
+        ])
+        self.assertNotIn(120, [a.service_state_id for a in alerts])
+        self.assertEqual(_check_service_states(self.db), 0)
+
+    def test_supervisor_batches(self):
+        """ Test that the supervisor works through a backlog in chunks, within its time budget """
+        services = ['s{}'.format(i) for i in range(10)]
+        for state in ('OK', 'WARN', 'OK', 'WARN', 'OK'):
+            self.send_service_status({'name': 'localhost', 'key': '1234'}, [dict(name=name, state=state) for name in services])
+        S = models.ServiceState
+        unchecked = lambda: self.db.query(S).filter(S.checked == False).count()
+        unreported = lambda: self.db.query(models.Alert).filter(models.Alert.reported == False).count()
+
+        # Out of time: a single chunk per run, committed
+        self.assertEqual(_check_service_states(self.db, batch_size=15, time_budget=0), 5)  # ids 1..15: 11..15 changed
+        self.assertEqual(unchecked(), 35)
+        self.db.close()
+        self.assertEqual(unchecked(), 35)
+        self.assertEqual(_check_service_states(self.db, batch_size=15, time_budget=0), 15)
+        self.assertEqual(unchecked(), 20)
+
+        # No time limit: all chunks
+        self.assertEqual(_check_service_states(self.db, batch_size=15), 20)
+        self.assertEqual(unchecked(), 0)
+        self.assertEqual(unreported(), 40)
+
+        # Alerts: the same
+        self.assertEqual(_send_pending_alerts(self.db, [], batch_size=15, time_budget=0), 1)  # at least one
+        self.assertEqual(_send_pending_alerts(self.db, [], batch_size=15), 39)
+        self.assertEqual(unreported(), 0)
+        self.assertEqual(_send_pending_alerts(self.db, [], batch_size=15), 0)
+
+    def test_write_avoidance(self):
+        """ Test that unchanged server & service metadata is not written """
+        statements = []
+
+        @event.listens_for(self.app.db_engine, 'before_cursor_execute')
+        def log_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(' '.join(statement.split()))
+
+        def writes():
+            """ Writes, except for the state & the current state pointer """
+            return [s for s in statements
+                    if not s.startswith('SELECT')
+                    and not s.startswith('INSERT INTO service_states')
+                    and not s.startswith('UPDATE services SET current_state_id')]
+
+        # First report: server, services, states are created
+        self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+            dict(name='a', state='OK', info='fine'),
+            dict(name='b', state='OK', info='fine', period=30),
+        ])
+        self.assertTrue(writes())
+
+        # Pings: nothing to write
+        del statements[:]
+        for i in range(2):
+            res, rv = self.test_client.jsonapi('POST', '/api/ping', {'server': {'name': 'localhost', 'key': '1234'}})
+            self.assertEqual(rv.status_code, 200)
+        self.assertEqual(writes(), [])
+        self.assertEqual([s for s in statements if not s.startswith('SELECT')], [])
+
+        # Same report: only states are inserted
+        del statements[:]
+        self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+            dict(name='a', state='OK', info='fine'),
+            dict(name='b', state='OK', info='fine', period=30),
+        ])
+        self.assertEqual(writes(), [])
+        # The new ids come from the insert: a single UPDATE points the services to them
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE services SET current_state_id')]), 1)
+        self.assertEqual([s for s in statements if 'max(service_states.id)' in s], [])
+        self.assertEqual([(s.name, s.current_state_id, s.current_state.name) for s in self.db.query(models.Service).order_by(models.Service.id)],
+                         [('a', 3, 'OK'), ('b', 4, 'OK')])
+
+        # Period changed: updated
+        del statements[:]
+        self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+            dict(name='a', state='OK', info='fine'),
+            dict(name='b', state='OK', info='fine'),
+        ])
+        self.assertEqual([s.split('=')[0] for s in writes()], ['UPDATE services SET period'])
+        self.assertEqual([s.period for s in self.db.query(models.Service).order_by(models.Service.id)], [60, 60])
+
+        # New IP: updated
+        del statements[:]
+        res, rv = self.test_client.jsonapi('POST', '/api/ping', {'server': {'name': 'localhost', 'key': '1234'}},
+                                           environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual([s.split('=')[0] for s in writes()], ['UPDATE servers SET ip'])
+        self.assertEqual(self.db.query(models.Server).get(1).ip, '10.0.0.1')
+
+        event.remove(self.app.db_engine, 'before_cursor_execute', log_statement)
+
+    def test_server_cache(self):
+        """ Test that known servers are authenticated without queries """
+        statements = []
+
+        @event.listens_for(self.app.db_engine, 'before_cursor_execute')
+        def log_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(' '.join(statement.split()))
+
+        # First report: the server is created, and cached once committed
+        self.send_service_status({'name': 'localhost', 'key': '1234'}, [dict(name='a', state='OK', info='fine')])
+        self.assertEqual(self.app.server_cache.get('localhost'), (1, '1234', '127.0.0.1'))
+
+        # Known server: no SELECT
+        del statements[:]
+        res, rv = self.test_client.jsonapi('POST', '/api/ping', {'server': {'name': 'localhost', 'key': '1234'}})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual([s for s in statements if 'servers' in s], [])
+
+        # A wrong key: refused from the cache
+        res, rv = self.test_client.jsonapi('POST', '/api/ping', {'server': {'name': 'localhost', 'key': 'wrong'}})
+        self.assertEqual(rv.status_code, 403)
+
+        # Deleted by another process: the write fails, and the server is forgotten
+        self.db.query(models.Server).delete()
+        self.db.commit()
+        self.assertRaises(Exception, self.send_service_status, {'name': 'localhost', 'key': '1234'}, [dict(name='b', state='OK', info='fine')])
+
+        # Next report: created again
+        res, rv = self.send_service_status({'name': 'localhost', 'key': '1234'}, [dict(name='b', state='OK', info='fine')])
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.db.query(models.Server).one().name, 'localhost')
+
+        event.remove(self.app.db_engine, 'before_cursor_execute', log_statement)
+
+    def test_rate_limit(self):
+        """ Test per-server rate limiting """
+        self.app.rate_limiter = TokenBuckets(1.0, 2)  # 1 request/sec, burst of 2
+
+        with freeze_time('2014-01-01 00:00:00'):
+            # Burst: fine
+            for i in range(2):
+                res, rv = self.send_service_status({'name': 'a', 'key': '1234'}, [dict(name='s', state='OK')])
+                self.assertEqual(rv.status_code, 200)
+
+            # Exceeded
+            res, rv = self.send_service_status({'name': 'a', 'key': '1234'}, [dict(name='s', state='OK')])
+            self.assertEqual(rv.status_code, 429)
+            self.assertEqual(rv.headers['Retry-After'], '1')
+            res, rv = self.send_alerts({'name': 'a', 'key': '1234'}, [dict(message='hey')])
+            self.assertEqual(rv.status_code, 429)
+
+            # Other servers are fine
+            res, rv = self.send_alerts({'name': 'b', 'key': '1234'}, [dict(message='hey')])
+            self.assertEqual(rv.status_code, 200)
+
+            # Batch: rate-limited one by one
+            res, rv = self.test_client.jsonapi('POST', '/api/set/batch', {'reports': [
+                {'server': {'name': 'a', 'key': '1234'}, 'alerts': [dict(message='hey')]},
+                {'server': {'name': 'b', 'key': '1234'}, 'alerts': [dict(message='hey')]},
+            ]})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(res['results'], [
+                {'error': 'Rate limit exceeded for "a"', 'code': 429, 'retry_after': 1},
+                {'ok': 1},
+            ])
+
+        # Refilled
+        with freeze_time('2014-01-01 00:00:01'):
+            res, rv = self.send_service_status({'name': 'a', 'key': '1234'}, [dict(name='s', state='OK')])
+            self.assertEqual(rv.status_code, 200)
+
+        # Requests with a wrong key do not drain the bucket
+        with freeze_time('2014-01-01 00:00:10'):
+            for i in range(3):
+                res, rv = self.send_service_status({'name': 'a', 'key': 'wrong'}, [dict(name='s', state='OK')])
+                self.assertEqual(rv.status_code, 403)
+            for i in range(2):
+                res, rv = self.send_service_status({'name': 'a', 'key': '1234'}, [dict(name='s', state='OK')])
+                self.assertEqual(rv.status_code, 200)
+
+            # Not cached: authenticated by the database first
+            self.app.server_cache.clear()
+            res, rv = self.send_service_status({'name': 'b', 'key': 'wrong'}, [dict(name='s', state='OK')])
+            self.assertEqual(rv.status_code, 403)
+            self.app.server_cache.clear()
+            res, rv = self.send_service_status({'name': 'b', 'key': '1234'}, [dict(name='s', state='OK')])
+            self.assertEqual(rv.status_code, 200)
+
+        # Nothing was saved for the rejected requests
+        self.assertEqual(self.db.query(models.ServiceState).count(), 6)
+        self.assertEqual(self.db.query(models.Alert).count(), 2)
+
+    def test_stream(self):
+        """ Test /api/set/stream """
+        self.app.app.config['STREAM_CHUNK_SIZE'] = 2
+
+        def post_stream(lines, **kwargs):
+            rv = self.test_client.post('/api/set/stream', content_type='application/x-ndjson', data='\n'.join(lines), **kwargs)
+            return json.loads(rv.get_data()), rv
+
+        lines = [
+            json.dumps({'server': {'name': 'a', 'key': '1234'}, 'period': 60, 'services': [dict(name='app', state='OK')]}),
+            '{"server":',  # invalid JSON
+            '',  # empty
+            json.dumps({'server': {'name': 'a', 'key': '____'}, 'alerts': [dict(message='Not me')]}),  # invalid key
+            json.dumps({'server': {'name': 'b', 'key': '1234'}, 'alerts': [dict(message='x' * 2048)]}),  # too long
+            json.dumps({'server': {'name': 'b', 'key': '1234'}, 'alerts': [dict(message='Disk full')]}),
+            json.dumps({'server': {'name': 'a', 'key': '1234'}, 'period': 60, 'services': [dict(name='app', state='WARN')]}),
+        ]
+
+        from overc.src.bps import api
+        max_line_size, api.STREAM_MAX_LINE_SIZE = api.STREAM_MAX_LINE_SIZE, 1024
+        try:
+            res, rv = post_stream(lines)
+        finally:
+            api.STREAM_MAX_LINE_SIZE = max_line_size
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(res['ok'], 3)
+        self.assertEqual([(e['line'], e['code']) for e in res['errors']], [(2, 400), (4, 403), (5, 413)])
+        self.assertEqual(res['errors_omitted'], 0)
+
+        # Errors: the first ones are listed, the rest are counted
+        max_errors, api.STREAM_MAX_ERRORS = api.STREAM_MAX_ERRORS, 2
+        try:
+            res, rv = post_stream(lines[1:2] * 5)
+        finally:
+            api.STREAM_MAX_ERRORS = max_errors
+        self.assertEqual(res['ok'], 0)
+        self.assertEqual([(e['line'], e['code']) for e in res['errors']], [(1, 400), (2, 400)])
+        self.assertEqual(res['errors_omitted'], 3)
+
+        # Saved
+        self.assertEqual([(s.service.name, s.state.name) for s in self.db.query(models.ServiceState).order_by(models.ServiceState.id)],
+                         [('app', 'OK'), ('app', 'WARN')])
+        self.assertEqual([a.message for a in self.db.query(models.Alert)], [u'Disk full'])
+
+        # Compressed
+        buf = StringIO()
+        with gzip.GzipFile(mode='wb', fileobj=buf) as f:
+            f.write('\n'.join(lines[-1:] * 5))
+        rv = self.test_client.post('/api/set/stream', content_type='application/x-ndjson', data=buf.getvalue(),
+                                   headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(json.loads(rv.get_data()), {'ok': 5, 'errors': [], 'errors_omitted': 0})
+        self.assertEqual(self.db.query(models.ServiceState).count(), 7)
+
+        # Spool mode: spooled in chunks
+        fd, spool_file = tempfile.mkstemp(suffix='.spool')
+        os.close(fd)
+        try:
+            self.app.spool = Spool(spool_file)
+            res, rv = post_stream(lines[-2:] * 3)
+            self.assertEqual(rv.status_code, 202)
+            self.assertEqual(res, {'ok': 6, 'errors': [], 'errors_omitted': 0})
+            self.assertEqual(len(self.app.spool), 6)
+        finally:
+            self.app.spool = None
+            os.unlink(spool_file)
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(spool_file + suffix):
+                    os.unlink(spool_file + suffix)
+
+    def test_retention(self):
+        """ Test retention: pruning old rows """
+        self.app.app.config.update(
+            RETENTION={'service_states': 1, 'alerts': 2},
+            RETENTION_BATCH_SIZE=2,
+        )
+
+        # Report for 3 days
+        for ts in ('2014-01-01 00:00:00', '2014-01-02 00:00:00', '2014-01-03 00:00:00'):
+            with freeze_time(ts):
+                self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+                    dict(name='a', state='OK'),
+                    dict(name='a', state='WARN'),
+                    dict(name='b', state='OK'),
+                ])
+                self.send_alerts({'name': 'localhost', 'key': '1234'}, [dict(message='hey')])
+                supervise_once(self.app, self.db)
+
+        # Not checked, not reported yet: kept
+        with freeze_time('2014-01-03 00:00:01'):
+            self.send_service_status({'name': 'localhost', 'key': '1234'}, [dict(name='a', state='OK')])
+            self.send_alerts({'name': 'localhost', 'key': '1234'}, [dict(message='pending')])
+
+        # Prune
+        with freeze_time('2014-01-04 12:00:00'):
+            self.assertEqual(prune(self.app, self.db), {'service_states': 8, 'service_state_infos': 0, 'alerts': 2})
+
+            # Service states: the current ones, and the unchecked one are kept
+            self.assertEqual([(s.id, s.service.name) for s in self.db.query(models.ServiceState).order_by(models.ServiceState.id)], [
+                (8, 'b'),
+                (10, 'a'),
+            ])
+            self.assertEqual([s.current_state_id for s in self.db.query(models.Service).order_by(models.Service.id)], [10, 8])
+
+            # Alerts: the recent & pending ones are kept
+            self.assertEqual([a.message for a in self.db.query(models.Alert).order_by(models.Alert.id) if a.channel == 'api'], ['hey', 'pending'])
+
+            # Nothing more to do
+            self.assertEqual(prune(self.app, self.db), {'service_states': 0, 'service_state_infos': 0, 'alerts': 0})
+
+    def test_info_storage(self):
+        """ Test info storage: every distinct text is stored once, unused texts are pruned """
+        self.app.app.config.update(
+            RETENTION={'service_states': 1},
+            RETENTION_BATCH_SIZE=1,
+        )
+
+        def infos():
+            return sorted(i.text for i in self.db.query(models.ServiceStateInfo))
+
+        with freeze_time('2014-01-01 00:00:00'):
+            self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+                dict(name='a', state='OK', info=u'fine'),
+                dict(name='b', state='OK', info=u'fine'),
+                dict(name='c', state='WARN', info=u'slow'),
+            ])
+            supervise_once(self.app, self.db)
+        with freeze_time('2014-01-03 00:00:00'):
+            self.send_service_status({'name': 'localhost', 'key': '1234'}, [
+                dict(name='a', state='OK', info=u'fine'),
+                dict(name='b', state='OK', info=u'ok ✓'),
+                dict(name='c', state='OK', info=u'ok ✓'),
+            ])
+            supervise_once(self.app, self.db)
+
+            # Shared
+            self.assertEqual(infos(), [u'fine', u'ok ✓', u'slow'])
+            self.assertEqual([(s.service.name, s.info) for s in self.db.query(models.ServiceState).order_by(models.ServiceState.id)], [
+                ('a', u'fine'), ('b', u'fine'), ('c', u'slow'),
+                ('a', u'fine'), ('b', u'ok ✓'), ('c', u'ok ✓'),
+            ])
+
+        # Prune: the texts no state refers to are gone. With a time budget, only the texts of the deleted states are checked
+        with freeze_time('2014-01-03 12:00:00'):
+            self.assertEqual(prune(self.app, self.db, time_budget=60), {'service_states': 3, 'service_state_infos': 1})
+            self.assertEqual(infos(), [u'fine', u'ok ✓'])
+
+            # Full sweep: nothing left
+            self.assertEqual(prune(self.app, self.db), {'service_states': 0, 'service_state_infos': 0})
+
+    def test_delete_id_ranges(self):
+        """ Test deletion in id ranges: gaps are skipped, the deadline is respected """
+        A = models.Alert
+        self.db.execute(A.__table__.insert(), [
+            dict(id=id, channel='api', event='alert', message=u'hey', ctime=datetime(2014, 1, 1), reported=reported)
+            for id, reported in ((1, True), (2, False), (3, True), (100000, True), (100001, True), (200000, True))
+        ])
+        self.db.commit()
+
+        statements = []
+        @event.listens_for(self.app.db_engine, 'before_cursor_execute')
+        def log_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.split(' ')[0])
+
+        # Gaps & rows that do not match are skipped
+        self.assertEqual(delete_id_ranges(self.db, A.__table__, A.reported == True, 100001, 2), 4)
+        self.assertEqual(statements.count('DELETE'), 3)
+        self.assertEqual([a.id for a in self.db.query(A).order_by(A.id)], [2, 200000])
+
+        # Deadline: a single range
+        del statements[:]
+        self.assertEqual(delete_id_ranges(self.db, A.__table__, A.reported == True, 200000, 2, deadline=0), 1)
+        self.assertEqual(statements.count('DELETE'), 1)
+        event.remove(self.app.db_engine, 'before_cursor_execute', log_statement)
+
+    def test_schema_version(self):
+        """ Test the schema version check & upgrade """
+        engine = self.app.db_engine
+        self.assertEqual(schema.get_version(engine), schema.SCHEMA_VERSION)
+        schema.check(engine)
+
+        # Up to date: nothing to do
+        self.assertEqual(schema.upgrade(engine), (schema.SCHEMA_VERSION, schema.SCHEMA_VERSION))
+
+        # Unversioned: refuse to start
+        engine.execute(models.SchemaVersion.__table__.delete())
+        self.assertRaises(schema.SchemaVersionError, schema.check, engine)
+        self.assertRaises(schema.SchemaVersionError, OvercApplication, __name__, self.instance_path, self.app.app.config)
+
+        # Upgrade: refused, the tables are not the baseline ones
+        self.assertRaises(schema.SchemaVersionError, schema.upgrade, engine)
+        self.assertEqual(schema.get_version(engine), None)
+
+    def test_schema_migrations(self):
+        """ Test the migrations from the baseline schema, v1 """
+        engine = self.app.db_engine
+        self.db.close()
+        models.Base.metadata.drop_all(bind=engine)
+
+        # The baseline schema, created before the schema was versioned
+        meta = MetaData()
+        Table('servers', meta,
+              Column('id', Integer, primary_key=True), Column('title', Unicode(64), nullable=False),
+              Column('name', String(32), nullable=False), Column('key', String(32), nullable=False), Column('ip', String(46)),
+              UniqueConstraint('name'))
+        Table('services', meta,
+              Column('id', Integer, primary_key=True), Column('server_id', Integer, ForeignKey('servers.id', ondelete='CASCADE'), nullable=False),
+              Column('period', Integer), Column('timed_out', Boolean, nullable=False),
+              Column('name', String(32), nullable=False), Column('title', Unicode(64), nullable=False),
+              UniqueConstraint('server_id', 'name'))
+        Table('service_states', meta,
+              Column('id', BigInteger, primary_key=True), Column('service_id', Integer, ForeignKey('services.id', ondelete='CASCADE'), nullable=False),
+              Column('checked', Boolean, nullable=False), Column('rtime', DateTime),
+              Column('state', Enum(*models.state_t.states, name='service_state'), nullable=False), Column('info', UnicodeText, nullable=False),
+              Index('idx_serviceid_rtime_id', 'service_id', 'rtime', 'id'), Index('idx_checked', 'checked'))
+        Table('alerts', meta,
+              Column('id', BigInteger, primary_key=True),
+              Column('server_id', Integer, ForeignKey('servers.id', ondelete='CASCADE')), Column('service_id', Integer, ForeignKey('services.id', ondelete='CASCADE')),
+              Column('service_state_id', BigInteger, ForeignKey('service_states.id', ondelete='SET NULL')),
+              Column('reported', Boolean, nullable=False), Column('ctime', DateTime),
+              Column('channel', String(32), nullable=False), Column('event', String(32), nullable=False), Column('message', UnicodeText, nullable=False),
+              Index('idx_reported', 'reported'))
+        meta.create_all(bind=engine)
+
+        # Baseline data. SQLite did not auto-increment the BIGINT primary keys: the ids are explicit
+        t = [datetime(2014, 1, 1, 10, i) for i in range(3)]
+        engine.execute(meta.tables['servers'].insert(), {'id': 1, 'title': u'', 'name': 'a', 'key': '1234'})
+        engine.execute(meta.tables['services'].insert(), [
+            {'id': 1, 'server_id': 1, 'period': 60, 'timed_out': False, 'name': 'app', 'title': u''},
+            {'id': 2, 'server_id': 1, 'period': 60, 'timed_out': False, 'name': 'db', 'title': u''},
+        ])
+        engine.execute(meta.tables['service_states'].insert(), [
+            {'id': 1, 'service_id': 1, 'checked': True, 'rtime': t[0], 'state': 'OK', 'info': u'fine'},
+            {'id': 2, 'service_id': 2, 'checked': True, 'rtime': t[0], 'state': 'OK', 'info': u'fine'},
+            {'id': 3, 'service_id': 1, 'checked': True, 'rtime': t[1], 'state': 'WARN', 'info': u'slow ✓'},
+            {'id': 4, 'service_id': 1, 'checked': True, 'rtime': t[2], 'state': 'WARN', 'info': u'slow ✓'},
+            {'id': 5, 'service_id': 2, 'checked': False, 'rtime': t[2], 'state': 'FAIL', 'info': u'down'},
+        ])
+        engine.execute(meta.tables['alerts'].insert(), [
+            {'id': 1, 'server_id': 1, 'service_id': 1, 'service_state_id': 3, 'reported': True, 'ctime': t[1], 'channel': 'service:state', 'event': 'WARN', 'message': u''},
+            {'id': 2, 'server_id': 1, 'service_id': None, 'service_state_id': None, 'reported': False, 'ctime': t[2], 'channel': 'api', 'event': 'alert', 'message': u''},
+            {'id': 3, 'server_id': None, 'service_id': None, 'service_state_id': None, 'reported': False, 'ctime': t[2], 'channel': 'plugin', 'event': 'online', 'message': u''},
+        ])
+
+        # Upgrade: interrupted in the middle of a batched step, in id ranges of 2 states
+        self.assertEqual(schema.get_version(engine), None)
+        steps = schema.MIGRATIONS[2]
+        prev_states, table, batch_size = steps[1]
+        ranges = []
+        def interrupted(conn, start, end):
+            ranges.append((start, end))
+            if len(ranges) == 2:
+                raise RuntimeError('Interrupted')
+            prev_states(conn, start, end)
+        steps[1] = (interrupted, table, 2)
+        try:
+            self.assertRaises(RuntimeError, schema.upgrade, engine)
+        finally:
+            steps[1] = (prev_states, table, batch_size)
+        self.assertEqual(schema.get_version(engine), 1)
+        self.assertEqual(engine.execute(schema.PROGRESS.select()).fetchall(), [(2, 1, 2)])  # step 1 done, ids up to 2
+
+        # Resumed
+        del ranges[:]
+        steps[1] = (lambda conn, start, end: ranges.append((start, end)) or prev_states(conn, start, end), table, 2)
+        try:
+            self.assertEqual(schema.upgrade(engine), (1, schema.SCHEMA_VERSION))
+        finally:
+            steps[1] = (prev_states, table, batch_size)
+        self.assertEqual(ranges, [(3, 5), (5, 6)])
+        self.assertEqual(engine.execute(schema.PROGRESS.select()).fetchall(), [])
+        schema.check(engine)
+        self.assertEqual(schema.upgrade(engine), (schema.SCHEMA_VERSION, schema.SCHEMA_VERSION))
+
+        # v2: state pointers, alert severity
+        self.assertEqual(engine.execute('SELECT id, prev_id, repeat_count FROM service_states ORDER BY id').fetchall(), [
+            (1, None, 0), (2, None, 0), (3, 1, 0), (4, 3, 0), (5, 2, 0)])
+        self.assertEqual(engine.execute('SELECT id, current_state_id FROM services ORDER BY id').fetchall(), [(1, 4), (2, 5)])
+        self.assertEqual(engine.execute('SELECT id, severity FROM alerts ORDER BY id').fetchall(), [
+            (1, models.state_t.WARN), (2, models.state_t.FAIL), (3, models.state_t.OK)])
+        self.assertEqual(engine.execute(models.ServiceStateHourly.__table__.select()).fetchall(), [])
+        self.assertEqual(sorted(fk['referred_table'] for fk in inspect(engine).get_foreign_keys('alerts')), ['servers', 'service_states', 'services'])
+
+        # v3: states are numbers
+        self.assertEqual(engine.execute('SELECT id, state, prev_state FROM service_states ORDER BY id').fetchall(), [
+            (1, 0, None), (2, 0, None), (3, 1, 0), (4, 1, 1), (5, 2, 0)])
+        self.assertEqual(engine.execute('SELECT id, current_state FROM services ORDER BY id').fetchall(), [(1, 1), (2, 2)])
+
+        # v4: every distinct info text is stored once
+        self.assertEqual(engine.execute('SELECT id, text FROM service_state_infos ORDER BY id').fetchall(), [(1, u'fine'), (2, u'slow ✓'), (3, u'down')])
+        self.assertEqual(engine.execute('SELECT id, info_id FROM service_states ORDER BY id').fetchall(), [(1, 1), (2, 1), (3, 2), (4, 2), (5, 3)])
+        self.assertNotIn('info', [c['name'] for c in inspect(engine).get_columns('service_states')])
+
+        # The models work
+        S = models.ServiceState
+        self.assertEqual([(s.id, s.state, s.info, s.prev_id) for s in self.db.query(S).order_by(S.id)], [
+            (1, models.state_t.OK, u'fine', None),
+            (2, models.state_t.OK, u'fine', None),
+            (3, models.state_t.WARN, u'slow ✓', 1),
+            (4, models.state_t.WARN, u'slow ✓', 3),
+            (5, models.state_t.FAIL, u'down', 2),
+        ])
+        self.db.close()
+        with freeze_time('2014-01-01 10:05:00'):
+            self.send_service_status({'name': 'a', 'key': '1234'}, [dict(name='db', state='OK', info=u'fine')])
+        state = self.db.query(models.Service).filter_by(name='db').one().state
+        self.assertEqual((state.id, state.state, state.info_id, state.prev_id), (6, models.state_t.OK, 1, 5))
+
+    def test_sqlite_profile(self):
+        """ Test the SQLite profile: pragmas, concurrent writers """
+        if self.app.db_engine.url.drivername != 'sqlite':
+            raise unittest.SkipTest('SQLite only')
+
+        # Pragmas
+        conn = self.app.db_engine.connect()
+        try:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(conn.execute('PRAGMA foreign_keys').scalar(), 1)
+            self.assertEqual(conn.execute('PRAGMA synchronous').scalar(), 1)  # NORMAL
+            self.assertEqual(conn.execute('PRAGMA busy_timeout').scalar(), 30000)
+        finally:
+            conn.close()
+
+        # Writers with engines of their own, like separate processes: read, then write
+        errors = []
+        def writer(n):
+            engine = init_db_engine(str(self.app.db_engine.url), self.app.app.config)
+            try:
+                for i in range(20):
+                    with engine.begin() as conn:
+                        conn.execute(models.Server.__table__.select()).fetchall()
+                        conn.execute(models.Server.__table__.insert(), {'name': 'w{}-{}'.format(n, i), 'title': u'', 'key': ''})
+            except Exception as e:
+                errors.append(e)
+            finally:
+                engine.dispose()
+
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.db.query(models.Server).count(), 80)
+
+        # Dashboard reads: a read-only engine of their own, which does not wait for the writer
+        self.assertIsNot(self.app.db_read_engine, self.app.db_engine)
+        read_engine = init_db_engine(str(self.app.db_engine.url), dict(self.app.app.config, SQLITE_BUSY_TIMEOUT=0.5), 'read')
+        self.db.close()
+        writer = self.app.db_engine.connect()
+        try:
+            with writer.begin():
+                writer.execute(models.Server.__table__.delete())
+                with read_engine.begin() as conn:
+                    self.assertEqual(conn.execute('PRAGMA query_only').scalar(), 1)
+                    self.assertEqual(len(conn.execute(models.Server.__table__.select()).fetchall()), 80)
+        finally:
+            writer.close()
+            read_engine.dispose()
+
+    def test_supervisor_wakeup(self):
+        """ Test supervisor wake-ups: the API signals after saving """
+        # Default socket: per instance & database
+        config = self.app.app.config
+        self.assertEqual(config['SUPERVISOR_WAKEUP'], wakeup_default_path(config['INSTANCE_PATH'], config['DATABASE']))
+        self.assertNotEqual(wakeup_default_path(config['INSTANCE_PATH'], 'sqlite:////tmp/other.db'), config['SUPERVISOR_WAKEUP'])
+        self.assertNotEqual(wakeup_default_path('/etc/overc-other', config['DATABASE']), config['SUPERVISOR_WAKEUP'])
+
+        fd, path = tempfile.mkstemp(suffix='.sock')
+        os.close(fd)  # a stale file: replaced
+
+        listener = WakeupListener(path)
+        try:
+            self.assertFalse(listener.wait(0))
+
+            # Another supervisor can't take it over
+            self.assertRaises(socket.error, WakeupListener, path)
+
+            # Report: woken up once, however many wake-ups were queued
+            app = OvercApplication(__name__, self.instance_path, dict(self.app.app.config, SUPERVISOR_WAKEUP=path))
+            client = app.app.test_client()
+            for i in range(3):
+                rv = client.post('/api/set/service/status', content_type='application/json', data=json.dumps({
+                    'server': {'name': 'a.example.com', 'key': '1234'},
+                    'period': 60,
+                    'services': [{'name': 'app', 'state': 'OK'}],
+                }))
+                self.assertEqual(rv.status_code, 200)
+            app.db_engine.dispose()
+            self.assertTrue(listener.wait(0))
+            self.assertFalse(listener.wait(0))
+
+            # Invalid reports do not wake it up
+            rv = client.post('/api/set/service/status', content_type='application/json', data=json.dumps({
+                'server': {'name': 'a.example.com', 'key': 'wrong'},
+                'period': 60,
+                'services': [{'name': 'app', 'state': 'OK'}],
+            }))
+            self.assertEqual(rv.status_code, 403)
+            self.assertFalse(listener.wait(0))
+        finally:
+            listener.close()
+
+        # Nobody listens: reports are fine
+        self.assertFalse(os.path.exists(path))
+        res, rv = self.test_client.jsonapi('POST', '/api/set/service/status', {
+            'server': {'name': 'a.example.com', 'key': '1234'},
+            'period': 60,
+            'services': [{'name': 'app', 'state': 'OK'}],
+        })
+        self.assertEqual(rv.status_code, 200)
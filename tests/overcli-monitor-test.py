@@ -3,7 +3,8 @@ from datetime import datetime
 import unittest
 from freezegun import freeze_time
 
-from overcli.monitor import Service, ServicesMonitor
+from overcli.monitor import Service, ServicesMonitor, StatusReporter
+from overcli.overclient import RetryLater
 
 
 class MonitorTest(unittest.TestCase):
@@ -121,3 +122,44 @@ class MonitorTest(unittest.TestCase):
         # Lags should've been updated
         for s in services.values():
             self.assertAlmostEqual(s.lag, 3.0, delta=1.0)
+
+    def test_reporter_backoff(self):
+        """ Test how the reporter backs off when the server asks to retry later """
+        class Overclient(object):
+            def __init__(self):
+                self.reports = []
+                self.retry_after = None
+
+            def set_service_status(self, period, services):
+                if self.retry_after:
+                    raise RetryLater(self.retry_after)
+                self.reports.append((period, list(services)))
+
+        overc = Overclient()
+        reporter = StatusReporter(overc)
+
+        with freeze_time('2014-01-01 00:00:00'):
+            # Fine
+            self.assertTrue(reporter.report(15, [{'name': 'a', 'state': 'OK'}]))
+            self.assertIsNone(reporter.retry_in())
+
+            # Rate-limited: kept
+            overc.retry_after = 10
+            self.assertFalse(reporter.report(15, [{'name': 'a', 'state': 'WARN'}, {'name': 'b', 'state': 'OK'}]))
+            self.assertEqual(reporter.retry_in(), 10.0)
+        overc.retry_after = None
+
+        with freeze_time('2014-01-01 00:00:05'):
+            # Still waiting: merged
+            self.assertFalse(reporter.report(30, [{'name': 'a', 'state': 'FAIL'}]))
+            self.assertEqual(reporter.retry_in(), 5.0)
+
+        with freeze_time('2014-01-01 00:00:10'):
+            # Reported at once
+            self.assertTrue(reporter.report(15, []))
+            self.assertIsNone(reporter.retry_in())
+
+        self.assertEqual(overc.reports, [
+            (15, [{'name': 'a', 'state': 'OK'}]),
+            (30, [{'name': 'b', 'state': 'OK'}, {'name': 'a', 'state': 'FAIL'}]),
+        ])
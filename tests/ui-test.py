@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
 import unittest
+import tempfile
+from datetime import datetime, timedelta
 from freezegun import freeze_time
+from sqlalchemy import event
 
 from . import ApplicationTest
-from overc.lib.db import models
+from flask import json
+from overc import OvercApplication
+from overc.src.init import init_db_engine, db_pool_options
+from overc.lib.db import models, schema
+from overc.lib import ingest, retention
+from overc.lib.rollup import rollup_once
+from overc.lib.supervise import supervise_once
 
 class UITest(ApplicationTest, unittest.TestCase):
     """ Test UI """
@@ -108,7 +119,7 @@ class UITest(ApplicationTest, unittest.TestCase):
         states = res.pop('states')
         self.assertEqual(len(states), 1)
         self.assertDictEqual(states[0], {
-            'id': 2, 'rtime': '2014-01-01 00:00:00', 'state': 'OK', 'info': 'Available',
+            'id': 2, 'rtime': '2014-01-01 00:00:00', 'last_seen': '2014-01-01 00:00:00', 'repeat_count': 0, 'state': 'OK', 'info': 'Available',
             'alerts': [],
             'service_id': 2, 'service': 'db'
         })
@@ -198,6 +209,11 @@ class UITest(ApplicationTest, unittest.TestCase):
         self.assertIsNone(self.db.query(models.Server).get(1))
         self.assertItemsCount(0, 0, 0)  # -1 server: -3 services, -3 service alerts, -1 server alert
 
+        # The server identity is forgotten: it can register again with a different key
+        res, rv = self.test_client.jsonapi('POST', '/api/ping', {'server': {'name': 'a.example.com', 'key': '9876'}})
+        self.assertEqual(rv.status_code, 200)
+        self.assertItemsCount(1, 0, 0)
+
 
     @freeze_time('2014-01-01 00:00:00')
     def test_api_service_states_collapse(self):
@@ -224,6 +240,8 @@ class UITest(ApplicationTest, unittest.TestCase):
                 'state': state, 'info': info,
                 'alerts': [ { 'id': a['id'], 'severity': 'FAIL', 'channel': 'test', 'event': 'test', 'message': 'test' } for a in alerts or [] ],
                 'rtime': '2014-01-01 00:00:00',
+                'last_seen': '2014-01-01 00:00:00',
+                'repeat_count': 0,
                 'service_id': 1,
                 'service': 'app'
             })
@@ -313,3 +331,251 @@ class UITest(ApplicationTest, unittest.TestCase):
         assertGroup(states[19],   [ 2, 4], 'OK', 3)
         assertState(states[20], id= 1, state='OK',   info='1')
         self.assertEqual(len(states), 21)
+
+    def test_api_service_history(self):
+        """ Test /api/status/service/:service_id/history & the rollups """
+        self.app.app.config['ROLLUP_DOWNSAMPLE_AFTER'] = 24
+
+        def report(state, n=1):
+            res, rv = self.test_client.jsonapi('POST', '/api/set/service/status', {
+                'server': {'name': 'a.example.com', 'key': '1234'},
+                'period': 60,
+                'services': [{'name': 'app', 'state': state, 'info': ''}] * n
+            })
+            self.assertEqual(rv.status_code, 200)
+
+        def history(**params):
+            res, rv = self.test_client.jsonapi('GET', '/ui/api/status/service/1/history?' + '&'.join('{}={}'.format(*p) for p in params.items()))
+            self.assertEqual(rv.status_code, 200)
+            return [(h['period'], h['counts'], h['n_states'], h['transitions']) for h in res['history']]
+
+        # Report: two days
+        for ts, state, n in [
+            ('2014-01-01 10:00:00', 'OK', 2),
+            ('2014-01-01 10:30:00', 'WARN', 1),
+            ('2014-01-01 11:10:00', 'OK', 1),
+            ('2014-01-02 12:00:00', 'FAIL', 3),
+        ]:
+            with freeze_time(ts):
+                report(state, n)
+
+        counts = lambda ok=0, warn=0, fail=0, unk=0: {'OK': ok, 'WARN': warn, 'FAIL': fail, 'UNK': unk}
+        expected_hourly = [
+            ('2014-01-01 10:00:00', counts(ok=2, warn=1), 3, 1),
+            ('2014-01-01 11:00:00', counts(ok=1), 1, 1),
+            ('2014-01-02 12:00:00', counts(fail=3), 3, 1),
+        ]
+        expected_daily = [
+            ('2014-01-01 00:00:00', counts(ok=3, warn=1), 4, 2),
+            ('2014-01-02 00:00:00', counts(fail=3), 3, 1),
+        ]
+
+        with freeze_time('2014-01-02 12:30:00'):
+            # Not rolled up yet: aggregated from the raw states, with a single query
+            statements = []
+            log_statement = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(self.app.db_read_engine, 'before_cursor_execute', log_statement)
+            self.assertEqual(history(hours=48), expected_hourly)
+            self.assertEqual(history(hours=720), expected_hourly)
+            event.remove(self.app.db_read_engine, 'before_cursor_execute', log_statement)
+            self.assertEqual(len([s for s in statements if 'service_states.rtime' in s]), 2)
+
+            # Roll up: complete hours only
+            supervise_once(self.app, self.db)  # states have to be checked before they're deleted
+            self.assertEqual(rollup_once(self.app, self.db, time_budget=0), (1, 0, 0))  # out of time: the rest is left
+            self.assertEqual(rollup_once(self.app, self.db), (1, 1, 4))  # raw states older than 24h are deleted
+            self.assertEqual(rollup_once(self.app, self.db), (0, 0, 0))
+            self.assertEqual(self.db.query(models.ServiceState).count(), 3)
+
+            # Same history
+            self.assertEqual(history(hours=48), expected_hourly)
+            self.assertEqual(history(hours=48, resolution='day'), expected_daily)
+            self.assertEqual(history(hours=2), expected_hourly[-1:])
+
+        with freeze_time('2014-01-03 13:00:00'):
+            # Current states are never deleted
+            self.assertEqual(rollup_once(self.app, self.db), (1, 1, 2))
+            self.assertEqual([s.id for s in self.db.query(models.ServiceState)], [7])
+
+            self.assertEqual(history(hours=48), expected_hourly[-1:])
+            self.assertEqual(history(hours=24*40), expected_daily)
+
+    def test_rollup_late_repeats(self):
+        """ Test the rollups of states repeated after they're rolled up """
+        self.app.app.config['STATE_STORAGE'] = 'changes'
+        self.app.app.config['ROLLUP_DOWNSAMPLE_AFTER'] = 1
+
+        def report(state):
+            res, rv = self.test_client.jsonapi('POST', '/api/set/service/status', {
+                'server': {'name': 'a.example.com', 'key': '1234'},
+                'period': 60,
+                'services': [{'name': 'app', 'state': state, 'info': ''}]
+            })
+            self.assertEqual(rv.status_code, 200)
+
+        def hourly():
+            H = models.ServiceStateHourly
+            return [(str(r.period), r.n_ok, r.n_warn, r.n_states) for r in self.db.query(H).order_by(H.period)]
+
+        with freeze_time('2014-01-01 10:30:00'):
+            report('OK')
+        with freeze_time('2014-01-01 11:05:00'):
+            supervise_once(self.app, self.db)
+            self.assertEqual(rollup_once(self.app, self.db), (1, 0, 0))
+            self.assertEqual(hourly(), [('2014-01-01 10:00:00', 1, 0, 1)])
+
+        # Repeated while current, then replaced
+        for ts in ('2014-01-01 11:10:00', '2014-01-01 11:20:00'):
+            with freeze_time(ts):
+                report('OK')
+        with freeze_time('2014-01-01 12:10:00'):
+            supervise_once(self.app, self.db)
+            self.assertEqual(rollup_once(self.app, self.db), (0, 0, 0))  # the hour of 11 is empty: skipped
+            self.assertEqual(hourly(), [('2014-01-01 10:00:00', 3, 0, 1)])
+        with freeze_time('2014-01-01 12:20:00'):
+            report('OK')
+            report('WARN')
+        with freeze_time('2014-01-02 13:00:00'):
+            supervise_once(self.app, self.db)
+            self.assertEqual(rollup_once(self.app, self.db), (1, 1, 1))
+            self.assertEqual(hourly(), [('2014-01-01 10:00:00', 4, 0, 1), ('2014-01-01 12:00:00', 0, 1, 1)])
+            self.assertEqual([(r.n_ok, r.n_warn) for r in self.db.query(models.ServiceStateDaily)], [(4, 1)])
+
+    def test_api_status_db(self):
+        """ Test /api/status/db: pool usage """
+        self.test_client.jsonapi('GET', '/ui/api/status/')
+        res, rv = self.test_client.jsonapi('GET', '/ui/api/status/db')
+        self.assertEqual(rv.status_code, 200)
+        self.assertGreaterEqual(res['pool']['checkouts'], 1)
+        self.assertEqual(res['pool']['checked_out'], 0)  # all returned
+        self.assertEqual(set(res['pool']), {'checkouts', 'checked_out', 'peak', 'wait_avg', 'wait_max', 'hold_avg', 'hold_max', 'size', 'overflow'})
+
+        # Pool options: the supervisor overrides the web app ones
+        config = {'DATABASE_POOL': {'size': 5, 'recycle': 3600}, 'SUPERVISOR_DATABASE_POOL': {'size': 1}}
+        self.assertEqual(db_pool_options(config), {'size': 5, 'recycle': 3600})
+        self.assertEqual(db_pool_options(config, 'supervisor'), {'size': 1, 'recycle': 3600})
+
+    def test_read_replica(self):
+        """ Test read-only DSN: the dashboard reads from it, writes go to the primary """
+        # A "replica" that does not replicate: an empty database
+        fd, replica = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        replica = 'sqlite:///' + replica
+        db_engine = init_db_engine(replica)
+        schema.upgrade(db_engine)
+        db_engine.dispose()
+
+        app = OvercApplication(__name__, self.instance_path, dict(self.app.app.config, DATABASE_READ=replica))
+        client = app.app.test_client()
+        try:
+            # Report: the primary gets it
+            rv = client.post('/api/set/service/status', content_type='application/json', data=json.dumps({
+                'server': {'name': 'a.example.com', 'key': '1234'},
+                'period': 60,
+                'services': [{'name': 'app', 'state': 'OK', 'info': 'Fine'}],
+            }))
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(self.db.query(models.ServiceState).count(), 1)
+            self.db.close()
+
+            # The dashboard reads the replica
+            rv = client.get('/ui/api/status/')
+            self.assertEqual(json.loads(rv.get_data())['servers'], [])
+            rv = client.get('/ui/api/status/db')
+            self.assertIsNotNone(json.loads(rv.get_data())['read_pool'])
+
+            # Writes go to the primary
+            rv = client.delete('/ui/api/item/server/1')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(self.db.query(models.Server).count(), 0)
+        finally:
+            app.db_read_engine.dispose()
+            app.db_engine.dispose()
+            os.unlink(replica[len('sqlite:///'):])
+
+    def test_history_segments(self):
+        """ Test the segments history backend: same states as the SQL one """
+        path = tempfile.mkdtemp()
+        app = OvercApplication(__name__, self.instance_path, dict(self.app.app.config,
+            STATE_STORAGE='changes', HISTORY_BACKEND='segments', HISTORY_PATH=path, HISTORY_SEGMENT_HOURS=1,
+            RETENTION={'history': 1}))
+        client = app.app.test_client()
+        try:
+            # Report: states, repeats & alerts, over several segments
+            for ts, services in [
+                ('2014-01-01 10:00:00', [('app', 'OK', '1'), ('db', 'OK', '1')]),
+                ('2014-01-01 10:30:00', [('app', 'OK', '1'), ('app', 'OK', '1'), ('db', 'WARN', '2')]),
+                ('2014-01-01 11:10:00', [('app', 'OK', '1'), ('app', 'FAIL', '3'), ('app', 'FAIL', '3')]),
+                ('2014-01-01 13:00:00', [('app', 'FAIL', '3'), ('db', 'WARN', '2')]),
+                ('2014-01-01 13:20:00', [('app', 'OK', '4')]),
+            ]:
+                with freeze_time(ts):
+                    rv = client.post('/api/set/service/status', content_type='application/json', data=json.dumps({
+                        'server': {'name': 'a.example.com', 'key': '1234'},
+                        'period': 60,
+                        'services': [{'name': name, 'state': state, 'info': info} for name, state, info in services],
+                    }))
+                    self.assertEqual(rv.status_code, 200)
+                    supervise_once(app, app.db())
+                    app.db.remove()
+            self.assertEqual(len(app.history.segments()), 3)
+
+            # A rolled back transaction appends nothing
+            ssn = app.db()
+            server = ssn.query(models.Server).one()
+            ingest.set_service_status(ssn, server, {'period': 60, 'services': [{'name': 'app', 'state': 'WARN'}]}, changes_only=True)
+            ssn.rollback()
+            app.db.remove()
+            self.assertEqual(len(app.history.segments()), 3)
+
+            # Same states as in SQL
+            with freeze_time('2014-01-01 13:30:00'):
+                for service_id in (1, 2):
+                    for hours in (0.25, 1, 2.5, 4):
+                        for use_mmap in (True, False):
+                            app.history.use_mmap = use_mmap
+                            uri = '/ui/api/status/service/{}/states?hours={}'.format(service_id, hours)
+                            expected = self.test_client.jsonapi('GET', uri)[0]
+                            self.db.close()
+                            self.assertEqual(json.loads(client.get(uri).get_data()), expected)
+                            app.db.remove()
+
+                states = expected['states']
+                self.assertEqual([(s['state'], s['repeat_count']) for s in states], [('WARN', 1), ('OK', 0)])
+                self.assertIn('WARN', [a['event'] for a in states[0]['alerts']])
+
+                # Segments read: the period's, and back to the state current at its start only if it was seen during the period
+                read_records = app.history._read_records
+                segments_read = []
+                app.history._read_records = lambda start, offsets: segments_read.append(start) or read_records(start, offsets)
+                try:
+                    for service_id, hours, n in ((1, 0.25, 1), (2, 0.25, 1), (2, 1, 2)):
+                        del segments_read[:]
+                        app.history.read(app.db(), service_id, datetime(2014, 1, 1, 13, 30) - timedelta(hours=hours))
+                        self.assertEqual(len(segments_read), n)
+                finally:
+                    app.history._read_records = read_records
+                    app.db.remove()
+
+            # An index file per service
+            self.assertEqual(sorted(os.listdir(os.path.join(path, '20140101T130000.idx'))), ['1', '2'])
+
+            # Reads see the entries appended meanwhile
+            with freeze_time('2014-01-01 13:40:00'):
+                rv = client.post('/api/set/service/status', content_type='application/json', data=json.dumps({
+                    'server': {'name': 'a.example.com', 'key': '1234'},
+                    'period': 60,
+                    'services': [{'name': 'app', 'state': 'WARN', 'info': '5'}],
+                }))
+                self.assertEqual(rv.status_code, 200)
+                app.db.remove()
+                self.assertEqual([s.info for s in app.history.read(app.db(), 1, datetime(2014, 1, 1, 13, 15))], [u'5', u'4'])
+                app.db.remove()
+
+            # Retention: whole segments
+            self.assertEqual(retention.prune(app, app.db(), datetime(2014, 1, 2, 13, 30))['history'], 2)
+            self.assertEqual(len(app.history.segments()), 1)
+        finally:
+            app.db.remove()
+            app.db_engine.dispose()
+            shutil.rmtree(path)